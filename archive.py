@@ -0,0 +1,224 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains an archive for storing many small downloaded documents in
+a few large, append-only segment files with an index of where each document
+starts and how long it is. Documents are read back as read-only buffers over a
+memory map of their segment, so nothing needs to be extracted or copied. The
+archive is content-addressed: byte-identical documents are stored once and
+every id that shares them points to the same bytes.
+"""
+
+import csv
+import hashlib
+import mmap
+import os
+
+## name of the csv file listing where each document is stored
+INDEX_NAME = 'index.csv'
+## headers for the index csv
+INDEX_HEADERS = ['id', 'segment', 'offset', 'length', 'digest']
+## template for the names of segment files
+SEGMENT_NAME_TEMPLATE = 'segment-%05i.dat'
+## the default size in bytes after which a new segment file is started
+DEFAULT_SEGMENT_SIZE = 1024 ** 3
+
+
+class SegmentArchive(object):
+    """
+    A directory of append-only segment files containing documents keyed by id.
+        Only one process should add documents at a time, but any number may
+        read them. Ids are stored as strings.
+    """
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        Open an archive, creating it if it does not already exist.
+        @param directory: Directory containing the archive.
+        @param segment_size: Size in bytes after which a new segment is started.
+        """
+        self.directory = os.path.abspath(directory)
+        self.segment_size = segment_size
+        self._index = dict()
+        self._digests = dict()
+        self._segment_count = 0
+        self._maps = dict()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        if not os.path.exists(index_path):
+            with open(index_path, 'w') as csv_file:
+                csv.writer(csv_file).writerow(INDEX_HEADERS)
+        else:
+            with open(index_path) as csv_file:
+                for row in csv.DictReader(csv_file):
+                    segment = int(row['segment'])
+                    location = (segment, int(row['offset']), int(row['length']))
+                    self._index[row['id']] = location + (row['digest'],)
+                    self._digests[row['digest']] = location
+                    self._segment_count = max(self._segment_count, segment + 1)
+
+    def __getstate__(self):
+        """
+        Only the location is pickled; the index is read again when unpickled.
+        """
+        return {'directory': self.directory, 'segment_size': self.segment_size}
+
+    def __setstate__(self, state):
+        """
+        Reopen an archive from its pickled location.
+        @param state: The pickled state.
+        """
+        self.__init__(state['directory'], state['segment_size'])
+
+    def __contains__(self, item_id):
+        return str(item_id) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def ids(self):
+        """
+        @return: A list of the ids of all documents in the archive.
+        """
+        return self._index.keys()
+
+    def get_size(self, item_id):
+        """
+        @param item_id: The id of a document in the archive.
+        @return: The size of the document in bytes.
+        """
+        return self._index[str(item_id)][2]
+
+    def get_sizes(self):
+        """
+        @return: A dict mapping the id of each document to its size in bytes.
+        """
+        return dict(
+            (item_id, location[2])
+            for item_id, location in self._index.iteritems()
+        )
+
+    def get_digest(self, item_id):
+        """
+        @param item_id: The id of a document in the archive.
+        @return: The SHA-1 hex digest of the document's contents.
+        """
+        return self._index[str(item_id)][3]
+
+    def group_ids_by_content(self, item_ids=None):
+        """
+        Group ids whose documents are byte-identical.
+        @param item_ids: A collection of ids in the archive, or None for all.
+        @return: A dict mapping the first id in each group, in the order
+            supplied, to a list of all ids in the group.
+        """
+        if item_ids is None:
+            item_ids = self.ids()
+        groups = dict()
+        for item_id in item_ids:
+            groups.setdefault(self.get_digest(item_id), list()).append(
+                str(item_id)
+            )
+        return dict((group[0], group) for group in groups.itervalues())
+
+    def get(self, item_id):
+        """
+        Get a document without copying it.
+        @param item_id: The id of a document in the archive.
+        @return: A read-only buffer containing the document. Use str() on it if
+            a copy is needed.
+        """
+        segment, offset, length, digest = self._index[str(item_id)]
+        # an empty document may be alone in a segment, which cannot be mapped
+        if length == 0:
+            return buffer('')
+        segment_map = self._maps.get(segment)
+        # segments that are still being appended to may have grown; any old
+        # map is left open for buffers that still refer to it
+        if segment_map is None or len(segment_map) < offset + length:
+            with open(self._get_segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return buffer(segment_map, offset, length)
+
+    def put(self, item_id, data):
+        """
+        Add a document to the archive. If a document with the same id is
+            already stored, the new one takes its place. If a document with the
+            same contents is already stored, the id is pointed at it rather
+            than storing the contents again.
+        @param item_id: The id of the document.
+        @param data: The document as a string.
+        @return: True if the contents were new to the archive; otherwise, False.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        location = self._digests.get(digest)
+        if location is not None:
+            self._add_to_index(item_id, location, digest)
+            return False
+        segment = max(self._segment_count - 1, 0)
+        segment_path = self._get_segment_path(segment)
+        if (
+            os.path.exists(segment_path) and
+            os.path.getsize(segment_path) >= self.segment_size
+        ):
+            segment += 1
+            segment_path = self._get_segment_path(segment)
+        self._segment_count = segment + 1
+        # write the data before indexing them, so an interrupted write leaves
+        # only unreferenced bytes behind
+        with open(segment_path, 'ab') as segment_file:
+            segment_file.seek(0, os.SEEK_END)
+            offset = segment_file.tell()
+            segment_file.write(data)
+        location = (segment, offset, len(data))
+        self._digests[digest] = location
+        self._add_to_index(item_id, location, digest)
+        return True
+
+    def _add_to_index(self, item_id, location, digest):
+        """
+        Point an id at a stored document.
+        @param item_id: The id of the document.
+        @param location: A tuple of (segment, offset, length).
+        @param digest: The SHA-1 hex digest of the document's contents.
+        """
+        with open(os.path.join(self.directory, INDEX_NAME), 'a') as csv_file:
+            csv.writer(csv_file).writerow([item_id] + list(location) + [digest])
+        self._index[str(item_id)] = location + (digest,)
+
+    def close(self):
+        """
+        Release any memory maps held by the archive. Buffers returned by get()
+            must not be used afterward.
+        """
+        for segment_map in self._maps.itervalues():
+            segment_map.close()
+        self._maps.clear()
+
+    def _get_segment_path(self, segment):
+        """
+        @param segment: The number of a segment.
+        @return: The path to the segment file.
+        """
+        return os.path.join(self.directory, SEGMENT_NAME_TEMPLATE % segment)
@@ -0,0 +1,281 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Benchmark modules. These helpers let the benchmarks run offline: a local HTTP
+server that imitates the kinds of sites mass_download() is used with, and
+generators for synthetic corpora modeled on the files in dredge/tests/files.
+"""
+
+import BaseHTTPServer
+import csv
+import os
+import SocketServer
+import threading
+import time
+import urlparse
+
+## template for synthetic xml documents, modeled on dredge/tests/files/*.xml
+XML_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<note id="{id}">
+  <from>Adam</from>
+  <to>Wadam</to>
+  <message>{message}</message>
+</note>
+'''
+## template for the index page of a synthetic multi-page html document
+HTML_INDEX_TEMPLATE = '''<html><body>
+<span class="geekpages">{links}</span>
+</body></html>
+'''
+## template for a single page of a synthetic multi-page html document
+HTML_PAGE_TEMPLATE = '''<html><body>
+<table>{rows}</table>
+</body></html>
+'''
+
+
+class _ThreadedHTTPServer(
+        SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer
+):
+    """
+    An HTTP server that handles each request in a new thread.
+    """
+    daemon_threads = True
+
+
+class _StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles requests to a StubServer.
+    """
+    def do_GET(self):
+        """
+        Respond to a GET request, imitating latency and rate limits.
+        """
+        stub = self.server.stub
+        if not stub.take_token():
+            self.send_error(429, 'Too Many Requests')
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/thing':
+            body = stub.get_xml_document(int(query['id']))
+            content_type = 'text/xml'
+        elif url.path == '/collection':
+            body = stub.get_html_document(
+                int(query['id']), int(query.get('page', 0))
+            )
+            content_type = 'text/html'
+        else:
+            self.send_error(404, 'Not Found')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Suppress request logging.
+        """
+        pass
+
+
+class StubServer(object):
+    """
+    A local HTTP server serving synthetic documents. Single-page xml documents
+        are served from /thing?id={id}. Multi-page html documents are served
+        from /collection?id={id}, whose index page lists links to each page
+        number in a span with the class geekpages, and /collection?id={id}&
+        page={page}. Items have id % max_pages + 1 pages.
+    """
+    def __init__(
+            self, latency=0.0, requests_per_second=None, max_pages=5,
+            message_length=100
+    ):
+        """
+        Initialize a new instance.
+        @param latency: Number of seconds to wait before each response.
+        @param requests_per_second: None if requests are not limited; otherwise,
+            the sustained rate above which requests receive a 429 response.
+        @param max_pages: The maximum number of pages of html documents.
+        @param message_length: Length of the message in each xml document.
+        """
+        self.latency = latency
+        self.requests_per_second = requests_per_second
+        self.max_pages = max_pages
+        self.message_length = message_length
+        self._tokens = requests_per_second or 0
+        self._last_token_time = time.time()
+        self._lock = threading.Lock()
+        self._server = _ThreadedHTTPServer(
+            ('127.0.0.1', 0), _StubRequestHandler
+        )
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        @return: The base url of the server, e.g., http://127.0.0.1:8000
+        """
+        return 'http://%s:%i' % self._server.server_address
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def take_token(self):
+        """
+        Take a token from the rate limiting bucket.
+        @return: True if the request may proceed; otherwise, False.
+        """
+        if self.requests_per_second is None:
+            return True
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.requests_per_second,
+                self._tokens +
+                (now - self._last_token_time) * self.requests_per_second
+            )
+            self._last_token_time = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def get_page_count(self, item_id):
+        """
+        @param item_id: The id of a multi-page item.
+        @return: The number of pages the item has.
+        """
+        return item_id % self.max_pages + 1
+
+    def get_xml_document(self, item_id):
+        """
+        @param item_id: The id of the item.
+        @return: An xml document for the item.
+        """
+        return get_xml_document(item_id, self.message_length)
+
+    def get_html_document(self, item_id, page):
+        """
+        @param item_id: The id of the item.
+        @param page: 0 for the index page; otherwise, the page number.
+        @return: An html page for the item.
+        """
+        if page == 0:
+            return HTML_INDEX_TEMPLATE.format(
+                links=''.join(
+                    '<a href="?id=%i&page=%i">%i</a>' % (item_id, p, p)
+                    for p in xrange(1, self.get_page_count(item_id) + 1)
+                )
+            )
+        return HTML_PAGE_TEMPLATE.format(
+            rows=''.join(
+                '<tr><td>%i</td><td>%i</td></tr>' % (item_id, page * 100 + r)
+                for r in xrange(100)
+            )
+        )
+
+
+def get_xml_document(item_id, message_length):
+    """
+    @param item_id: The id of the note.
+    @param message_length: Length of the note's message.
+    @return: A synthetic xml note like those in dredge/tests/files.
+    """
+    message = ('A longer message. ' * (message_length // 18 + 1))
+    return XML_TEMPLATE.format(id=item_id, message=message[:message_length])
+
+
+def generate_xml_corpus(directory, file_count, max_message_length=1000):
+    """
+    Write a synthetic corpus of xml notes to disk. Message lengths vary so that
+        files have different sizes for load balancing.
+    @param directory: Location where the files should be written.
+    @param file_count: The number of files to write.
+    @param max_message_length: The longest message to include in a note.
+    @return: A list of paths to the files.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    file_paths = list()
+    for i in xrange(file_count):
+        file_path = os.path.join(directory, '%i.xml' % i)
+        with open(file_path, 'w') as f:
+            f.write(get_xml_document(i, (i * 7919) % max_message_length + 1))
+        file_paths.append(file_path)
+    return file_paths
+
+
+def generate_csv_corpus(
+        directory, file_count, rows_per_file, headers=('Id', 'Value')
+):
+    """
+    Write a synthetic set of csv files to disk, like those produced by the
+        workers of do_multi_parse_to_csv(), modeled on
+        dredge/tests/files/merge-*.csv.
+    @param directory: Location where the files should be written.
+    @param file_count: The number of files to write.
+    @param rows_per_file: The number of rows in each file.
+    @param headers: Headers for the first row of each file, or None.
+    @return: A list of paths to the files.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    file_paths = list()
+    for i in xrange(file_count):
+        file_path = os.path.join(directory, 'merge-%04i.csv' % i)
+        with open(file_path, 'w') as f:
+            writer = csv.writer(f)
+            if headers is not None:
+                writer.writerow(headers)
+            first_id = i * rows_per_file
+            writer.writerows(
+                (first_id + r, (first_id + r) % 4 * 10)
+                for r in xrange(rows_per_file)
+            )
+        file_paths.append(file_path)
+    return file_paths
@@ -0,0 +1,441 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to benchmark dredge.downloader and dredge.multi offline. Run it with
+    python -m dredge.benchmarks.run --output results.json
+Each benchmark is run several times and the best time is reported, along with
+the parameters and environment, so that results are comparable across runs.
+"""
+
+import argparse
+import collections
+import json
+import lxml.etree
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import dredge.benchmarks
+import dredge.corpus
+import dredge.downloader
+import dredge.multi
+
+## a simple type corresponding to the data in the synthetic xml corpus
+Note = collections.namedtuple(
+    'Note', ['id', 'sender', 'recipient', 'message']
+)
+## modules whose import time is benchmarked
+IMPORT_BENCHMARK_MODULES = (
+    'dredge.compression', 'dredge.corpus', 'dredge.distributed',
+    'dredge.downloader', 'dredge.multi', 'dredge.pipeline'
+)
+## third party modules that are slow to import
+HEAVY_MODULES = ('bs4', 'lxml', 'lz4', 'scandir', 'zstandard')
+## script run in a fresh interpreter to time an import
+IMPORT_BENCHMARK_SCRIPT = '''
+import json, sys, time
+start_time = time.time()
+import %(module)s
+print json.dumps({
+    'seconds': time.time() - start_time,
+    'heavy_modules': [m for m in %(heavy_modules)r if m in sys.modules]
+})
+'''
+
+
+def parser_func(file_path):
+    """
+    Parse a note from the synthetic xml corpus.
+    @param file_path: Path to a file to parse.
+    @return: A Note.
+    """
+    with open(file_path) as f:
+        note = lxml.etree.fromstring(f.read())
+    return Note(
+        int(note.attrib['id']),
+        note.find('from').text,
+        note.find('to').text,
+        note.find('message').text
+    )
+
+
+def time_function(func, repeat):
+    """
+    Time several calls to a function.
+    @param func: A function taking no arguments.
+    @param repeat: The number of times to call the function.
+    @return: A dict with the best and mean times in seconds.
+    """
+    times = list()
+    for _ in xrange(repeat):
+        start_time = time.time()
+        func()
+        times.append(time.time() - start_time)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def benchmark_mass_download(temp_directory, item_count, latency, repeat):
+    """
+    Benchmark downloading single-page xml documents from a StubServer.
+    @param temp_directory: A writable scratch directory.
+    @param item_count: The number of items to download.
+    @param latency: Simulated server latency in seconds.
+    @param repeat: The number of times to run the benchmark.
+    @return: A dict of results.
+    """
+    output_directory = os.path.join(temp_directory, 'download')
+    with dredge.benchmarks.StubServer(latency=latency) as server:
+        def run():
+            if os.path.exists(output_directory):
+                shutil.rmtree(output_directory)
+            dredge.downloader.mass_download(
+                item_ids=range(item_count),
+                url_template=server.url + '/thing?id={id}',
+                url_format_expression=lambda item_id: {'id': item_id},
+                output_directory=output_directory,
+                download_burst_count=item_count + 1,
+                sleep_time=0
+            )
+        timing = time_function(run, repeat)
+    return {
+        'parameters': {'item_count': item_count, 'latency': latency},
+        'seconds': timing,
+        'items_per_second': item_count / timing['best']
+    }
+
+
+def benchmark_mass_download_multi_page(
+        temp_directory, item_count, latency, repeat, page_count_pattern=None
+):
+    """
+    Benchmark downloading multi-page html documents from a StubServer.
+    @param temp_directory: A writable scratch directory.
+    @param item_count: The number of items to download.
+    @param latency: Simulated server latency in seconds.
+    @param repeat: The number of times to run the benchmark.
+    @param page_count_pattern: None to find page counts with BeautifulSoup;
+        otherwise, a regular expression with which to find them.
+    @return: A dict of results.
+    """
+    output_directory = os.path.join(temp_directory, 'download-multi_page')
+    with dredge.benchmarks.StubServer(latency=latency) as server:
+        def run():
+            if os.path.exists(output_directory):
+                shutil.rmtree(output_directory)
+            dredge.downloader.mass_download(
+                item_ids=range(item_count),
+                url_template=server.url + '/collection?id={id}',
+                url_format_expression=lambda item_id: {'id': item_id},
+                output_directory=output_directory,
+                file_extension='html',
+                download_burst_count=item_count + 1,
+                sleep_time=0,
+                segment_url_template=(
+                    server.url + '/collection?id={id}&page={page}'
+                ),
+                segment_url_format_expression=lambda item_id, page: {
+                    'id': item_id, 'page': page
+                },
+                get_max_page_expression=lambda soup: max(
+                    int(a.text) for a in soup.find(
+                        'span', class_='geekpages'
+                    ).find_all('a')
+                ),
+                page_count_pattern=page_count_pattern
+            )
+        timing = time_function(run, repeat)
+        page_count = sum(server.get_page_count(i) for i in xrange(item_count))
+    return {
+        'parameters': {'item_count': item_count, 'latency': latency},
+        'seconds': timing,
+        'items_per_second': item_count / timing['best'],
+        'pages_per_second': page_count / timing['best']
+    }
+
+
+def benchmark_do_multi_parse_to_csv(file_paths, temp_directory, repeat):
+    """
+    Benchmark parsing the synthetic xml corpus into a csv.
+    @param file_paths: Paths to the files in the corpus.
+    @param temp_directory: A writable scratch directory.
+    @param repeat: The number of times to run the benchmark.
+    @return: A dict of results.
+    """
+    output_folder = os.path.join(temp_directory, 'parse')
+    timing = time_function(
+        lambda: dredge.multi.do_multi_parse_to_csv(
+            file_paths=file_paths,
+            output_folder=output_folder,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=0,
+            id_column=0
+        ),
+        repeat
+    )
+    return {
+        'parameters': {'file_count': len(file_paths)},
+        'seconds': timing,
+        'files_per_second': len(file_paths) / timing['best']
+    }
+
+
+def benchmark_merge_csv_files(
+        temp_directory, file_count, rows_per_file, id_column, repeat
+):
+    """
+    Benchmark merging a set of synthetic csv files.
+    @param temp_directory: A writable scratch directory.
+    @param file_count: The number of files to merge.
+    @param rows_per_file: The number of rows in each file.
+    @param id_column: None or the index of the primary key column.
+    @param repeat: The number of times to run the benchmark.
+    @return: A dict of results.
+    """
+    input_paths = dredge.benchmarks.generate_csv_corpus(
+        os.path.join(temp_directory, 'merge'), file_count, rows_per_file
+    )
+    timing = time_function(
+        lambda: dredge.multi.merge_csv_files(
+            input_paths=input_paths,
+            output_path=os.path.join(temp_directory, 'merged.csv'),
+            delimiter=',',
+            headers=('Id', 'Value'),
+            id_column=id_column
+        ),
+        repeat
+    )
+    return {
+        'parameters': {
+            'file_count': file_count,
+            'rows_per_file': rows_per_file,
+            'id_column': id_column
+        },
+        'seconds': timing,
+        'rows_per_second': file_count * rows_per_file / timing['best']
+    }
+
+
+def benchmark_sort_file_paths_for_load_balancing(
+        file_paths, repeat, corpus_index=None
+):
+    """
+    Benchmark sorting the synthetic xml corpus for load balancing.
+    @param file_paths: Paths to the files in the corpus.
+    @param repeat: The number of times to run the benchmark.
+    @param corpus_index: None if sizes should be read from disk; otherwise, a
+        dredge.corpus.CorpusIndex of the corpus from which to take sizes.
+    @return: A dict of results.
+    """
+    task_count = max(dredge.multi.CPU_COUNT, 1)
+    timing = time_function(
+        lambda: dredge.multi.sort_file_paths_for_load_balancing(
+            file_paths, task_count,
+            file_sizes=(
+                None if corpus_index is None
+                else corpus_index.get_file_sizes()
+            )
+        ),
+        repeat
+    )
+    return {
+        'parameters': {
+            'file_count': len(file_paths),
+            'task_count': task_count,
+            'corpus_index': corpus_index is not None
+        },
+        'seconds': timing,
+        'files_per_second': len(file_paths) / timing['best']
+    }
+
+
+def benchmark_corpus_index_scan(directory, repeat):
+    """
+    Benchmark indexing the synthetic xml corpus, from scratch and reusing a
+        previous index.
+    @param directory: The directory containing the corpus.
+    @param repeat: The number of times to run the benchmark.
+    @return: A dict of results.
+    """
+    index = dredge.corpus.CorpusIndex.scan(directory)
+    timing = time_function(
+        lambda: dredge.corpus.CorpusIndex.scan(directory), repeat
+    )
+    incremental_timing = time_function(
+        lambda: dredge.corpus.CorpusIndex.scan(directory, index), repeat
+    )
+    return {
+        'parameters': {
+            'file_count': len(index),
+            'scandir': dredge.corpus.scandir is not None
+        },
+        'seconds': timing,
+        'incremental_seconds': incremental_timing,
+        'files_per_second': len(index) / timing['best']
+    }
+
+
+def benchmark_import_time(repeat):
+    """
+    Benchmark importing each dredge module in a fresh interpreter, as a worker
+        started for a short job would, and note which heavy dependencies each
+        import loads.
+    @param repeat: The number of times to import each module.
+    @return: A dict of results for each module.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    results = dict()
+    for module_name in IMPORT_BENCHMARK_MODULES:
+        times = list()
+        for _ in xrange(repeat):
+            output = subprocess.check_output(
+                [
+                    sys.executable, '-c',
+                    IMPORT_BENCHMARK_SCRIPT % {
+                        'module': module_name,
+                        'heavy_modules': HEAVY_MODULES
+                    }
+                ],
+                env=environment
+            )
+            result = json.loads(output)
+            times.append(result['seconds'])
+        results[module_name] = {
+            'seconds': {'best': min(times), 'mean': sum(times) / len(times)},
+            'heavy_modules': result['heavy_modules']
+        }
+    return results
+
+
+def run_benchmarks(
+        file_count=1000, item_count=200, latency=0.0, merge_file_count=8,
+        rows_per_file=10000, repeat=3, temp_directory=None
+):
+    """
+    Run all benchmarks.
+    @param file_count: The number of files in the synthetic xml corpus.
+    @param item_count: The number of items to download.
+    @param latency: Simulated server latency in seconds.
+    @param merge_file_count: The number of csv files to merge.
+    @param rows_per_file: The number of rows in each csv file to merge.
+    @param repeat: The number of times to run each benchmark.
+    @param temp_directory: A writable scratch directory, or None to create one.
+    @return: A dict of results for each benchmark, along with details about the
+        environment.
+    """
+    is_temp_directory_owned = temp_directory is None
+    if is_temp_directory_owned:
+        temp_directory = tempfile.mkdtemp(prefix='dredge-benchmarks-')
+    try:
+        corpus_directory = os.path.join(temp_directory, 'corpus')
+        file_paths = dredge.benchmarks.generate_xml_corpus(
+            corpus_directory, file_count
+        )
+        results = {
+            'environment': {
+                'python': sys.version,
+                'platform': platform.platform(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'time': time.time()
+            },
+            'benchmarks': {
+                'mass_download': benchmark_mass_download(
+                    temp_directory, item_count, latency, repeat
+                ),
+                'mass_download_multi_page': benchmark_mass_download_multi_page(
+                    temp_directory, item_count, latency, repeat
+                ),
+                'mass_download_multi_page_pattern':
+                    benchmark_mass_download_multi_page(
+                        temp_directory, item_count, latency, repeat,
+                        r'page=(\d+)'
+                    ),
+                'do_multi_parse_to_csv': benchmark_do_multi_parse_to_csv(
+                    file_paths, temp_directory, repeat
+                ),
+                'merge_csv_files': benchmark_merge_csv_files(
+                    temp_directory, merge_file_count, rows_per_file, None,
+                    repeat
+                ),
+                'merge_csv_files_unique_ids': benchmark_merge_csv_files(
+                    temp_directory, merge_file_count, rows_per_file, 0, repeat
+                ),
+                'sort_file_paths_for_load_balancing':
+                    benchmark_sort_file_paths_for_load_balancing(
+                        file_paths, repeat
+                    ),
+                'sort_file_paths_for_load_balancing_corpus_index':
+                    benchmark_sort_file_paths_for_load_balancing(
+                        file_paths, repeat,
+                        dredge.corpus.CorpusIndex.scan(corpus_directory)
+                    ),
+                'corpus_index_scan': benchmark_corpus_index_scan(
+                    corpus_directory, repeat
+                ),
+                'import_time': benchmark_import_time(repeat)
+            }
+        }
+    finally:
+        if is_temp_directory_owned:
+            shutil.rmtree(temp_directory)
+    return results
+
+
+def main(args=None):
+    """
+    Run the benchmarks from the command line and write the results as JSON.
+    @param args: Command line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[-1])
+    parser.add_argument('--file-count', type=int, default=1000)
+    parser.add_argument('--item-count', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--merge-file-count', type=int, default=8)
+    parser.add_argument('--rows-per-file', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--temp-directory', default=None)
+    parser.add_argument('--output', default=None)
+    options = parser.parse_args(args)
+    results = run_benchmarks(
+        file_count=options.file_count,
+        item_count=options.item_count,
+        latency=options.latency,
+        merge_file_count=options.merge_file_count,
+        rows_per_file=options.rows_per_file,
+        repeat=options.repeat,
+        temp_directory=options.temp_directory
+    )
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output is None:
+        print output
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains an on-disk cache of parser output. Entries are keyed by a
+parser version tag and either a hash of a file's contents or its size and
+modification time, so repeated parse jobs over a largely unchanged corpus can
+replay cached rows instead of parsing each file again.
+"""
+
+import collections
+import cPickle
+import hashlib
+import os
+import uuid
+import zlib
+
+## the default maximum total size of a cache in bytes
+DEFAULT_MAX_SIZE = 1024 ** 3
+## fraction of max_size each process may write between evictions
+EVICTION_INTERVAL = 0.1
+## size of the chunks in which files are read for hashing
+_HASH_CHUNK_SIZE = 1024 * 1024
+## namedtuple types rebuilt from cached field names, keyed by field names
+_row_types = dict()
+
+
+class ParseCache(object):
+    """
+    A directory of compressed, pickled parser output. Each entry holds the
+        field names and values of the namedtuple rows produced for one file.
+        Reading an entry marks it as recently used, and evict() deletes the
+        least recently used entries once the cache grows beyond max_size.
+        Entries are evicted whenever a process has written a tenth of max_size
+        since its last eviction, so during a job each process can only take
+        the cache that much beyond its limit.
+    """
+    def __init__(
+            self, directory, version, max_size=DEFAULT_MAX_SIZE,
+            use_content_hash=True
+    ):
+        """
+        Open a cache, creating its directory if it does not already exist.
+        @param directory: Directory containing the cache.
+        @param version: A tag identifying the parser, which should be changed
+            whenever the parser's output changes, e.g., 'notes-1.2'.
+        @param max_size: Maximum total size of the cache in bytes.
+        @param use_content_hash: True if files should be identified by a hash of
+            their contents; otherwise, False to use their size and modification
+            time, which is faster but trusts the file system's timestamps.
+        """
+        self.directory = os.path.abspath(directory)
+        self.version = str(version)
+        self.max_size = max_size
+        self.use_content_hash = use_content_hash
+        self._unevicted_size = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get_file_key(self, file_path):
+        """
+        @param file_path: Path to a file on disk.
+        @return: The cache key for the file's parser output.
+        """
+        key = hashlib.sha1(self.version + '\0')
+        if self.use_content_hash:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), ''):
+                    key.update(chunk)
+        else:
+            stat = os.stat(file_path)
+            key.update('%i:%r' % (stat.st_size, stat.st_mtime))
+        return key.hexdigest()
+
+    def get_document_key(self, document):
+        """
+        @param document: A document as a string or buffer.
+        @return: The cache key for the document's parser output.
+        """
+        key = hashlib.sha1(self.version + '\0')
+        key.update(document)
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Get the rows cached for a key and mark them as recently used.
+        @param key: A key from get_file_key() or get_document_key().
+        @return: A list of namedtuple objects, or None if there is no entry or
+            it is corrupt, in which case it is deleted.
+        """
+        entry_path = self._get_entry_path(key)
+        try:
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+            os.utime(entry_path, None)
+        except (IOError, OSError):
+            return None
+        try:
+            fields, rows = cPickle.loads(zlib.decompress(data))
+        except (
+            zlib.error, EOFError, cPickle.UnpicklingError, ValueError,
+            TypeError
+        ):
+            # a corrupt entry is a miss, and is replaced when put() is called
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            return None
+        if not rows:
+            return list()
+        row_type = _row_types.get(fields)
+        if row_type is None:
+            row_type = _row_types[fields] = collections.namedtuple(
+                'CachedRow', fields, rename=True
+            )
+        return [row_type._make(row) for row in rows]
+
+    def put(self, key, entry):
+        """
+        Store parser output.
+        @param key: A key from get_file_key() or get_document_key().
+        @param entry: A namedtuple object or a collection of such objects.
+        """
+        rows = (entry,) if hasattr(entry, '_fields') else entry
+        fields = tuple(rows[0]._fields) if rows else None
+        data = zlib.compress(
+            cPickle.dumps((fields, [tuple(row) for row in rows]), 2)
+        )
+        entry_path = self._get_entry_path(key)
+        entry_directory = os.path.dirname(entry_path)
+        if not os.path.exists(entry_directory):
+            try:
+                os.makedirs(entry_directory)
+            except OSError:
+                # another process created it first
+                pass
+        # write to a temporary file first so readers never see partial entries
+        temp_path = '%s.%s.tmp' % (entry_path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, entry_path)
+        self._unevicted_size += len(data)
+        if self._unevicted_size > self.max_size * EVICTION_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache is no larger
+            than max_size.
+        """
+        self._unevicted_size = 0
+        entries = list()
+        total_size = 0
+        for directory, directory_names, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                # skip entries other processes are still writing
+                if not file_name.endswith('.bin'):
+                    continue
+                entry_path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    # another process evicted it first
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def _get_entry_path(self, key):
+        """
+        @param key: A cache key.
+        @return: The path to the file for the key's entry.
+        """
+        return os.path.join(self.directory, key[:2], key + '.bin')
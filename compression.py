@@ -0,0 +1,201 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+
+This module contains helpers for reading and writing compressed files. The
+codec is chosen by file extension: .gz for gzip, .zst for zstd and .lz4 for lz4.
+gzip is always available, while zstd and lz4 require the optional zstandard and
+lz4 packages, which are only imported when a file using them is opened. Every
+codec writes self-contained members or frames, so a file may be appended to,
+and compressed files may be concatenated without being decompressed.
+"""
+
+import gzip
+import importlib
+import io
+
+## file extensions for each codec
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+## modules required by each optional codec
+CODEC_MODULES = {'zstd': 'zstandard', 'lz4': 'lz4.frame'}
+## size of the chunks in which files are copied
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def get_codec(path):
+    """
+    @param path: Path to a file.
+    @return: The name of the codec indicated by the path's extension, or None
+        if the file is not compressed.
+    """
+    for codec, extension in CODEC_EXTENSIONS.iteritems():
+        if path.endswith(extension):
+            return codec
+    return None
+
+
+def get_extension(codec):
+    """
+    @param codec: The name of a codec, or None for no compression.
+    @return: The file extension for the codec, or an empty string.
+    """
+    if codec is None:
+        return ''
+    try:
+        return CODEC_EXTENSIONS[codec]
+    except KeyError:
+        raise ValueError(
+            'Unknown codec %r; expected one of %s' % (
+                codec, ', '.join(sorted(CODEC_EXTENSIONS))
+            )
+        )
+
+
+def is_codec_available(codec):
+    """
+    @param codec: The name of a codec.
+    @return: True if the packages the codec requires are installed; otherwise,
+        False.
+    """
+    try:
+        _import_codec(codec)
+    except ImportError:
+        return False
+    return True
+
+
+def open_file(path, mode='rb'):
+    """
+    Open a file, compressing or decompressing it according to its extension.
+    @param path: Path to the file.
+    @param mode: 'rb' to read, 'wb' to write or 'ab' to append.
+    @return: A file-like object that may be iterated by line when reading.
+    """
+    codec = get_codec(path)
+    if codec is None:
+        return open(path, mode)
+    if codec == 'gzip':
+        return gzip.open(path, mode)
+    if codec == 'lz4':
+        return _import_codec(codec).open(path, mode)
+    return _ZstdFile(path, mode)
+
+
+def copy_contents(input_file, output_file, last_character=None):
+    """
+    Copy the remaining contents of one file to another in chunks.
+    @param input_file: A file-like object to read from.
+    @param output_file: A file-like object to write to.
+    @param last_character: The last character already written to output_file,
+        or None if nothing has been written.
+    @return: The last character written to output_file, so that callers can
+        terminate an unterminated final line before copying more.
+    """
+    while True:
+        chunk = input_file.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return last_character
+        output_file.write(chunk)
+        last_character = chunk[-1]
+
+
+class _ZstdFile(object):
+    """
+    A minimal file-like object for reading or writing zstd files. Each time a
+        file is opened for writing, a new frame is started, which is completed
+        when the file is closed.
+    """
+    def __init__(self, path, mode):
+        """
+        Initialize a new instance.
+        @param path: Path to the file.
+        @param mode: 'rb' to read, 'wb' to write or 'ab' to append.
+        """
+        zstandard = _import_codec('zstd')
+        self._file = open(path, mode)
+        if 'r' in mode:
+            self._stream = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(
+                    self._file, read_across_frames=True
+                )
+            )
+        else:
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def read(self, size=-1):
+        """
+        @param size: The number of bytes to read, or -1 to read everything.
+        @return: Decompressed data.
+        """
+        return self._stream.read(size)
+
+    def readline(self):
+        """
+        @return: The next line of decompressed data.
+        """
+        return self._stream.readline()
+
+    def write(self, data):
+        """
+        @param data: Data to compress.
+        """
+        self._stream.write(data)
+
+    def close(self):
+        """
+        Complete the current frame if writing, and close the file.
+        """
+        if self._file.closed:
+            return
+        if 'r' not in self._file.mode:
+            self._stream.flush(_import_codec('zstd').FLUSH_FRAME)
+        self._file.close()
+
+
+def _import_codec(codec):
+    """
+    Import the module an optional codec requires.
+    @param codec: The name of the codec.
+    @return: The module, or None if the codec requires no optional package.
+    @raise ImportError: If the package providing the module is not installed.
+    """
+    module_name = CODEC_MODULES.get(codec)
+    if module_name is None:
+        return None
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImportError(
+            'The %s package is required to read or write %s files' % (
+                module_name.split('.')[0], codec
+            )
+        )
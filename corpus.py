@@ -0,0 +1,173 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+
+This module contains an index of the files in a corpus directory. The names,
+sizes and modification times of the files are gathered in a single pass over
+the directory, using the optional scandir package where it is installed, and
+the index may be saved and loaded again so that later runs only look at files
+that have appeared since. The downloader uses an index to decide which items to
+skip when resuming, and the parse load balancer uses it for file sizes.
+"""
+
+import csv
+import os
+import uuid
+try:
+    import scandir
+except ImportError:
+    scandir = None
+import dredge.compression
+
+## headers for a saved index
+INDEX_HEADERS = ['name', 'size', 'mtime']
+
+
+class CorpusIndex(object):
+    """
+    The names, sizes and modification times of the files in a directory.
+    """
+    def __init__(self, directory, entries=None):
+        """
+        Initialize a new instance. Use scan() or load() to fill the index.
+        @param directory: The directory the index describes.
+        @param entries: A dict mapping file names to (size, mtime) tuples.
+        """
+        self.directory = directory
+        self.entries = dict(entries or {})
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def scan(cls, directory, previous=None):
+        """
+        Index the files in a directory. Subdirectories are not included.
+        @param directory: The directory to index.
+        @param previous: None if every file should be examined; otherwise, an
+            earlier CorpusIndex of the directory, whose entries are reused for
+            files that are still present rather than examined again. This
+            assumes files are not modified once written, as is the case for
+            downloaded documents.
+        @return: A new CorpusIndex.
+        """
+        reused_entries = previous.entries if previous is not None else {}
+        entries = dict()
+        if scandir is not None:
+            for entry in scandir.scandir(directory):
+                if entry.name in reused_entries:
+                    entries[entry.name] = reused_entries[entry.name]
+                elif entry.is_file():
+                    stat = entry.stat()
+                    entries[entry.name] = (stat.st_size, stat.st_mtime)
+        else:
+            for name in os.listdir(directory):
+                if name in reused_entries:
+                    entries[name] = reused_entries[name]
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if not os.path.isdir(path):
+                    entries[name] = (stat.st_size, stat.st_mtime)
+        return cls(directory, entries)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save().
+        @param path: Path to the saved index.
+        @return: A new CorpusIndex.
+        """
+        with dredge.compression.open_file(path) as csv_file:
+            reader = csv.reader(csv_file)
+            directory = reader.next()[0]
+            reader.next()
+            return cls(
+                directory,
+                (
+                    (name, (int(size), float(mtime)))
+                    for name, size, mtime in reader
+                )
+            )
+
+    def save(self, path):
+        """
+        Save the index to a csv file, compressed if the path ends with .gz, .zst
+            or .lz4. The first row holds the directory and the second the
+            headers. The file is replaced atomically.
+        @param path: Path to the saved index.
+        """
+        temp_path = '%s.%s%s' % (
+            path, uuid.uuid4().hex,
+            dredge.compression.get_extension(
+                dredge.compression.get_codec(path)
+            )
+        )
+        with dredge.compression.open_file(temp_path, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow([self.directory])
+            writer.writerow(INDEX_HEADERS)
+            writer.writerows(
+                (name, size, repr(mtime))
+                for name, (size, mtime) in sorted(self.entries.iteritems())
+            )
+        os.rename(temp_path, path)
+
+    def add(self, name, size, mtime):
+        """
+        Record a file that has been written since the directory was scanned.
+        @param name: The name of the file.
+        @param size: The size of the file in bytes.
+        @param mtime: The modification time of the file.
+        """
+        self.entries[name] = (size, mtime)
+
+    def names(self):
+        """
+        @return: A list of the names of the files in the index.
+        """
+        return self.entries.keys()
+
+    def get_paths(self):
+        """
+        @return: A list of the paths to the files in the index, joined to the
+            directory as it was given.
+        """
+        return [os.path.join(self.directory, name) for name in self.entries]
+
+    def get_file_sizes(self):
+        """
+        @return: A dict mapping the path to each file, as returned by
+            get_paths(), to its size, e.g., for
+            dredge.multi.sort_file_paths_for_load_balancing().
+        """
+        return dict(
+            (os.path.join(self.directory, name), size)
+            for name, (size, mtime) in self.entries.iteritems()
+        )
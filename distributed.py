@@ -0,0 +1,667 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains utilities for running parse jobs and crawls across many
+processes on any number of hosts that share a work directory, e.g., over NFS.
+The file paths or item ids are divided into chunks when the job is prepared.
+Each worker claims a chunk by creating a lease file, keeps the lease alive
+while it works, and marks the chunk done when its output is in place. Leases
+that have not been renewed within the lease duration are assumed to belong to
+dead workers and may be taken over. The final merge of a parse job is performed
+once, by whichever worker finishes last. Workers in a crawl share one request
+rate budget, error log and manifest.
+"""
+
+import csv
+import errno
+import json
+import multiprocessing
+import os
+import Queue
+import socket
+import threading
+import time
+import uuid
+import dredge.downloader
+import dredge.multi
+
+## name of the file describing a distributed job
+JOB_FILE_NAME = 'job.json'
+## the default number of file paths in each chunk
+DEFAULT_CHUNK_SIZE = 1000
+## the default number of seconds after which an unrenewed lease expires
+DEFAULT_LEASE_DURATION = 300
+## the default number of seconds to wait before checking for expired leases
+DEFAULT_POLL_INTERVAL = 10
+## name given to the lease for the final merge
+_MERGE_LEASE_NAME = 'merge'
+
+
+def prepare_distributed_parse(
+        file_paths, work_directory, output_folder, task_name,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        delimiter=',',
+        id_column=None,
+        include_headers=True,
+        file_timeout=None
+):
+    """
+    Divide a parse job into chunks in a shared work directory. This should be
+        called once before starting any workers.
+    @param file_paths: A collection of file paths containing the data. They
+        must be readable at the same paths on every host.
+    @param work_directory: A directory shared by all hosts, where chunks, leases
+        and intermediate output are kept.
+    @param output_folder: Location where the results should be written.
+    @param task_name: The name to give to the csv output.
+    @param chunk_size: The number of file paths in each chunk.
+    @param delimiter: Delimiter to use in csv output.
+    @param id_column: None if the data contain no primary key; otherwise, the
+        index of the primary key in the namedtuple type produced by the parser.
+    @param include_headers: True if the final output should include headers;
+        otherwise, False.
+    @param file_timeout: None if parsing a file may take any amount of time;
+        otherwise, the number of seconds after which a file is abandoned and
+        logged to the error log.
+    @return: The number of chunks.
+    """
+    for folder in ('chunks', 'leases', 'done', 'output', 'temp'):
+        path = os.path.join(work_directory, folder)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    file_paths = list(file_paths)
+    chunk_count = 0
+    for chunk_start in xrange(0, len(file_paths), chunk_size):
+        chunk_file_paths = file_paths[chunk_start:chunk_start + chunk_size]
+        with open(_get_chunk_path(work_directory, chunk_count), 'w') as f:
+            csv.writer(f).writerows(
+                [file_path] for file_path in chunk_file_paths
+            )
+        chunk_count += 1
+    job = {
+        'chunk_count': chunk_count,
+        'output_folder': os.path.abspath(output_folder),
+        'task_name': task_name,
+        'delimiter': delimiter,
+        'id_column': id_column,
+        'include_headers': include_headers,
+        'file_timeout': file_timeout
+    }
+    _write_atomically(
+        os.path.join(work_directory, JOB_FILE_NAME), json.dumps(job)
+    )
+    return chunk_count
+
+
+def run_distributed_parse_worker(
+        work_directory, parser_func,
+        lease_duration=DEFAULT_LEASE_DURATION,
+        poll_interval=DEFAULT_POLL_INTERVAL
+):
+    """
+    Claim and parse chunks of a prepared job until every chunk is done, then
+        perform the final merge if no other worker has. Any number of workers
+        may run at once on any host.
+    @param work_directory: The work directory of a job prepared with
+        prepare_distributed_parse().
+    @param parser_func: A function with the signature func(path_to_file) that
+        returns a namedtuple object containing a primary key, id, or a
+        collection of such objects.
+    @param lease_duration: Number of seconds after which a lease that has not
+        been renewed is considered abandoned. Leases are renewed in the
+        background while a chunk is parsed.
+    @param poll_interval: Number of seconds to wait before checking again for
+        abandoned chunks while other workers hold leases on the rest.
+    @return: True if this worker performed the final merge; otherwise, False.
+    """
+    job = _load_job(work_directory)
+    _process_chunks(
+        work_directory, job['chunk_count'],
+        lambda chunk: _parse_chunk(work_directory, job, chunk, parser_func),
+        lease_duration, poll_interval
+    )
+    return _finalize(work_directory, job, lease_duration)
+
+
+def run_distributed_parse_workers(
+        work_directory, parser_func, cores_to_reserve=1, **kwargs
+):
+    """
+    Run a distributed parse worker on each available core of this host.
+    @param work_directory: The work directory of a job prepared with
+        prepare_distributed_parse().
+    @param parser_func: A function with the signature func(path_to_file) that
+        returns a namedtuple object containing a primary key, id, or a
+        collection of such objects.
+    @param cores_to_reserve: The number of cores to leave idle.
+    @param kwargs: Any additional keyword arguments for
+        run_distributed_parse_worker().
+    """
+    workers = [
+        multiprocessing.Process(
+            target=run_distributed_parse_worker,
+            args=(work_directory, parser_func),
+            kwargs=kwargs
+        ) for _ in xrange(max(dredge.multi.CPU_COUNT - cores_to_reserve, 1))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def prepare_distributed_download(
+        item_ids, work_directory,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        requests_per_second=1.0,
+        burst=1
+):
+    """
+    Divide a crawl into chunks of ids in a shared work directory. This should
+        be called once before starting any workers. The workers share one
+        request-rate budget, an error log, errors.csv, and a manifest of
+        downloaded items, manifest.csv, all kept in the work directory.
+    @param item_ids: Collection of ids specifying what is to be downloaded. The
+        ids must be serializable as json, e.g., numbers or strings.
+    @param work_directory: A directory shared by all hosts, where chunks,
+        leases, logs and the state of the rate limiter are kept.
+    @param chunk_size: The number of ids in each chunk.
+    @param requests_per_second: The sustained rate of requests permitted across
+        all workers.
+    @param burst: The number of requests that may be made in succession after
+        the workers have been idle.
+    @return: The number of chunks.
+    """
+    for folder in ('chunks', 'leases', 'done'):
+        path = os.path.join(work_directory, folder)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    item_ids = list(item_ids)
+    chunk_count = 0
+    for chunk_start in xrange(0, len(item_ids), chunk_size):
+        _write_atomically(
+            _get_chunk_path(work_directory, chunk_count, 'json'),
+            json.dumps(item_ids[chunk_start:chunk_start + chunk_size])
+        )
+        chunk_count += 1
+    job = {
+        'chunk_count': chunk_count,
+        'requests_per_second': requests_per_second,
+        'burst': burst
+    }
+    _write_atomically(
+        os.path.join(work_directory, JOB_FILE_NAME), json.dumps(job)
+    )
+    return chunk_count
+
+
+def run_distributed_download_worker(
+        work_directory, url_template, url_format_expression, output_directory,
+        lease_duration=DEFAULT_LEASE_DURATION,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        **kwargs
+):
+    """
+    Claim and download chunks of a prepared crawl until every chunk is done.
+        Any number of workers may run at once on any host. Requests from all
+        workers are paced by one shared rate limiter rather than in bursts.
+    @param work_directory: The work directory of a crawl prepared with
+        prepare_distributed_download().
+    @param url_template: URL template with formatting entries. E.g.,
+        http://boardgamegeek.com/xmlapi2/collection?user={name}
+    @param url_format_expression: Lambda expression to generate url template
+        kwargs from an id. Ids are read back from json, so strings are unicode.
+    @param output_directory: Directory where data should be stored. Workers
+        may use the same directory or one of their own, since items in the
+        shared manifest are skipped regardless of where they were saved.
+    @param lease_duration: Number of seconds after which a lease that has not
+        been renewed is considered abandoned.
+    @param poll_interval: Number of seconds to wait before checking again for
+        abandoned chunks while other workers hold leases on the rest.
+    @param kwargs: Any additional keyword arguments for
+        dredge.downloader.mass_download(). An archive may not be shared
+        between processes, so each worker must be given its own.
+    """
+    job = _load_job(work_directory)
+    rate_limiter = dredge.downloader.SharedRateLimiter(
+        os.path.join(work_directory, 'rate-limiter'),
+        job['requests_per_second'],
+        job['burst']
+    )
+    error_log_path = os.path.join(work_directory, 'errors.csv')
+    manifest_path = os.path.join(work_directory, 'manifest.csv')
+    # find finished items once rather than for each chunk; chunks are disjoint,
+    # so items finished by other workers later are not needed
+    skip_item_ids = dredge.downloader.find_downloaded_item_ids(
+        output_directory,
+        file_extension=kwargs.get('file_extension', 'xml'),
+        archive=kwargs.get('archive'),
+        corpus_index=kwargs.get('corpus_index'),
+        error_log_path=error_log_path,
+        manifest_path=manifest_path
+    )
+
+    def download_chunk(chunk):
+        with open(_get_chunk_path(work_directory, chunk, 'json')) as f:
+            item_ids = [
+                str(item_id) if isinstance(item_id, unicode) else item_id
+                for item_id in json.load(f)
+            ]
+        dredge.downloader.mass_download(
+            item_ids, url_template, url_format_expression, output_directory,
+            rate_limiter=rate_limiter,
+            error_log_path=error_log_path,
+            manifest_path=manifest_path,
+            skip_item_ids=skip_item_ids,
+            **kwargs
+        )
+        _write_atomically(
+            _get_done_path(work_directory, chunk), socket.gethostname()
+        )
+
+    _process_chunks(
+        work_directory, job['chunk_count'], download_chunk,
+        lease_duration, poll_interval
+    )
+
+
+def run_distributed_download_workers(
+        work_directory, process_count, *args, **kwargs
+):
+    """
+    Run several distributed download workers on this host.
+    @param work_directory: The work directory of a crawl prepared with
+        prepare_distributed_download().
+    @param process_count: The number of workers to run.
+    @param args: The remaining positional arguments for
+        run_distributed_download_worker().
+    @param kwargs: Any additional keyword arguments for
+        run_distributed_download_worker().
+    """
+    workers = [
+        multiprocessing.Process(
+            target=run_distributed_download_worker,
+            args=(work_directory,) + args,
+            kwargs=kwargs
+        ) for _ in xrange(process_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _process_chunks(
+        work_directory, chunk_count, process_chunk, lease_duration,
+        poll_interval
+):
+    """
+    Claim and process chunks until every chunk is done.
+    @param work_directory: The work directory of the job.
+    @param chunk_count: The number of chunks in the job.
+    @param process_chunk: A function with the signature func(chunk) that
+        processes a claimed chunk and marks it done.
+    @param lease_duration: Number of seconds after which a lease that has not
+        been renewed is considered abandoned.
+    @param poll_interval: Number of seconds to wait before checking again for
+        abandoned chunks while other workers hold leases on the rest.
+    """
+    while True:
+        pending_chunks = [
+            chunk for chunk in xrange(chunk_count)
+            if not os.path.exists(_get_done_path(work_directory, chunk))
+        ]
+        if not pending_chunks:
+            break
+        claimed_chunk = None
+        for chunk in pending_chunks:
+            token = _claim_lease(work_directory, chunk, lease_duration)
+            if token is not None:
+                claimed_chunk = chunk
+                break
+        if claimed_chunk is None:
+            time.sleep(poll_interval)
+            continue
+        renewer = _LeaseRenewer(
+            _get_lease_path(work_directory, claimed_chunk),
+            lease_duration / 3.0, token
+        )
+        renewer.start()
+        try:
+            process_chunk(claimed_chunk)
+        finally:
+            renewer.stop()
+            _release_lease(work_directory, claimed_chunk, token)
+
+
+def _parse_chunk(work_directory, job, chunk, parser_func):
+    """
+    Parse the files in a chunk and move the output into place.
+    @param work_directory: The work directory of the job.
+    @param job: The job description.
+    @param chunk: The number of the chunk.
+    @param parser_func: The parser function.
+    """
+    with open(_get_chunk_path(work_directory, chunk)) as f:
+        file_paths = [row[0] for row in csv.reader(f)]
+    # parse into a private folder so a worker whose lease was taken over
+    # cannot interfere with the output of the worker that took it
+    temp_folder = os.path.join(work_directory, 'temp', uuid.uuid4().hex)
+    os.makedirs(temp_folder)
+    dredge.multi._dump_into_csv_task(
+        file_paths, 0, len(file_paths), Queue.Queue(),
+        output_folder=temp_folder,
+        task_name='chunk',
+        csv_headers=None,
+        delimiter=job['delimiter'],
+        parser_func=parser_func,
+        file_timeout=job['file_timeout'],
+        _task_index=chunk
+    )
+    if job['include_headers']:
+        _record_headers(work_directory, file_paths, parser_func)
+    for suffix in ('', '-errors'):
+        os.rename(
+            os.path.join(temp_folder, 'chunk-%i%s.csv' % (chunk, suffix)),
+            _get_output_path(work_directory, chunk, suffix)
+        )
+    os.rmdir(temp_folder)
+    _write_atomically(
+        _get_done_path(work_directory, chunk), socket.gethostname()
+    )
+
+
+def _record_headers(work_directory, file_paths, parser_func):
+    """
+    Save the csv headers for the job if no worker has already.
+    @param work_directory: The work directory of the job.
+    @param file_paths: Paths to files that may be parsed to find the headers.
+    @param parser_func: The parser function.
+    """
+    headers_path = os.path.join(work_directory, 'headers.csv')
+    if os.path.exists(headers_path):
+        return
+    for file_path in file_paths:
+        try:
+            entry = parser_func(file_path)
+        except Exception:
+            continue
+        if entry:
+            fields = entry._fields if hasattr(entry, '_fields') else (
+                entry[0]._fields
+            )
+            temp_path = '%s.%s' % (headers_path, uuid.uuid4().hex)
+            with open(temp_path, 'w') as f:
+                csv.writer(f).writerow(fields)
+            os.rename(temp_path, headers_path)
+            return
+
+
+def _finalize(work_directory, job, lease_duration):
+    """
+    Merge the output of all chunks, unless another worker already has.
+    @param work_directory: The work directory of the job.
+    @param job: The job description.
+    @param lease_duration: Number of seconds after which the merge lease is
+        considered abandoned.
+    @return: True if this call performed the merge; otherwise, False.
+    """
+    merged_path = _get_done_path(work_directory, _MERGE_LEASE_NAME)
+    if os.path.exists(merged_path):
+        return False
+    token = _claim_lease(work_directory, _MERGE_LEASE_NAME, lease_duration)
+    if token is None:
+        return False
+    renewer = _LeaseRenewer(
+        _get_lease_path(work_directory, _MERGE_LEASE_NAME),
+        lease_duration / 3.0, token
+    )
+    renewer.start()
+    try:
+        # the merge may have finished between checking and claiming the lease
+        if os.path.exists(merged_path):
+            return False
+        output_folder = job['output_folder']
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        chunks = xrange(job['chunk_count'])
+        output_path = os.path.join(output_folder, '%s.csv' % job['task_name'])
+        headers_path = os.path.join(work_directory, 'headers.csv')
+        input_paths = [_get_output_path(work_directory, c, '') for c in chunks]
+        if job['include_headers'] and os.path.exists(headers_path):
+            input_paths.insert(0, headers_path)
+        dredge.multi.merge_csv_files(
+            input_paths=input_paths,
+            output_path=output_path,
+            delimiter=job['delimiter'],
+            id_column=job['id_column']
+        )
+        dredge.multi.merge_csv_files(
+            input_paths=[
+                _get_output_path(work_directory, c, '-errors') for c in chunks
+            ],
+            output_path=os.path.join(
+                output_folder, '%s-errors.csv' % job['task_name']
+            ),
+            delimiter=',',
+            headers=dredge.multi.ERROR_LOG_HEADERS
+        )
+        _write_atomically(merged_path, socket.gethostname())
+        return True
+    finally:
+        renewer.stop()
+        _release_lease(work_directory, _MERGE_LEASE_NAME, token)
+
+
+class _LeaseRenewer(threading.Thread):
+    """
+    A background thread that keeps a lease alive by updating its modification
+        time. Renewal stops if another worker takes over the lease.
+    """
+    def __init__(self, lease_path, interval, token):
+        """
+        Initialize a new instance.
+        @param lease_path: Path to the lease file.
+        @param interval: Number of seconds between renewals.
+        @param token: The token returned by _claim_lease() for the lease.
+        """
+        super(_LeaseRenewer, self).__init__()
+        self.daemon = True
+        self.lease_path = lease_path
+        self.interval = interval
+        self.token = token
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+        Renew the lease until stopped or until it belongs to another worker.
+        """
+        while not self._stopped.wait(self.interval):
+            if _read_lease_token(self.lease_path) != self.token:
+                return
+            try:
+                os.utime(self.lease_path, None)
+            except OSError:
+                pass
+
+    def stop(self):
+        """
+        Stop renewing the lease.
+        """
+        self._stopped.set()
+        self.join()
+
+
+def _claim_lease(work_directory, name, lease_duration):
+    """
+    Try to take the lease on a chunk, taking over abandoned leases.
+    @param work_directory: The work directory of the job.
+    @param name: The number of a chunk, or the name of another lease.
+    @param lease_duration: Number of seconds after which a lease that has not
+        been renewed is considered abandoned.
+    @return: A token unique to this claim, which is written in the lease file,
+        if the lease was claimed; otherwise, None.
+    """
+    lease_path = _get_lease_path(work_directory, name)
+    try:
+        file_descriptor = os.open(
+            lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY
+        )
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        abandoned_token = _read_lease_token(lease_path)
+        try:
+            is_expired = _is_lease_expired(lease_path, lease_duration)
+        except OSError:
+            # the lease was released in the meantime
+            return _claim_lease(work_directory, name, lease_duration)
+        if not is_expired:
+            return None
+        # only one worker can succeed in moving an abandoned lease aside
+        abandoned_path = '%s.%s' % (lease_path, uuid.uuid4().hex)
+        try:
+            os.rename(lease_path, abandoned_path)
+        except OSError:
+            return None
+        # another worker may have taken the lease over since it was checked,
+        # in which case its new lease was moved and must be put back
+        if (
+            _read_lease_token(abandoned_path) != abandoned_token or
+            not _is_lease_expired(abandoned_path, lease_duration)
+        ):
+            try:
+                os.link(abandoned_path, lease_path)
+            except OSError:
+                pass
+            os.remove(abandoned_path)
+            return None
+        os.remove(abandoned_path)
+        return _claim_lease(work_directory, name, lease_duration)
+    token = '%s %i %s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    os.write(file_descriptor, token + '\n')
+    os.close(file_descriptor)
+    return token
+
+
+def _is_lease_expired(lease_path, lease_duration):
+    """
+    @param lease_path: Path to a lease file.
+    @param lease_duration: Number of seconds after which a lease that has not
+        been renewed is considered abandoned.
+    @return: True if the lease has not been renewed in time; otherwise, False.
+    @raise OSError: If there is no lease.
+    """
+    return time.time() - os.path.getmtime(lease_path) > lease_duration
+
+
+def _read_lease_token(lease_path):
+    """
+    @param lease_path: Path to a lease file.
+    @return: The token in the lease file, or None if there is no lease.
+    """
+    try:
+        with open(lease_path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _release_lease(work_directory, name, token):
+    """
+    Give up the lease on a chunk, unless another worker has taken it over.
+    @param work_directory: The work directory of the job.
+    @param name: The number of a chunk, or the name of another lease.
+    @param token: The token returned by _claim_lease() for the lease.
+    """
+    lease_path = _get_lease_path(work_directory, name)
+    if _read_lease_token(lease_path) != token:
+        return
+    try:
+        os.remove(lease_path)
+    except OSError:
+        pass
+
+
+def _load_job(work_directory):
+    """
+    Read the description of a job.
+    @param work_directory: The work directory of the job.
+    @return: A dict describing the job, with strings rather than unicode, as
+        the csv module requires.
+    """
+    with open(os.path.join(work_directory, JOB_FILE_NAME)) as f:
+        job = json.load(f)
+    return dict(
+        (str(key), str(value) if isinstance(value, unicode) else value)
+        for key, value in job.iteritems()
+    )
+
+
+def _write_atomically(path, contents):
+    """
+    Write a file so that other processes never see it partially written.
+    @param path: Path to the file.
+    @param contents: The contents of the file.
+    """
+    temp_path = '%s.%s' % (path, uuid.uuid4().hex)
+    with open(temp_path, 'w') as f:
+        f.write(contents)
+    os.rename(temp_path, path)
+
+
+def _get_chunk_path(work_directory, chunk, extension='csv'):
+    """
+    @return: The path to the list of file paths or ids in a chunk.
+    """
+    return os.path.join(
+        work_directory, 'chunks', 'chunk-%05i.%s' % (chunk, extension)
+    )
+
+
+def _get_lease_path(work_directory, name):
+    """
+    @return: The path to the lease file for a chunk or other lease name.
+    """
+    if isinstance(name, int):
+        name = 'chunk-%05i' % name
+    return os.path.join(work_directory, 'leases', '%s.lease' % name)
+
+
+def _get_done_path(work_directory, name):
+    """
+    @return: The path to the marker indicating a chunk or other step is done.
+    """
+    if isinstance(name, int):
+        name = 'chunk-%05i' % name
+    return os.path.join(work_directory, 'done', '%s.done' % name)
+
+
+def _get_output_path(work_directory, chunk, suffix):
+    """
+    @return: The path to the csv output of a chunk, with an optional suffix
+        such as '-errors'.
+    """
+    return os.path.join(
+        work_directory, 'output', 'chunk-%05i%s.csv' % (chunk, suffix)
+    )
@@ -24,19 +24,43 @@ THE SOFTWARE.
 This module contains methods for performing mass downloads.
 """
 
-import bs4
 import cookielib
+import contextlib
 import csv
+import functools
 import os
 import re
+import StringIO
+import threading
 import time
 import traceback
 import urllib
 import urllib2
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import dredge.errorlog
 
 
 ## name of a csv file to dump info about items for which there were errors
 ERROR_LOG_NAME = 'errors.csv'
+## headers for the error log
+ERROR_LOG_HEADERS = ['id', 'exception']
+## headers for the manifest of downloaded items
+MANIFEST_HEADERS = ['id', 'bytes']
+## headers for a cache of the page counts of multi-page items
+PAGE_COUNT_HEADERS = ['id', 'pages']
+## number of bytes at the start of an index page searched for its page count
+PAGE_COUNT_PREFIX_SIZE = 64 * 1024
+## http status codes indicating that the server is overloaded
+OVERLOAD_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+## matches the id and page number of a page of a multi-page item
+_PAGE_ID_MATCH = re.compile('^(.*)-([0-9]{4})$')
+## increases in latency of fewer seconds than this are ignored as noise
+LATENCY_NOISE_FLOOR = 0.01
+## serializes file locks between threads, since fcntl locks are per process
+_file_lock = threading.Lock()
 
 
 def get_credentialed_opener(login_url, login_credentials):
@@ -59,6 +83,141 @@ def get_credentialed_opener(login_url, login_credentials):
     return opener
 
 
+def get_item_file_name(item_id, file_extension):
+    """
+    Get the name of the file in which an item's data are stored.
+    @param item_id: The id of the item.
+    @param file_extension: Extension to use for downloaded data.
+    @return: The file name, with the id quoted so it is safe for any file
+        system.
+    """
+    return '%s.%s' % (urllib2.quote(str(item_id), safe=''), file_extension)
+
+
+def get_opener_method(
+        opener=None, metrics=None, rate_limiter=None, concurrency=None
+):
+    """
+    Get the method used to open urls.
+    @param opener: A custom OpenerDirector if required, such as when login
+        credentials must be supplied. See get_credentialed_opener().
+    @param metrics: An optional dredge.metrics.Metrics object on which to record
+        the latency and size of each request.
+    @param rate_limiter: An optional object with an acquire() method, such as a
+        SharedRateLimiter, which is called before each request.
+    @param concurrency: An optional AdaptiveConcurrency object, which limits the
+        number of requests in flight and is told the outcome of each request.
+    @return: A function with the signature func(url, max_bytes=None) that
+        returns a file-like object containing the response, or only its first
+        max_bytes bytes if max_bytes is not None.
+    """
+    if opener is not None:
+        opener_method = opener.open
+    else:
+        opener_method = urllib2.urlopen
+    opener_method = functools.partial(
+        _limited_fetch, opener_method=opener_method
+    )
+    # time only the request itself, not waits for tokens or a free slot
+    if metrics is not None:
+        opener_method = functools.partial(
+            _timed_fetch, opener_method=opener_method, metrics=metrics
+        )
+    if concurrency is not None:
+        opener_method = functools.partial(
+            _controlled_fetch,
+            opener_method=opener_method,
+            concurrency=concurrency
+        )
+    if rate_limiter is not None:
+        opener_method = functools.partial(
+            _rate_limited_fetch,
+            opener_method=opener_method,
+            rate_limiter=rate_limiter
+        )
+    return opener_method
+
+
+def get_page_counts(output_directory, archive=None, corpus_index=None):
+    """
+    Get the number of pages of each multi-page item saved by a previous run of
+        mass_download(), e.g., to estimate costs for schedule_item_ids().
+    @param output_directory: Directory where the pages were saved.
+    @param archive: None if pages were saved as files; otherwise, the
+        dredge.archive.SegmentArchive in which they were stored.
+    @param corpus_index: None if output_directory should be listed; otherwise,
+        a dredge.corpus.CorpusIndex of it.
+    @return: A dict mapping item ids, as strings, to their page counts.
+    """
+    if archive is not None:
+        page_ids = archive.ids()
+    else:
+        page_ids = [
+            urllib2.unquote(file_name[:-len('.html')])
+            for file_name in (
+                corpus_index.names() if corpus_index is not None
+                else os.listdir(output_directory)
+            )
+            if file_name.endswith('.html')
+        ]
+    page_counts = dict()
+    for page_id in page_ids:
+        match = _PAGE_ID_MATCH.match(page_id)
+        if match is None:
+            continue
+        item_id, page_number = match.group(1), int(match.group(2))
+        page_counts[item_id] = max(page_counts.get(item_id, 0), page_number)
+    return page_counts
+
+
+def schedule_item_ids(item_ids, priorities=None, costs=None, lead_count=0):
+    """
+    Order items so that the most valuable data per request are downloaded
+        first. Items are sorted by priority divided by cost, so that among
+        items of equal priority cheap ones come first, and ties keep their
+        original order.
+    @param item_ids: Collection of ids specifying what is to be downloaded.
+    @param priorities: None if all items are equally important; otherwise, a
+        dict or a function mapping an id to a positive number, where larger is
+        more important. Items missing from a dict have a priority of 1.
+    @param costs: None if all items are equally expensive; otherwise, a dict or
+        a function mapping an id to a positive number such as a page count from
+        get_page_counts(). Items missing from a dict are assumed to have the
+        median cost of those present. Dicts may be keyed by ids or by ids as
+        strings.
+    @param lead_count: The number of the most expensive items among those of
+        the highest priority to move to the front, e.g., so that when
+        downloading on several threads they overlap the rest of the crawl
+        instead of forming its tail.
+    @return: A list of the ids in the order they should be downloaded.
+    """
+    item_ids = list(item_ids)
+    default_cost = 1
+    if isinstance(costs, dict) and costs:
+        known_costs = sorted(costs.itervalues())
+        default_cost = known_costs[len(known_costs) // 2]
+    item_costs = [
+        max(_get_item_value(costs, item_id, default_cost), 1e-9)
+        for item_id in item_ids
+    ]
+    order = sorted(
+        xrange(len(item_ids)),
+        key=lambda i: (
+            -_get_item_value(priorities, item_ids[i], 1) / float(item_costs[i])
+        )
+    )
+    if lead_count > 0:
+        leaders = sorted(
+            xrange(len(item_ids)),
+            key=lambda i: (
+                -_get_item_value(priorities, item_ids[i], 1), -item_costs[i]
+            )
+        )[:lead_count]
+        is_leader = set(leaders)
+        order = leaders + [i for i in order if i not in is_leader]
+    return [item_ids[i] for i in order]
+
+
 def mass_download(
         item_ids, url_template, url_format_expression, output_directory,
         file_extension='xml',
@@ -66,7 +225,20 @@ def mass_download(
         segment_url_template=None,
         segment_url_format_expression=None,
         get_max_page_expression=None,
-        opener=None
+        opener=None,
+        metrics=None,
+        archive=None,
+        rate_limiter=None,
+        error_log_path=None,
+        manifest_path=None,
+        concurrency=None,
+        priorities=None,
+        costs=None,
+        corpus_index=None,
+        page_count_pattern=None,
+        page_count_prefix_size=PAGE_COUNT_PREFIX_SIZE,
+        page_count_cache_path=None,
+        skip_item_ids=None
 ):
     """
     Downloads a bunch of data for the supplied items_ids using the supplied url
@@ -100,84 +272,713 @@ def mass_download(
         )
     @param opener: A custom OpenerDirector if required, such as when login
         credentials must be supplied. See get_credentialed_opener().
+    @param metrics: An optional dredge.metrics.Metrics object on which to record
+        fetch latency, bytes, requests, errors and the number of pending
+        items.
+    @param archive: None if each document should be saved to its own file in
+        output_directory; otherwise, a dredge.archive.SegmentArchive in which
+        to store the documents. The error log is kept in output_directory in
+        either case. Pages of multi-page documents are stored with ids of the
+        form <item_id>-<page_number>, with the page number padded to 4 digits.
+    @param rate_limiter: None if downloads should be paced with
+        download_burst_count and sleep_time; otherwise, an object with an
+        acquire() method, such as a SharedRateLimiter, which is called before
+        each request in place of sleeping between bursts.
+    @param error_log_path: None to keep the error log in output_directory;
+        otherwise, the path to an error log, which may be shared with other
+        processes. Rows are appended in batches under a file lock, and the full
+        traceback is written once for each kind of error. See
+        dredge.errorlog.ErrorLog.
+    @param manifest_path: None if no manifest should be kept; otherwise, the
+        path to a csv file, which may be shared with other processes, to which
+        the id and size of each downloaded item is appended. Items in the
+        manifest are skipped, even if they were saved somewhere else.
+    @param concurrency: None if items should be downloaded one at a time;
+        otherwise, an AdaptiveConcurrency object, in which case items are
+        downloaded on a pool of threads and the number of requests in flight
+        is adjusted to the server's responses in place of sleeping between
+        bursts.
+    @param priorities: None to download items in the order supplied;
+        otherwise, a dict or function giving the priority of each id. See
+        schedule_item_ids().
+    @param costs: None to download items in the order supplied; otherwise, a
+        dict or function giving the estimated cost of each id, such as the
+        result of get_page_counts() for a previous run. See
+        schedule_item_ids(). When downloading on several threads, the most
+        expensive items, up to half the threads, are started first.
+    @param corpus_index: None if output_directory should be listed to find
+        items that have already been downloaded; otherwise, a
+        dredge.corpus.CorpusIndex of output_directory, which is used instead
+        and to which each new file is added, so that it can be saved for the
+        next run.
+    @param page_count_pattern: None if get_max_page_expression should be used
+        to find the page count of a multi-page item; otherwise, a regular
+        expression, which may be compiled, whose first group matches a page
+        number on the index page, e.g., r'page=(\d+)'. The page count is the
+        largest number matched in the first page_count_prefix_size bytes, which
+        avoids building a BeautifulSoup tree of the whole page.
+    @param page_count_prefix_size: The number of bytes at the start of the
+        index page searched with page_count_pattern, or None to search all of
+        it.
+    @param page_count_cache_path: None if the index page of each multi-page
+        item should be downloaded to find its page count; otherwise, the path
+        to a csv file, which may be shared with other processes, in which page
+        counts are kept. The index page of an item whose count is cached is
+        not downloaded, and an item whose cached pages have all been saved is
+        skipped without any requests. Delete the file to pick up items that
+        have gained pages.
+    @param skip_item_ids: None if the error log, the manifest and
+        output_directory or archive should be read to find items that have
+        already been downloaded; otherwise, a set of the ids to skip, as
+        strings, which is used instead and to which each item is added once it
+        has been downloaded or logged as an error, so that the same set can be
+        passed to the next call. See find_downloaded_item_ids().
     """
     # create the output xml_directory if it does not already exist
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     # create the error file if it does not already exist
-    path_to_error_log = os.path.join(output_directory, ERROR_LOG_NAME)
-    error_items = list()
-    if not os.path.exists(path_to_error_log):
-        with open(path_to_error_log, 'w') as csv_file:
-            csv.writer(csv_file).writerow(['id', 'exception'])
-    else:
-        with open(path_to_error_log) as csv_file:
-            error_items = [row['id'] for row in csv.DictReader(csv_file)]
-    # get list of already downloaded item_ids
-    file_extension = re.search('[A-Za-z]+', file_extension).group(0)
-    downloaded_file_name_match = re.compile('.*[.]' + file_extension + '$')
-    existing_downloaded_data = set(
-        [
-            urllib2.unquote(os.path.splitext(file_name)[0])
-            for file_name in os.listdir(output_directory)
-            if downloaded_file_name_match.match(file_name)
-        ] + error_items
+    path_to_error_log = error_log_path or os.path.join(
+        output_directory, ERROR_LOG_NAME
     )
+    file_extension = re.search('[A-Za-z]+', file_extension).group(0)
+    # get list of already downloaded item_ids
+    if skip_item_ids is None:
+        existing_downloaded_data, existing_file_names = _find_downloaded_items(
+            output_directory, file_extension, archive, corpus_index,
+            path_to_error_log, manifest_path
+        )
+    else:
+        existing_downloaded_data = skip_item_ids
+        if archive is not None:
+            existing_file_names = set()
+        elif corpus_index is not None:
+            existing_file_names = set(corpus_index.names())
+        else:
+            # pages of multi-page items are looked for one at a time instead
+            existing_file_names = None
     # determine what opener method to use
-    if opener is not None:
-        opener_method = opener.open
+    opener_method = get_opener_method(
+        opener, metrics, rate_limiter, concurrency
+    )
+    # get page counts of multi-page items found by previous runs
+    if page_count_cache_path is not None:
+        page_counts = dict(
+            (row[0], int(row[1])) for row in
+            _read_csv_rows(page_count_cache_path, PAGE_COUNT_HEADERS)
+        )
     else:
-        opener_method = urllib2.urlopen
-    # download items
-    download_count = 0
-    for item_id in item_ids:
-        # skip already downloaded data
-        if str(item_id) in existing_downloaded_data:
-            continue
-        # download the data
-        url = url_template.format(**url_format_expression(item_id))
+        page_counts = dict()
+    if isinstance(page_count_pattern, basestring):
+        page_count_pattern = re.compile(page_count_pattern)
+    # archives may not be written from several threads at once
+    archive_lock = threading.Lock()
+    # errors are written in the background, since many may fail in a row
+    error_log = dredge.errorlog.ErrorLog(path_to_error_log)
+
+    def download_item(item_id):
         try:
-            downloaded_data = opener_method(url).read()
+            url = url_template.format(**url_format_expression(item_id))
             # code path if the data does not need to be parsed
-            if get_max_page_expression is None:
-                # save the data to a file
-                path_to_file_on_disk = os.path.join(
-                    output_directory,
-                    '%s.%s' % (
-                        urllib2.quote(str(item_id), safe=''), file_extension
+            if get_max_page_expression is None and page_count_pattern is None:
+                downloaded_data = opener_method(url).read()
+                item_size = len(downloaded_data)
+                # save the data to the archive or a file
+                if archive is not None:
+                    with archive_lock:
+                        archive.put(item_id, downloaded_data)
+                else:
+                    _save_file(
+                        output_directory,
+                        get_item_file_name(item_id, file_extension),
+                        downloaded_data, corpus_index
                     )
-                )
-                with open(path_to_file_on_disk, 'w+') as file_on_disk:
-                    file_on_disk.write(downloaded_data)
             # otherwise look for the page counter in the data
             else:
-                # assume it's html
-                soup = bs4.BeautifulSoup(opener_method(url).read(), 'lxml')
-                max_page = get_max_page_expression(soup)
+                max_page = page_counts.get(str(item_id))
+                item_size = 0
+                if max_page is None:
+                    # only the start of the page is searched for a pattern
+                    downloaded_data = opener_method(
+                        url,
+                        max_bytes=page_count_prefix_size
+                        if page_count_pattern is not None else None
+                    ).read()
+                    item_size = len(downloaded_data)
+                    max_page = _get_page_count(
+                        downloaded_data, get_max_page_expression,
+                        page_count_pattern
+                    )
+                    if page_count_cache_path is not None:
+                        page_counts[str(item_id)] = max_page
+                        _append_csv_row(
+                            page_count_cache_path, [item_id, max_page]
+                        )
                 for page_number in xrange(1, max_page + 1):
-                    # skip if a file has already been downloaded
+                    # skip if a page has already been downloaded
+                    page_id = '%s-%04i' % (item_id, page_number)
                     file_name = '%s-%04i.html' % (
                         urllib2.quote(str(item_id), safe=''), page_number
                     )
-                    if file_name in os.listdir(output_directory):
+                    if archive is not None:
+                        if page_id in archive:
+                            continue
+                    elif existing_file_names is None:
+                        if os.path.exists(
+                            os.path.join(output_directory, file_name)
+                        ):
+                            continue
+                    elif file_name in existing_file_names:
                         continue
                     # download the individual page
                     page_url = segment_url_template.format(
                         **segment_url_format_expression(item_id, page_number)
                     )
                     html_data = opener_method(page_url).read()
-                    # save the data to a file
-                    path_to_file_on_disk = os.path.join(
-                        output_directory, file_name
+                    item_size += len(html_data)
+                    # save the data to the archive or a file
+                    if archive is not None:
+                        with archive_lock:
+                            archive.put(page_id, html_data)
+                        continue
+                    _save_file(
+                        output_directory, file_name, html_data, corpus_index
                     )
-                    with open(path_to_file_on_disk, 'w+') as file_on_disk:
-                        file_on_disk.write(html_data)
+                    if existing_file_names is not None:
+                        existing_file_names.add(file_name)
+            if manifest_path is not None:
+                _append_csv_row(manifest_path, [item_id, item_size])
+            if metrics is not None:
+                metrics.increment('download.items')
         except Exception:
             print 'error with %s' % item_id
-            tb = traceback.format_exc()
-            with open(path_to_error_log, 'a') as csv_file:
-                csv.writer(csv_file).writerow([item_id, tb])
-        # wait between bursts
-        download_count += 1
-        if download_count % download_burst_count == 0:
-            time.sleep(sleep_time)
\ No newline at end of file
+            error_log.log(item_id)
+            if metrics is not None:
+                metrics.increment('download.errors')
+        if skip_item_ids is not None:
+            skip_item_ids.add(str(item_id))
+
+    # order the items still to be downloaded if a schedule is requested
+    if priorities is not None or costs is not None:
+        item_ids = list(item_ids)
+        scheduled_item_ids = [
+            item_id for item_id in item_ids
+            if str(item_id) not in existing_downloaded_data
+        ]
+        if metrics is not None:
+            metrics.increment(
+                'download.skipped', len(item_ids) - len(scheduled_item_ids)
+            )
+        item_ids = schedule_item_ids(
+            scheduled_item_ids, priorities, costs,
+            lead_count=concurrency.max_limit // 2 if concurrency else 0
+        )
+    # skip already downloaded data
+    pending_item_ids = _get_pending_item_ids(
+        item_ids, existing_downloaded_data, metrics
+    )
+    # download items
+    with error_log:
+        if concurrency is not None:
+            concurrency.run(pending_item_ids, download_item)
+        else:
+            download_count = 0
+            for item_id in pending_item_ids:
+                download_item(item_id)
+                # wait between bursts
+                download_count += 1
+                if (
+                    rate_limiter is None and
+                    download_count % download_burst_count == 0
+                ):
+                    time.sleep(sleep_time)
+    if metrics is not None:
+        metrics.flush()
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of requests in flight, adjusting the limit to the
+        server's responses with additive increase and multiplicative decrease.
+        The limit grows by about one request for each round of successful
+        requests. It is cut when a request fails or is refused with a status
+        such as 429 or 503, or when the smoothed latency rises well above the
+        lowest latency observed, which indicates requests are queueing at the
+        server. Decisions are recorded on an optional metrics object as the
+        gauge download.concurrency and the counters
+        download.concurrency_increases and download.concurrency_decreases.
+    """
+    def __init__(
+            self, initial_limit=1, min_limit=1, max_limit=16,
+            backoff_factor=0.5, latency_tolerance=2.0, smoothing=0.2,
+            metrics=None
+    ):
+        """
+        Initialize a new instance.
+        @param initial_limit: The number of requests in flight at the start.
+        @param min_limit: The fewest requests ever allowed in flight.
+        @param max_limit: The most requests ever allowed in flight, which is
+            also the number of threads used by run().
+        @param backoff_factor: The factor by which the limit is multiplied when
+            the server is overloaded.
+        @param latency_tolerance: The ratio of smoothed latency to the lowest
+            latency above which the server is considered overloaded.
+        @param smoothing: The weight of each new latency in the exponentially
+            weighted moving average.
+        @param metrics: An optional dredge.metrics.Metrics object on which to
+            record decisions.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.metrics = metrics
+        self.in_flight = 0
+        self.min_latency = None
+        self.smoothed_latency = None
+        self._limit = float(max(min(initial_limit, max_limit), min_limit))
+        self._last_decrease_time = 0
+        self._condition = threading.Condition()
+        if metrics is not None:
+            metrics.set_gauge('download.concurrency', self.limit)
+
+    @property
+    def limit(self):
+        """
+        @return: The number of requests currently allowed in flight.
+        """
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Wait until another request may be put in flight.
+        """
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, is_overloaded):
+        """
+        Take a request out of flight and adjust the limit to its outcome.
+        @param latency: The number of seconds the request took.
+        @param is_overloaded: True if the request failed in a way that suggests
+            the server is overloaded; otherwise, False.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if not is_overloaded:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if self.smoothed_latency is None:
+                    self.smoothed_latency = latency
+                else:
+                    self.smoothed_latency += self.smoothing * (
+                        latency - self.smoothed_latency
+                    )
+                is_overloaded = self.smoothed_latency > (
+                    self.min_latency * self.latency_tolerance
+                ) and self.smoothed_latency - self.min_latency > (
+                    LATENCY_NOISE_FLOOR
+                )
+            if is_overloaded:
+                self._decrease()
+            elif self._limit < self.max_limit:
+                old_limit = self.limit
+                self._limit = min(
+                    self._limit + 1.0 / old_limit, float(self.max_limit)
+                )
+                if self.metrics is not None and self.limit > old_limit:
+                    self.metrics.increment('download.concurrency_increases')
+            if self.metrics is not None:
+                self.metrics.set_gauge('download.concurrency', self.limit)
+            self._condition.notify_all()
+
+    def run(self, items, func):
+        """
+        Call a function on each item from a pool of max_limit threads. The
+            function's requests should be made through a method returned by
+            get_opener_method() with this object, which enforces the limit.
+        @param items: An iterable of items.
+        @param func: A function with the signature func(item). If it raises an
+            exception, the traceback is printed and the thread moves on to the
+            next item.
+        """
+        items = iter(items)
+        items_lock = threading.Lock()
+
+        def work():
+            while True:
+                with items_lock:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                try:
+                    func(item)
+                except Exception:
+                    traceback.print_exc()
+
+        threads = [
+            threading.Thread(target=work) for _ in xrange(self.max_limit)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _decrease(self):
+        """
+        Cut the limit, at most once per smoothed latency so that one episode of
+            overload does not cut it repeatedly. The lock must be held.
+        """
+        now = time.time()
+        if now - self._last_decrease_time < (self.smoothed_latency or 0):
+            return
+        self._last_decrease_time = now
+        self._limit = max(self._limit * self.backoff_factor, self.min_limit)
+        # give the server a fresh chance to show its unloaded latency
+        self.smoothed_latency = self.min_latency
+        if self.metrics is not None:
+            self.metrics.increment('download.concurrency_decreases')
+
+
+def _save_file(output_directory, file_name, data, corpus_index):
+    """
+    Save downloaded data to a file.
+    @param output_directory: Directory where data should be stored.
+    @param file_name: The name of the file.
+    @param data: The downloaded data.
+    @param corpus_index: None or a dredge.corpus.CorpusIndex of the directory
+        to which the file should be added.
+    """
+    path_to_file_on_disk = os.path.join(output_directory, file_name)
+    with open(path_to_file_on_disk, 'w+') as file_on_disk:
+        file_on_disk.write(data)
+    if corpus_index is not None:
+        corpus_index.add(file_name, len(data), time.time())
+
+
+def _get_item_value(values, item_id, default):
+    """
+    Look up a priority or cost for an item.
+    @param values: None, a dict keyed by ids or ids as strings, or a function.
+    @param item_id: The id of the item.
+    @param default: The value to use if there is none for the item.
+    @return: The value for the item.
+    """
+    if values is None:
+        return default
+    if callable(values):
+        return values(item_id)
+    if item_id in values:
+        return values[item_id]
+    return values.get(str(item_id), default)
+
+
+def find_downloaded_item_ids(
+        output_directory, file_extension='xml', archive=None,
+        corpus_index=None, error_log_path=None, manifest_path=None
+):
+    """
+    Find the items that mass_download() would skip, so that the result can be
+        passed to several calls as skip_item_ids rather than being found again
+        for each of them.
+    @param output_directory: Directory where data is stored.
+    @param file_extension: Extension used for downloaded data.
+    @param archive: None if each document is saved to its own file in
+        output_directory; otherwise, a dredge.archive.SegmentArchive in which
+        the documents are stored.
+    @param corpus_index: None if output_directory should be listed; otherwise,
+        a dredge.corpus.CorpusIndex of output_directory.
+    @param error_log_path: None if the error log is kept in output_directory;
+        otherwise, the path to the error log.
+    @param manifest_path: None if no manifest is kept; otherwise, the path to
+        the manifest.
+    @return: A set of the ids to skip, as strings.
+    """
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    return _find_downloaded_items(
+        output_directory, re.search('[A-Za-z]+', file_extension).group(0),
+        archive, corpus_index,
+        error_log_path or os.path.join(output_directory, ERROR_LOG_NAME),
+        manifest_path
+    )[0]
+
+
+def _find_downloaded_items(
+        output_directory, file_extension, archive, corpus_index,
+        error_log_path, manifest_path
+):
+    """
+    Find the items that have already been downloaded or logged as errors.
+    @param output_directory: Directory where data is stored.
+    @param file_extension: Extension used for downloaded data, without a dot.
+    @param archive: None or a dredge.archive.SegmentArchive.
+    @param corpus_index: None or a dredge.corpus.CorpusIndex of
+        output_directory.
+    @param error_log_path: Path to the error log.
+    @param manifest_path: None or the path to the manifest.
+    @return: A tuple of a set of the ids to skip, as strings, and a set of the
+        file names in output_directory.
+    """
+    error_items = _read_csv_ids(error_log_path, ERROR_LOG_HEADERS)
+    # items in a shared manifest may have been saved by another process
+    if manifest_path is not None:
+        error_items += _read_csv_ids(manifest_path, MANIFEST_HEADERS)
+    # list the directory only once
+    if archive is not None:
+        existing_file_names = set()
+    elif corpus_index is not None:
+        existing_file_names = set(corpus_index.names())
+    else:
+        existing_file_names = set(os.listdir(output_directory))
+    if archive is not None:
+        return set(archive.ids() + error_items), existing_file_names
+    downloaded_file_name_match = re.compile('.*[.]' + file_extension + '$')
+    return set(
+        [
+            urllib2.unquote(os.path.splitext(file_name)[0])
+            for file_name in existing_file_names
+            if downloaded_file_name_match.match(file_name)
+        ] + error_items
+    ), existing_file_names
+
+
+def _get_pending_item_ids(item_ids, existing_downloaded_data, metrics):
+    """
+    Skip items that have already been downloaded or logged as errors.
+    @param item_ids: Collection of ids specifying what is to be downloaded.
+    @param existing_downloaded_data: A set of the ids to skip, as strings.
+    @param metrics: An optional dredge.metrics.Metrics object on which to record
+        the number of pending and skipped items.
+    @return: A generator of the ids to download.
+    """
+    if metrics is not None:
+        pending_count = len(item_ids) if hasattr(item_ids, '__len__') else None
+    for item_id in item_ids:
+        if metrics is not None and pending_count is not None:
+            metrics.set_gauge('download.pending', pending_count)
+            pending_count -= 1
+        if str(item_id) in existing_downloaded_data:
+            if metrics is not None:
+                metrics.increment('download.skipped')
+            continue
+        yield item_id
+
+
+def _limited_fetch(url, opener_method, max_bytes=None):
+    """
+    Fetch a url, reading no more than a given number of bytes.
+    @param url: The url to fetch.
+    @param opener_method: The method used to open the url.
+    @param max_bytes: None to return the response unread; otherwise, the
+        number of bytes to read before the response is closed.
+    @return: A file-like object containing the downloaded data.
+    """
+    response = opener_method(url)
+    if max_bytes is None:
+        return response
+    try:
+        return StringIO.StringIO(response.read(max_bytes))
+    finally:
+        response.close()
+
+
+def _controlled_fetch(url, opener_method, concurrency, max_bytes=None):
+    """
+    Fetch a url once the concurrency limit permits it, and report the outcome.
+    @param url: The url to fetch.
+    @param opener_method: The method used to open the url.
+    @param concurrency: An AdaptiveConcurrency object.
+    @param max_bytes: None to read the whole response; otherwise, the number
+        of bytes to read.
+    @return: A file-like object containing the downloaded data.
+    """
+    concurrency.acquire()
+    start_time = time.time()
+    is_overloaded = True
+    try:
+        data = opener_method(url, max_bytes=max_bytes).read()
+        is_overloaded = False
+    except urllib2.HTTPError as e:
+        is_overloaded = e.code in OVERLOAD_STATUS_CODES
+        raise
+    finally:
+        concurrency.release(time.time() - start_time, is_overloaded)
+    return StringIO.StringIO(data)
+
+
+def _timed_fetch(url, opener_method, metrics, max_bytes=None):
+    """
+    Fetch a url and record its latency and size.
+    @param url: The url to fetch.
+    @param opener_method: The method used to open the url.
+    @param metrics: A dredge.metrics.Metrics object.
+    @param max_bytes: None to read the whole response; otherwise, the number
+        of bytes to read.
+    @return: A file-like object containing the downloaded data.
+    """
+    start_time = time.time()
+    data = opener_method(url, max_bytes=max_bytes).read()
+    metrics.observe('download.fetch_latency', time.time() - start_time)
+    metrics.increment('download.requests')
+    metrics.increment('download.bytes', len(data))
+    return StringIO.StringIO(data)
+
+
+class SharedRateLimiter(object):
+    """
+    A token bucket whose state is kept in a file, so that any number of
+        processes, on any hosts that share the file, draw from one request-rate
+        budget. The file is locked while tokens are taken. Hosts sharing a
+        limiter should have synchronized clocks.
+    """
+    def __init__(self, path, requests_per_second, burst=1):
+        """
+        Initialize a new instance.
+        @param path: Path to the file in which the state of the bucket is kept.
+            It is created if it does not exist.
+        @param requests_per_second: The sustained rate of requests permitted
+            across all processes.
+        @param burst: The number of requests that may be made in succession
+            after the bucket has been idle.
+        """
+        self.path = path
+        self.requests_per_second = float(requests_per_second)
+        self.burst = burst
+
+    def acquire(self):
+        """
+        Take a token from the bucket, waiting until one is available.
+        """
+        while True:
+            with _locked_file(self.path) as f:
+                now = time.time()
+                state = f.read().split()
+                if len(state) == 2:
+                    tokens, last_time = float(state[0]), float(state[1])
+                    tokens = min(
+                        self.burst,
+                        tokens +
+                        max(now - last_time, 0) * self.requests_per_second
+                    )
+                else:
+                    tokens = self.burst
+                if tokens >= 1:
+                    tokens -= 1
+                    wait_time = 0
+                else:
+                    wait_time = (1 - tokens) / self.requests_per_second
+                f.seek(0)
+                f.truncate()
+                f.write('%r %r' % (tokens, now))
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+
+@contextlib.contextmanager
+def _locked_file(path):
+    """
+    Open a file for reading and writing, creating it if necessary, and hold an
+        exclusive lock on it against other threads and processes. Locks between
+        processes are advisory and are only taken where fcntl is available.
+    @param path: Path to the file.
+    @return: The locked file object, positioned at the start of the file.
+    """
+    with _file_lock, os.fdopen(
+            os.open(path, os.O_RDWR | os.O_CREAT), 'r+'
+    ) as f:
+        if fcntl is not None:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            f.flush()
+            if fcntl is not None:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def _read_csv_ids(path, headers):
+    """
+    Read the ids in a csv log, creating the log if it does not already exist.
+    @param path: Path to the log.
+    @param headers: Headers for the log, the first of which is id.
+    @return: A list of the ids in the log.
+    """
+    return [row[0] for row in _read_csv_rows(path, headers)]
+
+
+def _read_csv_rows(path, headers):
+    """
+    Read the rows in a csv log, creating the log if it does not already exist.
+    @param path: Path to the log.
+    @param headers: Headers for the log.
+    @return: A list of the rows in the log, excluding the headers.
+    """
+    with _locked_file(path) as csv_file:
+        rows = [row for row in csv.reader(csv_file) if row]
+        if not rows:
+            # the headers are written under the lock, so no row appended by
+            # another process can come before them
+            csv_file.seek(0, os.SEEK_END)
+            csv.writer(csv_file).writerow(headers)
+            return list()
+    # earlier versions could append a row to a new log before its headers
+    if rows[0] == list(headers):
+        return rows[1:]
+    return rows
+
+
+def _get_page_count(data, get_max_page_expression, page_count_pattern):
+    """
+    Find the page count on the index page of a multi-page item.
+    @param data: The contents of the index page, or the start of it.
+    @param get_max_page_expression: Function to find the page count in a souped
+        document, used if page_count_pattern is None.
+    @param page_count_pattern: None or a compiled regular expression whose first
+        group matches a page number.
+    @return: The number of pages.
+    """
+    if page_count_pattern is None:
+        # assume it's html; bs4 and lxml are imported here so that crawls that
+        # never parse html do not pay to load them
+        import bs4
+        return get_max_page_expression(bs4.BeautifulSoup(data, 'lxml'))
+    page_numbers = [
+        int(match.group(1)) for match in page_count_pattern.finditer(data)
+    ]
+    if not page_numbers:
+        raise ValueError(
+            'no page numbers matching %r' % page_count_pattern.pattern
+        )
+    return max(page_numbers)
+
+
+def _append_csv_row(path, row):
+    """
+    Append a row to a csv log that may be shared with other processes.
+    @param path: Path to the log.
+    @param row: The row to append.
+    """
+    with _locked_file(path) as csv_file:
+        csv_file.seek(0, os.SEEK_END)
+        csv.writer(csv_file).writerow(row)
+
+
+def _rate_limited_fetch(url, opener_method, rate_limiter, max_bytes=None):
+    """
+    Fetch a url once the rate limiter permits it.
+    @param url: The url to fetch.
+    @param opener_method: The method used to open the url.
+    @param rate_limiter: An object with an acquire() method.
+    @param max_bytes: None to read the whole response; otherwise, the number
+        of bytes to read.
+    @return: A file-like object containing the downloaded data.
+    """
+    rate_limiter.acquire()
+    return opener_method(url, max_bytes=max_bytes)
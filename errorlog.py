@@ -0,0 +1,185 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+
+This module contains a buffered writer for csv error logs. Rows are collected
+in memory and appended in batches from a background thread, so a run of
+failures, such as during an outage, does not turn into a run of synchronous
+writes. Exceptions are grouped by signature, and the full traceback is written
+only for the first item with each signature.
+"""
+
+import csv
+import multiprocessing.util
+import os
+import StringIO
+import sys
+import threading
+import traceback
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+## default number of seconds between flushes of an error log
+DEFAULT_FLUSH_INTERVAL = 1.0
+## default number of pending rows that triggers an immediate flush
+DEFAULT_MAX_BATCH_SIZE = 1000
+
+
+class ErrorLog(object):
+    """
+    Appends rows of (id, error) to a csv error log in batches from a
+        background thread. Each batch is appended with a single write under an
+        exclusive lock, where fcntl is available, so the log may be shared with
+        other processes. The log must already exist with its headers, and the
+        ids remain in the first column so that it can be read to resume a job.
+        Pending rows are flushed when the log is closed or the process exits
+        normally, but are lost if the process is killed.
+    """
+    def __init__(
+            self, path, flush_interval=DEFAULT_FLUSH_INTERVAL,
+            max_batch_size=DEFAULT_MAX_BATCH_SIZE
+    ):
+        """
+        Initialize a new instance and start its background thread.
+        @param path: Path to the error log.
+        @param flush_interval: The most seconds a row waits to be written.
+        @param max_batch_size: The number of pending rows at which they are
+            written without waiting for the interval.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._pending = list()
+        self._signatures = dict()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        # flush at exit, including in multiprocessing workers that call exit
+        self._finalizer = multiprocessing.util.Finalize(
+            self, self._close, exitpriority=10
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def log(self, item_id, error=None):
+        """
+        Add a row to the log.
+        @param item_id: The id of the item that failed.
+        @param error: None to log the exception currently being handled;
+            otherwise, a message to log. The full traceback of an exception is
+            logged only for the first item whose exception has the same type
+            and stack; for later items the exception's message is logged with
+            the id of that first item.
+        """
+        if error is None:
+            error = self._format_exception(item_id)
+        with self._condition:
+            self._pending.append([item_id, error])
+            if len(self._pending) >= self.max_batch_size:
+                self._condition.notify()
+
+    def flush(self):
+        """
+        Write all pending rows to the log.
+        """
+        with self._write_lock:
+            with self._condition:
+                rows, self._pending = self._pending, list()
+            if not rows:
+                return
+            data = StringIO.StringIO()
+            csv.writer(data).writerows(rows)
+            file_descriptor = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+            )
+            try:
+                if fcntl is not None:
+                    fcntl.lockf(file_descriptor, fcntl.LOCK_EX)
+                os.write(file_descriptor, data.getvalue())
+            finally:
+                os.close(file_descriptor)
+
+    def close(self):
+        """
+        Stop the background thread and write all pending rows to the log.
+        """
+        self._finalizer()
+
+    def _close(self):
+        """
+        Stop the background thread, which writes the last pending rows.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        """
+        Write pending rows each interval, or sooner if enough are waiting.
+        """
+        while True:
+            with self._condition:
+                if (
+                    not self._closed and
+                    len(self._pending) < self.max_batch_size
+                ):
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def _format_exception(self, item_id):
+        """
+        Format the exception currently being handled for an item.
+        @param item_id: The id of the item that failed.
+        @return: The full traceback if no exception with the same signature has
+            been logged; otherwise, the exception's message and the id of the
+            item whose row has the traceback.
+        """
+        exc_type, exc_value, tb = sys.exc_info()
+        signature = (exc_type, tuple(
+            frame[:3] for frame in traceback.extract_tb(tb)
+        ))
+        with self._condition:
+            first_item_id = self._signatures.setdefault(signature, item_id)
+        if first_item_id == item_id:
+            return traceback.format_exc()
+        return '%s (traceback logged for %s)' % (
+            ''.join(
+                traceback.format_exception_only(exc_type, exc_value)
+            ).strip(),
+            first_item_id
+        )
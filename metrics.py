@@ -0,0 +1,291 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains a lightweight metrics collector for long-running download
+and parse jobs. Functions that accept a Metrics object record counters, gauges
+and histograms on it; when they are given None instead, no measurements are
+taken at all.
+"""
+
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+
+class Histogram(object):
+    """
+    A summary of observed values with power-of-two buckets, which can be merged
+        with histograms collected in other processes.
+    """
+    def __init__(self):
+        """
+        Initialize a new instance.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = dict()
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+        @param value: A non-negative number.
+        """
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        bucket = _get_bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, summary):
+        """
+        Add the values of another histogram to this one.
+        @param summary: A dict produced by to_dict().
+        """
+        if not summary['count']:
+            return
+        self.count += summary['count']
+        self.total += summary['sum']
+        if self.minimum is None or summary['min'] < self.minimum:
+            self.minimum = summary['min']
+        if self.maximum is None or summary['max'] > self.maximum:
+            self.maximum = summary['max']
+        for bucket, count in summary['buckets'].iteritems():
+            bucket = float(bucket)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def to_dict(self):
+        """
+        @return: A JSON-serializable summary of the histogram.
+        """
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.minimum,
+            'max': self.maximum,
+            'mean': self.total / self.count if self.count else None,
+            'buckets': dict(
+                (repr(bucket), count)
+                for bucket, count in self.buckets.iteritems()
+            )
+        }
+
+
+class Metrics(object):
+    """
+    Collects counters, gauges and histograms for a job. Hooks are called with
+        (name, value) for every measurement in the process that records it, and
+        a snapshot is appended to a JSON lines file every log_interval seconds
+        if a log_path is supplied.
+    """
+    def __init__(self, hooks=None, log_path=None, log_interval=60, labels=None):
+        """
+        Initialize a new instance.
+        @param hooks: A collection of functions with the signature
+            func(name, value).
+        @param log_path: None if snapshots should not be logged; otherwise, the
+            path to a JSON lines file to which snapshots are appended.
+        @param log_interval: Minimum number of seconds between logged snapshots.
+        @param labels: A dict of labels to include in each snapshot, e.g., the
+            index of the worker that collected it.
+        """
+        self.hooks = list(hooks or [])
+        self.log_path = log_path
+        self.log_interval = log_interval
+        self.labels = dict(labels or {})
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self._start_time = time.time()
+        self._last_log_time = self._start_time
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        """
+        Prepare the instance to be pickled, e.g., to send it to a worker.
+        @return: The state of the instance, without its lock.
+        """
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled instance.
+        @param state: The state returned by __getstate__().
+        """
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def child(self, **labels):
+        """
+        Get an empty collector with the same configuration, e.g., for use in a
+            worker process whose snapshot is merged back at the end.
+        @param labels: Labels to add to those of this collector.
+        @return: A new Metrics object.
+        """
+        return Metrics(
+            hooks=self.hooks,
+            log_path=self.log_path,
+            log_interval=self.log_interval,
+            labels=dict(self.labels.items() + labels.items())
+        )
+
+    def increment(self, name, count=1):
+        """
+        Increase a counter.
+        @param name: Name of the counter.
+        @param count: Amount by which to increase the counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+        self._notify(name, count)
+
+    def set_gauge(self, name, value):
+        """
+        Set the current value of a gauge, e.g., a queue depth.
+        @param name: Name of the gauge.
+        @param value: The current value.
+        """
+        self.gauges[name] = value
+        self._notify(name, value)
+
+    def observe(self, name, value):
+        """
+        Add a value to a histogram, e.g., a latency.
+        @param name: Name of the histogram.
+        @param value: The observed value.
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        self._notify(name, value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Observe the number of seconds taken by the body of a with statement.
+        @param name: Name of the histogram.
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start_time)
+
+    def snapshot(self):
+        """
+        @return: A JSON-serializable dict describing all measurements so far.
+            Rates are the counters divided by the elapsed seconds.
+        """
+        with self._lock:
+            return self._get_snapshot()
+
+    def _get_snapshot(self):
+        """
+        @return: A snapshot, assuming the lock is held.
+        """
+        elapsed = time.time() - self._start_time
+        return {
+            'time': time.time(),
+            'elapsed': elapsed,
+            'labels': self.labels,
+            'counters': dict(self.counters),
+            'rates': dict(
+                (name, count / elapsed if elapsed else 0.0)
+                for name, count in self.counters.iteritems()
+            ),
+            'gauges': dict(self.gauges),
+            'histograms': dict(
+                (name, histogram.to_dict())
+                for name, histogram in self.histograms.iteritems()
+            )
+        }
+
+    def merge(self, snapshot):
+        """
+        Add the counters and histograms of a snapshot to this collector. Gauges
+            in the snapshot replace those in this collector.
+        @param snapshot: A dict produced by snapshot().
+        """
+        with self._lock:
+            for name, count in snapshot['counters'].iteritems():
+                self.counters[name] = self.counters.get(name, 0) + count
+            self.gauges.update(snapshot['gauges'])
+            for name, summary in snapshot['histograms'].iteritems():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.merge(summary)
+
+    def flush(self):
+        """
+        Append a snapshot to the log file if there is one.
+        """
+        self._last_log_time = time.time()
+        if self.log_path is None:
+            return
+        line = json.dumps(self.snapshot(), sort_keys=True) + '\n'
+        # a single small write in append mode keeps lines from several
+        # processes intact
+        file_descriptor = os.open(
+            self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644
+        )
+        try:
+            os.write(file_descriptor, line)
+        finally:
+            os.close(file_descriptor)
+
+    def _notify(self, name, value):
+        """
+        Call hooks for a measurement and log a snapshot if one is due.
+        @param name: Name of the measurement.
+        @param value: The measured value.
+        """
+        for hook in self.hooks:
+            hook(name, value)
+        if (
+            self.log_path is not None and
+            time.time() - self._last_log_time >= self.log_interval
+        ):
+            self.flush()
+
+
+def _get_bucket(value):
+    """
+    Get the upper bound of the power-of-two bucket containing a value.
+    @param value: A non-negative number.
+    @return: The bucket's upper bound as a float.
+    """
+    if value <= 0:
+        return 0.0
+    return 2.0 ** math.ceil(math.log(value, 2))
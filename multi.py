@@ -24,21 +24,300 @@ THE SOFTWARE.
 This module contains multiprocessing utilities.
 """
 
+import array
+import contextlib
+import cPickle
+import cProfile
 import csv
+import ctypes
 import functools
+import importlib
 import itertools
 import multiprocessing
 import os
+import pstats
+import Queue
+import re
+import signal
 import sys
+import time
 import traceback
+import dredge.compression
+import dredge.errorlog
+import dredge.resources
 
 # increase csv field size limit
 csv.field_size_limit(sys.maxsize)
 
-## the number of cores to use for job scheduling
-CPU_COUNT = multiprocessing.cpu_count()
+## the number of cores to use for job scheduling, respecting the affinity mask
+## and any control group quota of this process
+CPU_COUNT = dredge.resources.get_available_cpu_count()
 ## headers for error log csv output
 ERROR_LOG_HEADERS = ['file', 'error']
+## headers for per-file profiling csv output
+PROFILE_LOG_HEADERS = ['file', 'wall_time', 'cpu_time', 'rows']
+## seconds the watchdog allows beyond a file's time budget before it replaces
+## the worker parsing it
+WATCHDOG_GRACE_PERIOD = 10
+## seconds between watchdog checks on worker health
+WATCHDOG_POLL_INTERVAL = 1
+## exit code of a worker that stopped to be replaced after reaching a budget
+RECYCLE_EXIT_CODE = 75
+## the default number of items a ResultChannel sends in each batch
+DEFAULT_BATCH_SIZE = 1000
+## the default number of batches a ResultChannel holds before senders block
+DEFAULT_CHANNEL_DEPTH = 8
+## the default size in bytes of each shared buffer of a ResultChannel
+DEFAULT_CHANNEL_BUFFER_SIZE = 4 * 1024 * 1024
+## kinds of messages sent through a ResultChannel
+_BUFFERED_BATCH, _INLINE_BATCH, _TASK_DONE, _TASK_FAILED = range(4)
+
+
+class ParseTimeoutError(Exception):
+    """
+    Raised inside a worker when an item exceeds its time budget.
+    """
+    pass
+
+
+class MapError(Exception):
+    """
+    Raised by do_multi_reduce() when the map or reduce function fails on an
+        item and no error handler is supplied.
+    """
+    def __init__(self, item, tb):
+        """
+        Initialize a new instance.
+        @param item: The item on which the map or reduce function failed.
+        @param tb: The formatted traceback from the worker.
+        """
+        super(MapError, self).__init__(
+            'map or reduce function failed on %r:\n%s' % (item, tb)
+        )
+        self.item = item
+        self.traceback = tb
+
+
+class TaskError(Exception):
+    """
+    Raised by do_multi_process(), do_multi_process_iter() and
+        do_multi_reduce() when a task raises an exception or its worker exits
+        before the task is done.
+    """
+    def __init__(self, task_index, tb):
+        """
+        Initialize a new instance.
+        @param task_index: The _task_index of the task.
+        @param tb: The formatted traceback from the worker, or a description
+            of how the worker exited.
+        """
+        super(TaskError, self).__init__(
+            'task %i failed:\n%s' % (task_index, tb)
+        )
+        self.task_index = task_index
+        self.traceback = tb
+
+
+class TaskProgress(object):
+    """
+    Shared record of which item each task is working on and when it started.
+        Tasks run under a watchdog or with a budget should call start_item()
+        before each item and finish() before putting their result in the queue.
+    """
+    def __init__(self, slice_ranges, max_items=None, max_memory=None):
+        """
+        Initialize a new instance.
+        @param slice_ranges: The (slice_start, slice_end) range of each task.
+        @param max_items: None if a worker may process any number of items;
+            otherwise, the number after which it exits to be replaced.
+        @param max_memory: None if a worker may use any amount of memory;
+            otherwise, the resident set size in bytes above which it exits to
+            be replaced before starting its next item.
+        """
+        self.max_items = max_items
+        self.max_memory = max_memory
+        # counts items started in this process, since each worker has a copy
+        self._items_started = 0
+        self.current_items = multiprocessing.Array(
+            'l', [slice_start for slice_start, slice_end in slice_ranges],
+            lock=False
+        )
+        self.start_times = multiprocessing.Array(
+            'd', len(slice_ranges), lock=False
+        )
+
+    def start_item(self, task_index, item_index):
+        """
+        Record that a task has started working on an item. If the worker has
+            reached its budget, it exits instead so that it can be replaced.
+        @param task_index: The _task_index of the task.
+        @param item_index: Index of the item in the data.
+        """
+        self.current_items[task_index] = item_index
+        if self._items_started > 0 and (
+            self.max_items is not None and
+            self._items_started >= self.max_items or
+            self.max_memory is not None and
+            dredge.resources.get_rss() > self.max_memory
+        ):
+            # the parent restarts the slice from this item in a new worker
+            self.start_times[task_index] = 0.0
+            sys.exit(RECYCLE_EXIT_CODE)
+        self._items_started += 1
+        self.start_times[task_index] = time.time()
+
+    def finish(self, task_index):
+        """
+        Record that a task is no longer working on any item.
+        @param task_index: The _task_index of the task.
+        """
+        self.start_times[task_index] = 0.0
+
+    def is_stalled(self, task_index, timeout):
+        """
+        Determine whether a task has been working on its item for too long.
+        @param task_index: The _task_index of the task.
+        @param timeout: Number of seconds an item is allowed to take.
+        @return: True if the task has exceeded the timeout; otherwise, False.
+        """
+        start_time = self.start_times[task_index]
+        return start_time > 0.0 and time.time() - start_time > timeout
+
+
+class ResultChannel(object):
+    """
+    A batched, bounded channel through which tasks stream results to the
+        parent process. Items are pickled in batches into a fixed pool of
+        shared memory buffers, so only a buffer number passes through the
+        queue. Senders block while every buffer is waiting to be read, which
+        bounds the memory used on both sides. Batches too large for a buffer
+        are sent through the queue itself. Strings are pickled as raw bytes,
+        and array.array items are sent as their raw bytes and rebuilt.
+    """
+    def __init__(
+            self, batch_size=DEFAULT_BATCH_SIZE,
+            queue_depth=DEFAULT_CHANNEL_DEPTH,
+            buffer_size=DEFAULT_CHANNEL_BUFFER_SIZE
+    ):
+        """
+        Initialize a new instance. This must be done in the parent process
+            before workers are started.
+        @param batch_size: The number of items to collect before sending.
+        @param queue_depth: The number of batches that may wait to be read.
+        @param buffer_size: The size in bytes of each shared buffer.
+        """
+        self.batch_size = batch_size
+        self.queue_depth = queue_depth
+        self.buffer_size = buffer_size
+        self._buffers = [
+            multiprocessing.RawArray(ctypes.c_char, buffer_size)
+            for _ in xrange(queue_depth)
+        ]
+        self._free_buffers = multiprocessing.Queue()
+        for buffer_index in xrange(queue_depth):
+            self._free_buffers.put(buffer_index)
+        self._messages = multiprocessing.Queue(queue_depth)
+        self._batch = list()
+
+    def send(self, item):
+        """
+        Send an item to the parent process. It is sent once the batch is full
+            or the channel is flushed.
+        @param item: A picklable item.
+        """
+        if isinstance(item, array.array):
+            item = _PackedArray(item.typecode, item.tostring())
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the current batch, waiting for a free buffer if necessary.
+        """
+        if not self._batch:
+            return
+        data = cPickle.dumps(self._batch, cPickle.HIGHEST_PROTOCOL)
+        self._batch = list()
+        if len(data) > self.buffer_size:
+            self._messages.put((_INLINE_BATCH, data))
+            return
+        buffer_index = self._free_buffers.get()
+        ctypes.memmove(self._buffers[buffer_index], data, len(data))
+        self._messages.put((_BUFFERED_BATCH, (buffer_index, len(data))))
+
+    def _finish(self, task_index):
+        """
+        Send the last batch of a task and tell the parent it is done.
+        @param task_index: The _task_index of the task.
+        """
+        self.flush()
+        self._messages.put((_TASK_DONE, task_index))
+
+    def _fail(self, task_index, tb):
+        """
+        Tell the parent that a task raised an exception. Items in the current
+            batch are discarded.
+        @param task_index: The _task_index of the task.
+        @param tb: The formatted traceback.
+        """
+        self._batch = list()
+        self._messages.put((_TASK_FAILED, (task_index, tb)))
+
+    def _receive(self, timeout):
+        """
+        Receive the next message in the parent process.
+        @param timeout: Number of seconds to wait for a message.
+        @return: A list of items, or the index of a task that is done.
+        @raise Queue.Empty: If no message arrived within the timeout.
+        @raise TaskError: If a task raised an exception.
+        """
+        kind, payload = self._messages.get(timeout=timeout)
+        if kind == _TASK_DONE:
+            return payload
+        if kind == _TASK_FAILED:
+            raise TaskError(*payload)
+        if kind == _BUFFERED_BATCH:
+            buffer_index, length = payload
+            data = ctypes.string_at(
+                ctypes.addressof(self._buffers[buffer_index]), length
+            )
+            self._free_buffers.put(buffer_index)
+        else:
+            data = payload
+        return [
+            item.unpack() if isinstance(item, _PackedArray) else item
+            for item in cPickle.loads(data)
+        ]
+
+
+class _PackedArray(object):
+    """
+    The raw contents of an array.array, which pickles far faster than the array
+        itself.
+    """
+    __slots__ = ('typecode', 'data')
+
+    def __init__(self, typecode, data):
+        """
+        Initialize a new instance.
+        @param typecode: The typecode of the array.
+        @param data: The raw bytes of the array.
+        """
+        self.typecode = typecode
+        self.data = data
+
+    def __getstate__(self):
+        return self.typecode, self.data
+
+    def __setstate__(self, state):
+        self.typecode, self.data = state
+
+    def unpack(self):
+        """
+        @return: The array.array.
+        """
+        return array.array(self.typecode, self.data)
 
 
 def do_multi_parse_to_csv(
@@ -46,47 +325,164 @@ def do_multi_parse_to_csv(
         cores_to_reserve=1,
         delimiter=',',
         id_column=None,
-        include_headers=True
+        include_headers=True,
+        file_timeout=None,
+        metrics=None,
+        profile_files=False,
+        profile_code=False,
+        archive=None,
+        document_id_column=None,
+        parse_cache=None,
+        compression=None,
+        corpus_index=None,
+        max_files_per_task=None,
+        max_task_memory=None,
+        memory_per_task=None,
+        schema=None,
+        validation_batch_size=None
 ):
     """
     Parse a collection of files across multiple processes and dump the output
         into a csv.
-    @param file_paths: A collection of file paths containing the data.
+    @param file_paths: A collection of file paths containing the data, or of
+        document ids if an archive is supplied.
     @param output_folder: Location where the results should be written.
     @param task_name: The name to give to the csv output.
     @param parser_func: A function with the signature func(path_to_file) that
         returns a namedtuple object containing a primary key, id, or a
-        collection of such objects.
+        collection of such objects. Large lookup tables the function depends
+        on should be created with dredge.shared so that workers attach to them
+        rather than each receiving a copy.
     @param cores_to_reserve: The number of cores to leave idle.
     @param delimiter: Delimiter to use in csv output.
     @param id_column: None if the data contain no primary key; otherwise, the
         index of the primary key in the namedtuple type produced by parser_func.
     @param include_headers: True if the final output should include headers;
         otherwise, False.
+    @param file_timeout: None if parsing a file may take any amount of time;
+        otherwise, the number of seconds after which a file is abandoned and
+        logged to the error log. A worker that cannot be interrupted is
+        replaced once the file has run WATCHDOG_GRACE_PERIOD seconds longer.
+    @param metrics: An optional dredge.metrics.Metrics object on which to record
+        parse time per file, rows, errors and the number of files each worker
+        has left. Workers record on their own copies, which are merged into
+        this object when they finish.
+    @param profile_files: True if the wall time, CPU time and row count for each
+        file should be written to <task_name>-profile.csv; otherwise, False.
+    @param profile_code: True if parser_func should be run under cProfile in
+        each worker and the merged stats written to <task_name>.prof, for use
+        with the pstats module; otherwise, False.
+    @param archive: None if file_paths are paths on disk; otherwise, a
+        dredge.archive.SegmentArchive containing the documents whose ids are
+        supplied as file_paths. In that case parser_func is called with a
+        read-only buffer over the memory-mapped document rather than a path.
+        Ids whose documents are byte-identical are parsed only once, and the
+        rows are written once for each of the ids.
+    @param document_id_column: None if rows written for identical documents
+        should be exact copies; otherwise, the index of the column in the
+        namedtuple type produced by parser_func that should be set to the
+        archive id of each document. Only used with an archive.
+    @param parse_cache: None if every file should be parsed; otherwise, a
+        dredge.cache.ParseCache from which the rows for files that have been
+        parsed before are replayed instead of calling parser_func. Least
+        recently used entries are evicted from the cache once the job is done.
+    @param compression: None if the csv output should be plain text;
+        otherwise, 'gzip', 'zstd' or 'lz4', in which case the output of each
+        worker and the final output, <task_name>.csv.gz, .csv.zst or .csv.lz4,
+        are compressed with the codec. Each file's rows are written to the
+        output of a worker as a separate member or frame, so the outputs can
+        be concatenated without being decompressed when neither headers nor an
+        id_column are used.
+    @param corpus_index: None if the size of each file should be read from disk
+        for load balancing; otherwise, a dredge.corpus.CorpusIndex from which
+        sizes are taken. File paths must be joined to the index's directory
+        in the same way as its get_paths().
+    @param max_files_per_task: None if a worker may parse any number of files;
+        otherwise, the number of files after which it is replaced with a new
+        worker, e.g., to bound the growth of a parser that leaks memory.
+        Metrics and code profiles recorded by a replaced worker are lost.
+    @param max_task_memory: None if workers may use any amount of memory;
+        otherwise, the resident set size in bytes above which a worker is
+        replaced before parsing its next file.
+    @param memory_per_task: None if a worker is started for each available
+        processor; otherwise, the number of bytes each worker is expected to
+        need, so that no more workers are started than fit in the memory
+        available.
+    @param schema: None if rows should be written as parser_func returns them;
+        otherwise, a dict mapping field names to dredge.validation.Column
+        objects. Each worker then collects rows into batches, converts and
+        validates the columns with NumPy before writing them, and logs each
+        invalid row to the error log instead of writing it. Requires numpy.
+    @param validation_batch_size: None to use the default; otherwise, the
+        number of rows each worker validates together. Rows waiting in a batch
+        are lost if the worker is replaced by the watchdog.
     """
+    extension = dredge.compression.get_extension(compression)
+    # parse identical documents in an archive only once
+    if archive is not None:
+        missing_ids = [
+            item_id for item_id in file_paths if item_id not in archive
+        ]
+        duplicate_ids = archive.group_ids_by_content(
+            [item_id for item_id in file_paths if item_id in archive]
+        )
+        file_paths = duplicate_ids.keys()
+    else:
+        missing_ids = list()
+        duplicate_ids = None
     # balance the load across all tasks
-    task_count = get_num_tasks(cores_to_reserve, file_paths)
+    task_count = get_num_tasks(cores_to_reserve, file_paths, memory_per_task)
+    # reserve the cores memory does not allow, so the task count is stable
+    cores_to_reserve = max(CPU_COUNT - task_count, 0)
+    if archive is not None:
+        file_sizes = archive.get_sizes()
+    elif corpus_index is not None:
+        file_sizes = corpus_index.get_file_sizes()
+    else:
+        file_sizes = None
     sorted_file_paths = sort_file_paths_for_load_balancing(
-        file_paths, task_count
+        file_paths, task_count, file_sizes=file_sizes
     )
     # get the csv headers by just parsing a test file
     if include_headers:
         test_entry = None
         i = 0
         while not test_entry:
-            test_entry = parser_func(sorted_file_paths[i])
+            try:
+                with _time_limit(file_timeout):
+                    test_entry = parser_func(
+                        sorted_file_paths[i] if archive is None
+                        else archive.get(sorted_file_paths[i])
+                    )
+            except ParseTimeoutError:
+                pass
             i += 1
         if hasattr(test_entry, '_fields'):
             csv_headers = test_entry._fields
         else:
             csv_headers = test_entry[0]._fields
+        # report a schema that does not match the rows before starting workers
+        if schema is not None:
+            importlib.import_module('dredge.validation').check_schema(
+                schema, csv_headers
+            )
     else:
         csv_headers = None
     # ensure the output directory exists
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    # ids missing from the archive are logged as errors rather than parsed
+    if missing_ids:
+        _log_task_errors(
+            [[item_id, 'missing from archive'] for item_id in missing_ids],
+            0, output_folder, task_name
+        )
+    # remove worker stats left by earlier runs so they are not merged
+    if profile_code:
+        for stats_path in _get_stats_paths(output_folder, task_name):
+            os.remove(stats_path)
     # do the multiprocess
-    do_multi_process(
+    results = do_multi_process(
         sorted_file_paths,
         functools.partial(
             _dump_into_csv_task,
@@ -94,22 +490,53 @@ def do_multi_parse_to_csv(
             task_name=task_name,
             parser_func=parser_func,
             csv_headers=csv_headers,
-            delimiter=delimiter
+            delimiter=delimiter,
+            file_timeout=file_timeout,
+            metrics=metrics,
+            profile_files=profile_files,
+            profile_code=profile_code,
+            archive=archive,
+            duplicate_ids=duplicate_ids,
+            document_id_column=document_id_column,
+            parse_cache=parse_cache,
+            compression=compression,
+            schema=schema,
+            validation_batch_size=validation_batch_size
         ),
-        cores_to_reserve=cores_to_reserve
+        cores_to_reserve=cores_to_reserve,
+        item_timeout=(
+            None if file_timeout is None
+            else file_timeout + WATCHDOG_GRACE_PERIOD
+        ),
+        on_item_timeout=functools.partial(
+            _log_stalled_file, output_folder=output_folder, task_name=task_name,
+            duplicate_ids=duplicate_ids
+        ),
+        max_items_per_task=max_files_per_task,
+        max_task_memory=max_task_memory
     )
+    if metrics is not None:
+        for path_to_csv, snapshot in results:
+            metrics.merge(snapshot)
+        metrics.flush()
+    if parse_cache is not None:
+        parse_cache.evict()
     # clear out any large objects that may be attached to the parser function
     del(parser_func)
     # stitch output files together
     merge_csv_files(
         input_paths=[
-            os.path.join(output_folder, '%s-%i.csv' % (task_name, i))
-            for i in xrange(task_count)
+            os.path.join(
+                output_folder, '%s-%i.csv%s' % (task_name, i, extension)
+            ) for i in xrange(task_count)
         ],
-        output_path=os.path.join(output_folder, '%s.csv' % task_name),
+        output_path=os.path.join(
+            output_folder, '%s.csv%s' % (task_name, extension)
+        ),
         delimiter=delimiter,
         headers=csv_headers,
-        id_column=id_column
+        id_column=id_column,
+        remove_inputs=True
     )
     # stitch error logs together
     merge_csv_files(
@@ -119,54 +546,292 @@ def do_multi_parse_to_csv(
         ],
         output_path=os.path.join(output_folder, '%s-errors.csv' % task_name),
         delimiter=',',
-        headers=ERROR_LOG_HEADERS
+        headers=ERROR_LOG_HEADERS,
+        remove_inputs=True
     )
-    # remove intermediate files
-    for i in xrange(task_count):
-        path_to_csv = os.path.join(output_folder, '%s-%i.csv' % (task_name, i))
-        os.remove(path_to_csv)
-        path_to_error_log = os.path.join(
-            output_folder, '%s-%i-errors.csv' % (task_name, i)
+    # stitch profiling output together
+    if profile_files:
+        merge_csv_files(
+            input_paths=[
+                os.path.join(
+                    output_folder, '%s-%i-profile.csv' % (task_name, i)
+                ) for i in xrange(task_count)
+            ],
+            output_path=os.path.join(
+                output_folder, '%s-profile.csv' % task_name
+            ),
+            delimiter=',',
+            headers=PROFILE_LOG_HEADERS,
+            remove_inputs=True
         )
-        os.remove(path_to_error_log)
+    if profile_code:
+        stats_paths = _get_stats_paths(output_folder, task_name)
+        stats = pstats.Stats(*stats_paths)
+        stats.dump_stats(os.path.join(output_folder, '%s.prof' % task_name))
+        for stats_path in stats_paths:
+            os.remove(stats_path)
 
 
-def do_multi_process(data, task, cores_to_reserve=1, **kwargs):
+def do_multi_process(
+        data, task, cores_to_reserve=1,
+        item_timeout=None, on_item_timeout=None,
+        max_items_per_task=None, max_task_memory=None, memory_per_task=None,
+        **kwargs
+):
     """
     Perform a task on a tuple of data over all available processors.
     @param data: A tuple of data to process.
     @param task: A task with the signature:
         (data, slice_start, slice_end, result_queue, kwargs). The keyword
-        argument '_task_index' is also sent to each task.
+        argument '_task_index' is also sent to each task. If item_timeout,
+        max_items_per_task or max_task_memory is set, the keyword argument
+        '_task_progress' is also sent to each task; see TaskProgress.
     @param cores_to_reserve: The number of cores to leave idle.
+    @param item_timeout: None if no watchdog should be used; otherwise, the
+        number of seconds a task may spend on a single item. A worker that
+        exceeds this time or dies before putting its result is terminated and
+        replaced with a new worker for the rest of its slice, starting after
+        the item that stalled. Anything the terminated worker was holding in
+        memory is lost, so tasks run this way should write their output as
+        they go, as _dump_into_csv_task() does.
+    @param on_item_timeout: Optional function with the signature
+        func(item, task_index, reason) that is called in this process for each
+        item skipped by the watchdog.
+    @param max_items_per_task: None if a worker may process any number of
+        items; otherwise, the number of items after which a worker is replaced
+        with a new one for the rest of its slice. Like the watchdog, this loses
+        anything the worker was holding in memory, but returns any memory it
+        leaked or fragmented to the system.
+    @param max_task_memory: None if workers may use any amount of memory;
+        otherwise, the resident set size in bytes above which a worker is
+        replaced before starting its next item.
+    @param memory_per_task: None if the number of workers depends only on the
+        processors available; otherwise, the number of bytes each worker is
+        expected to need, so that no more workers are started than fit in the
+        memory available.
     @param kwargs: Any additional keyword arguments for task.
     @return: A list containing all of the workers' results.
+    @raise TaskError: If no watchdog or budget is used and a worker exits with
+        a non-zero code before every result has arrived.
     """
     # determine how to cut up work load
-    num_tasks = get_num_tasks(cores_to_reserve, data)
+    num_tasks = get_num_tasks(cores_to_reserve, data, memory_per_task)
     slice_ranges = get_multiprocess_slice_ranges(num_tasks, len(data))
     # start a worker for each CPU
     results_queue = multiprocessing.Queue()
+    if (
+        item_timeout is not None or max_items_per_task is not None or
+        max_task_memory is not None
+    ):
+        kwargs['_task_progress'] = TaskProgress(
+            slice_ranges, max_items_per_task, max_task_memory
+        )
+    progress = kwargs.get('_task_progress')
     consumers = [
-        multiprocessing.Process(
-            target=task,
-            args=(data, slice_ranges[x][0], slice_ranges[x][1], results_queue),
-            kwargs=dict(kwargs.items() + [('_task_index', x)])
+        _start_worker(
+            data, task, slice_ranges[x][0], slice_ranges[x][1], results_queue,
+            kwargs, x
         ) for x in xrange(num_tasks)
     ]
-    for worker in consumers:
-        worker.start()
     results = list()
-    while num_tasks:
-        result = results_queue.get()
-        results.append(result)
-        num_tasks -= 1
+    while len(results) < num_tasks:
+        try:
+            results.append(results_queue.get(timeout=WATCHDOG_POLL_INTERVAL))
+        except Queue.Empty:
+            if progress is None:
+                # a worker that exits without its result would never send it
+                _check_workers(consumers)
+                continue
+        if progress is None:
+            continue
+        # replace any workers that have stalled or died without a result
+        for x, worker in enumerate(consumers):
+            if worker is None or worker.exitcode == 0:
+                continue
+            if worker.exitcode == RECYCLE_EXIT_CODE:
+                # resume from the item the recycled worker did not start
+                worker.join()
+                consumers[x] = _start_worker(
+                    data, task, progress.current_items[x], slice_ranges[x][1],
+                    results_queue, kwargs, x
+                )
+                continue
+            if worker.exitcode is None:
+                if (
+                    item_timeout is None or
+                    not progress.is_stalled(x, item_timeout)
+                ):
+                    continue
+                worker.terminate()
+                worker.join()
+                reason = 'timeout: exceeded %s seconds' % item_timeout
+            else:
+                reason = 'worker exited with code %i' % worker.exitcode
+            item_index = progress.current_items[x]
+            if item_index < slice_ranges[x][1] and on_item_timeout is not None:
+                on_item_timeout(data[item_index], x, reason)
+            progress.finish(x)
+            consumers[x] = _start_worker(
+                data, task, min(item_index + 1, slice_ranges[x][1]),
+                slice_ranges[x][1], results_queue, kwargs, x
+            )
     return results
 
 
+def do_multi_process_iter(
+        data, task, cores_to_reserve=1,
+        batch_size=DEFAULT_BATCH_SIZE,
+        queue_depth=DEFAULT_CHANNEL_DEPTH,
+        buffer_size=DEFAULT_CHANNEL_BUFFER_SIZE,
+        **kwargs
+):
+    """
+    Perform a task on a tuple of data over all available processors, streaming
+        the results as the tasks produce them rather than collecting one
+        result per task.
+    @param data: A tuple of data to process.
+    @param task: A task with the signature:
+        (data, slice_start, slice_end, result_queue, kwargs). The keyword
+        arguments '_task_index' and '_result_channel' are also sent to each
+        task. Tasks should pass their results to the send() method of the
+        ResultChannel; anything put in result_queue is discarded.
+    @param cores_to_reserve: The number of cores to leave idle.
+    @param batch_size: The number of items workers collect before sending.
+    @param queue_depth: The number of batches that may wait to be read before
+        workers block.
+    @param buffer_size: The size in bytes of each shared buffer.
+    @param kwargs: Any additional keyword arguments for task.
+    @return: A generator of the items sent by the tasks. Items from one task
+        arrive in the order sent, interleaved with those of other tasks.
+        Workers are terminated if the generator is closed early.
+    @raise TaskError: If a task raises an exception or its worker exits before
+        the task is done, once the items it sent have been generated.
+    """
+    num_tasks = get_num_tasks(cores_to_reserve, data)
+    slice_ranges = get_multiprocess_slice_ranges(num_tasks, len(data))
+    channel = ResultChannel(batch_size, queue_depth, buffer_size)
+    kwargs['_result_channel'] = channel
+    consumers = [
+        _start_worker(
+            data, functools.partial(_channel_task, task),
+            slice_ranges[x][0], slice_ranges[x][1], Queue.Queue(), kwargs, x
+        ) for x in xrange(num_tasks)
+    ]
+    done_tasks = set()
+    try:
+        while len(done_tasks) < num_tasks:
+            try:
+                message = channel._receive(WATCHDOG_POLL_INTERVAL)
+            except Queue.Empty:
+                # a worker that exits without saying so was killed
+                _check_workers(consumers, done_tasks)
+                continue
+            if isinstance(message, list):
+                for item in message:
+                    yield item
+            else:
+                done_tasks.add(message)
+    finally:
+        for worker in consumers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def do_multi_reduce(
+        data, map_func, reduce_func, cores_to_reserve=1, on_error=None
+):
+    """
+    Aggregate a tuple of data by key over all available processors without
+        materializing intermediate rows. Each worker maps its items to key-value
+        pairs and combines the values for each key as it goes, and the partial
+        aggregates of the workers are then combined in this process.
+    @param data: A tuple of data to process.
+    @param map_func: A function with the signature func(item) that returns an
+        iterable of (key, value) pairs, e.g., a generator over the rows a
+        parser produces for a file. Keys and values must be picklable.
+    @param reduce_func: A function with the signature func(value, value) that
+        combines two values for the same key, e.g., operator.add. It must be
+        associative. Values are combined in the order of their items in data,
+        so it need not be commutative.
+    @param cores_to_reserve: The number of cores to leave idle.
+    @param on_error: None if a MapError should be raised when map_func fails on
+        an item; otherwise, a function with the signature func(item, tb) that
+        is called in this process for each such item, which is then skipped.
+    @return: A dict mapping each key to its combined value.
+    @raise TaskError: If a worker fails other than in map_func or reduce_func,
+        e.g., if its aggregate cannot be pickled.
+    """
+    # combine the partial aggregates in the order of the workers' slices
+    partials = sorted(
+        do_multi_process(
+            data, _map_reduce_task, cores_to_reserve=cores_to_reserve,
+            map_func=map_func, reduce_func=reduce_func
+        ),
+        key=lambda partial: partial[0]
+    )
+    aggregate = dict()
+    for task_index, partial, errors in partials:
+        if partial is None:
+            raise TaskError(task_index, errors)
+        partial = cPickle.loads(partial)
+        for item, tb in errors:
+            if on_error is None:
+                raise MapError(item, tb)
+            on_error(item, tb)
+        _combine(aggregate, partial.iteritems(), reduce_func)
+    return aggregate
+
+
+def _check_workers(consumers, done_tasks=()):
+    """
+    Raise an error if a worker has exited with a non-zero code.
+    @param consumers: The worker processes, indexed by task.
+    @param done_tasks: The indices of tasks that are known to be done.
+    @raise TaskError: If a worker of a task that is not done has failed.
+    """
+    for x, worker in enumerate(consumers):
+        if x not in done_tasks and worker.exitcode not in (None, 0):
+            raise TaskError(x, 'worker exited with code %i' % worker.exitcode)
+
+
+def _start_worker(
+        data, task, slice_start, slice_end, results_queue, kwargs, task_index
+):
+    """
+    Start a worker process for one slice of a multiprocess job.
+    @param data: A tuple of data to process.
+    @param task: The task to perform on the data.
+    @param slice_start: The start for the range to be processed.
+    @param slice_end: The end of the range to be processed.
+    @param results_queue: The queue into which the result should be placed.
+    @param kwargs: Any additional keyword arguments for task.
+    @param task_index: The index of the slice in the job.
+    @return: The started multiprocessing.Process.
+    """
+    worker = multiprocessing.Process(
+        target=task,
+        args=(data, slice_start, slice_end, results_queue),
+        kwargs=dict(kwargs.items() + [('_task_index', task_index)])
+    )
+    worker.start()
+    return worker
+
+
 def _dump_into_csv_task(
         file_paths, slice_start, slice_end, result_queue,
         output_folder, task_name, csv_headers, delimiter, parser_func,
+        file_timeout=None,
+        metrics=None,
+        profile_files=False,
+        profile_code=False,
+        archive=None,
+        duplicate_ids=None,
+        document_id_column=None,
+        parse_cache=None,
+        compression=None,
+        schema=None,
+        validation_batch_size=None,
         **kwargs
 ):
     """
@@ -182,14 +847,49 @@ def _dump_into_csv_task(
     @param parser_func: A function with the signature func(path_to_file) that
         returns a namedtuple object whose 0th element is a primary key, or a
         collection of such objects.
+    @param file_timeout: None if parsing a file may take any amount of time;
+        otherwise, the number of seconds after which a file is abandoned.
+    @param metrics: None if no metrics should be recorded; otherwise, a
+        dredge.metrics.Metrics object from which a collector for this task is
+        created. The task's result is then a tuple of (path_to_csv, snapshot).
+    @param profile_files: True if the time taken and rows produced for each file
+        should be logged; otherwise, False.
+    @param profile_code: True if parser_func should be run under cProfile and
+        the stats dumped for the task; otherwise, False.
+    @param archive: None if file_paths are paths on disk; otherwise, a
+        dredge.archive.SegmentArchive from which documents are read by id.
+    @param duplicate_ids: None if each file is parsed for itself; otherwise, a
+        dict mapping each file path to the list of ids whose documents are
+        identical to it, for which its rows should be written.
+    @param document_id_column: None or the index of the column to set to each
+        id in duplicate_ids.
+    @param parse_cache: None or a dredge.cache.ParseCache in which to look up
+        and store the rows for each file.
+    @param compression: None, or the codec with which to compress the csv
+        output. Rows are staged uncompressed and compressed in one stream
+        once the slice is done, so that rows written before a worker is
+        replaced are kept and the output holds one member or frame per task.
+    @param schema: None, or a dict mapping field names to
+        dredge.validation.Column objects with which to validate rows.
+    @param validation_batch_size: None, or the number of rows to validate
+        together.
     @param kwargs: Method signature requirement.
     """
-    # create csv if it doesn't exist
+    progress = kwargs.get('_task_progress')
+    if metrics is not None:
+        metrics = metrics.child(task=kwargs['_task_index'])
+    csv_name = '%s-%i.csv' % (task_name, kwargs['_task_index'])
     path_to_csv = os.path.join(
-        output_folder, '%s-%i.csv' % (task_name, kwargs['_task_index'])
+        output_folder,
+        csv_name + dredge.compression.get_extension(compression)
     )
-    if not os.path.exists(path_to_csv):
-        with open(path_to_csv, 'w+') as csv_file:
+    if compression is None:
+        staging_path = path_to_csv
+    else:
+        staging_path = os.path.join(output_folder, csv_name + '.part')
+    # create csv if it doesn't exist
+    if not os.path.exists(path_to_csv) and not os.path.exists(staging_path):
+        with open(staging_path, 'wb') as csv_file:
             if csv_headers is not None:
                 csv.writer(csv_file, delimiter=delimiter).writerow(csv_headers)
     # create error log if it doesn't exist
@@ -199,23 +899,331 @@ def _dump_into_csv_task(
     if not os.path.exists(error_path):
         with open(error_path, 'w+') as error_file:
             csv.writer(error_file).writerow(ERROR_LOG_HEADERS)
+    # create profile log if it doesn't exist
+    if profile_files:
+        profile_path = os.path.join(
+            output_folder,
+            '%s-%i-profile.csv' % (task_name, kwargs['_task_index'])
+        )
+        if not os.path.exists(profile_path):
+            with open(profile_path, 'w+') as profile_file:
+                csv.writer(profile_file).writerow(PROFILE_LOG_HEADERS)
+    profiler = cProfile.Profile() if profile_code else None
+    # errors are written in the background, since many may fail in a row
+    error_log = dredge.errorlog.ErrorLog(error_path)
+
+    def write_rows(rows):
+        with open(staging_path, 'ab') as csv_file:
+            csv.writer(csv_file, delimiter=delimiter).writerows(rows)
+
+    def log_invalid_row(item_id, message):
+        error_log.log(item_id, message)
+        if metrics is not None:
+            metrics.increment('parse.invalid_rows')
+
+    def record_rows(file_path, start_time, start_cpu_time, row_count):
+        if metrics is not None:
+            metrics.increment('parse.rows', row_count)
+        if profile_files:
+            with open(profile_path, 'a+') as profile_file:
+                csv.writer(profile_file).writerow([
+                    file_path,
+                    time.time() - start_time,
+                    _get_cpu_time() - start_cpu_time,
+                    row_count
+                ])
+
+    # numpy is imported here so that jobs without a schema do not load it
+    if schema is not None:
+        validation = importlib.import_module('dredge.validation')
+        validator = validation.RowValidator(
+            schema, write_rows, log_invalid_row,
+            validation_batch_size or validation.DEFAULT_BATCH_SIZE
+        )
+    else:
+        validator = None
     # write each entry to the csv
     for i in xrange(slice_start, slice_end):
         file_path = file_paths[i]
+        if progress is not None:
+            progress.start_item(kwargs['_task_index'], i)
+        if metrics is not None:
+            metrics.set_gauge('parse.pending', slice_end - i)
+        start_time = time.time()
+        start_cpu_time = _get_cpu_time()
+        item_ids = (
+            [file_path] if duplicate_ids is None else duplicate_ids[file_path]
+        )
         try:
-            entry = parser_func(file_path)
+            with _time_limit(file_timeout):
+                document = file_path if archive is None else archive.get(
+                    file_path
+                )
+                entry = None
+                if parse_cache is not None:
+                    if archive is None:
+                        cache_key = parse_cache.get_file_key(file_path)
+                    else:
+                        cache_key = parse_cache.get_document_key(document)
+                    entry = parse_cache.get(cache_key)
+                    if metrics is not None:
+                        metrics.increment(
+                            'parse.cache_misses' if entry is None
+                            else 'parse.cache_hits'
+                        )
+                if entry is None:
+                    if profiler is None:
+                        entry = parser_func(document)
+                    else:
+                        entry = profiler.runcall(parser_func, document)
+                    if parse_cache is not None:
+                        parse_cache.put(cache_key, entry)
+        except ParseTimeoutError:
+            for item_id in item_ids:
+                error_log.log(
+                    item_id, 'timeout: exceeded %s seconds' % file_timeout
+                )
+            if metrics is not None:
+                metrics.increment('parse.timeouts')
         except Exception as e:
-            tb = traceback.format_exc()
-            with open(error_path, 'a+') as error_file:
-                csv.writer(error_file).writerow([file_path, tb])
-            continue
-        with open(path_to_csv, 'a+') as csv_file:
-            if hasattr(entry, '_fields'):
-                csv.writer(csv_file, delimiter=delimiter).writerow(entry)
+            for item_id in item_ids:
+                error_log.log(item_id)
+            if metrics is not None:
+                metrics.increment('parse.errors')
+        else:
+            rows = (entry,) if hasattr(entry, '_fields') else entry
+            row_ids = [item_id for item_id in item_ids for row in rows]
+            if duplicate_ids is not None:
+                rows = _fan_out_rows(rows, item_ids, document_id_column)
+            if metrics is not None:
+                metrics.observe('parse.file_time', time.time() - start_time)
+                metrics.increment('parse.files')
+            if validator is None:
+                write_rows(rows)
+                record_rows(file_path, start_time, start_cpu_time, len(rows))
             else:
-                csv.writer(csv_file, delimiter=delimiter).writerows(entry)
+                # rows are counted once the validator has accepted them
+                validator.add(
+                    row_ids, rows, functools.partial(
+                        record_rows, file_path, start_time, start_cpu_time
+                    )
+                )
+            continue
+        record_rows(file_path, start_time, start_cpu_time, 0)
     # rejoin the main thread
-    result_queue.put(path_to_csv)
+    if validator is not None:
+        validator.close()
+    error_log.close()
+    if staging_path != path_to_csv and os.path.exists(staging_path):
+        with open(staging_path, 'rb') as staged_file:
+            with dredge.compression.open_file(path_to_csv, 'ab') as csv_file:
+                dredge.compression.copy_contents(staged_file, csv_file)
+        os.remove(staging_path)
+    if progress is not None:
+        progress.finish(kwargs['_task_index'])
+    if profiler is not None:
+        profiler.dump_stats(
+            os.path.join(
+                output_folder, '%s-%i-%i.prof' % (
+                    task_name, kwargs['_task_index'], os.getpid()
+                )
+            )
+        )
+    if metrics is None:
+        result_queue.put(path_to_csv)
+    else:
+        metrics.set_gauge('parse.pending', 0)
+        metrics.flush()
+        result_queue.put((path_to_csv, metrics.snapshot()))
+
+
+def _channel_task(
+        task, data, slice_start, slice_end, result_queue, **kwargs
+):
+    """
+    Run a task and then flush its ResultChannel, or report the exception if
+        it raises one.
+    @param task: The task to perform on the data.
+    @param data: A tuple of data to process.
+    @param slice_start: The start for the range to be processed.
+    @param slice_end: The end of the range to be processed.
+    @param result_queue: A queue whose contents are discarded.
+    @param kwargs: Any additional keyword arguments for task, including
+        '_result_channel' and '_task_index'.
+    """
+    channel = kwargs['_result_channel']
+    try:
+        task(data, slice_start, slice_end, result_queue, **kwargs)
+    except Exception:
+        channel._fail(kwargs['_task_index'], traceback.format_exc())
+        raise
+    channel._finish(kwargs['_task_index'])
+
+
+def _map_reduce_task(
+        data, slice_start, slice_end, result_queue, map_func, reduce_func,
+        **kwargs
+):
+    """
+    A task to map a slice of data to key-value pairs and combine them by key.
+    @param data: A tuple of data to process.
+    @param slice_start: The start for the range to be processed.
+    @param slice_end: The end of the range to be processed.
+    @param result_queue: The queue into which the result should be placed.
+    @param map_func: A function with the signature func(item) that returns an
+        iterable of (key, value) pairs.
+    @param reduce_func: An associative function with the signature
+        func(value, value) that combines two values.
+    @param kwargs: Method signature requirement.
+    """
+    try:
+        aggregate = dict()
+        errors = list()
+        for i in xrange(slice_start, slice_end):
+            # map the whole item first so a map failure leaves no partial
+            # values; a reduce failure may leave values of the item combined
+            try:
+                _combine(aggregate, list(map_func(data[i])), reduce_func)
+            except Exception:
+                errors.append((data[i], traceback.format_exc()))
+        # pickle here, since the queue would drop an unpicklable result
+        result = (
+            kwargs['_task_index'],
+            cPickle.dumps(aggregate, cPickle.HIGHEST_PROTOCOL),
+            errors
+        )
+    except Exception:
+        result = (kwargs['_task_index'], None, traceback.format_exc())
+    result_queue.put(result)
+
+
+def _combine(aggregate, pairs, reduce_func):
+    """
+    Combine key-value pairs into an aggregate.
+    @param aggregate: A dict mapping keys to combined values, which is updated.
+    @param pairs: An iterable of (key, value) pairs.
+    @param reduce_func: An associative function with the signature
+        func(value, value) that combines two values.
+    """
+    for key, value in pairs:
+        if key in aggregate:
+            aggregate[key] = reduce_func(aggregate[key], value)
+        else:
+            aggregate[key] = value
+
+
+def _fan_out_rows(rows, item_ids, document_id_column):
+    """
+    Repeat the rows parsed from a document for each id that shares it.
+    @param rows: A collection of namedtuple objects.
+    @param item_ids: The ids of the documents the rows were parsed from.
+    @param document_id_column: None if the rows should be repeated as they are;
+        otherwise, the index of the column to set to each id.
+    @return: A list of namedtuple objects.
+    """
+    if document_id_column is None:
+        return [row for item_id in item_ids for row in rows]
+    return [
+        row._replace(**{row._fields[document_id_column]: item_id})
+        for item_id in item_ids for row in rows
+    ]
+
+
+def _get_stats_paths(output_folder, task_name):
+    """
+    Get the paths to the profiler stats dumped by the workers of a task.
+    @param output_folder: Location where the results are written.
+    @param task_name: Name given to output files.
+    @return: A list of paths to the stats files.
+    """
+    stats_file_name_match = re.compile(
+        re.escape(task_name) + r'-\d+-\d+[.]prof$'
+    )
+    return [
+        os.path.join(output_folder, file_name)
+        for file_name in os.listdir(output_folder)
+        if stats_file_name_match.match(file_name)
+    ]
+
+
+def _get_cpu_time():
+    """
+    @return: The user and system CPU time used by this process, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _log_stalled_file(
+        file_path, task_index, reason, output_folder, task_name,
+        duplicate_ids=None
+):
+    """
+    Record a file skipped by the watchdog in the error log of its task.
+    @param file_path: Path to the file that stalled.
+    @param task_index: The index of the task that was parsing the file.
+    @param reason: Description of why the file was skipped.
+    @param output_folder: Location where the results are being written.
+    @param task_name: Name given to output files.
+    @param duplicate_ids: None if each file is parsed for itself; otherwise, a
+        dict mapping each file path to the list of ids whose documents are
+        identical to it, all of which are logged.
+    """
+    _log_task_errors(
+        [
+            [item_id, reason] for item_id in (
+                [file_path] if duplicate_ids is None
+                else duplicate_ids[file_path]
+            )
+        ],
+        task_index, output_folder, task_name
+    )
+
+
+def _log_task_errors(rows, task_index, output_folder, task_name):
+    """
+    Append rows to the error log of a task from this process.
+    @param rows: A list of (id, error) rows.
+    @param task_index: The index of the task whose log should be written.
+    @param output_folder: Location where the results are being written.
+    @param task_name: Name given to output files.
+    """
+    error_path = os.path.join(
+        output_folder, '%s-%i-errors.csv' % (task_name, task_index)
+    )
+    is_new_log = not os.path.exists(error_path)
+    with open(error_path, 'a+') as error_file:
+        if is_new_log:
+            csv.writer(error_file).writerow(ERROR_LOG_HEADERS)
+        csv.writer(error_file).writerows(rows)
+
+
+@contextlib.contextmanager
+def _time_limit(seconds):
+    """
+    Raise ParseTimeoutError if the body of the with statement takes too long.
+        This has no effect if seconds is None, the platform lacks interval
+        timers or this is not the main thread, which alone may handle signals;
+        in those cases only the watchdog in do_multi_process applies.
+    @param seconds: None or the number of seconds allowed.
+    """
+    if seconds is None or not hasattr(signal, 'setitimer'):
+        yield
+        return
+
+    def handle_alarm(signum, frame):
+        raise ParseTimeoutError()
+    try:
+        previous_handler = signal.signal(signal.SIGALRM, handle_alarm)
+    except ValueError:
+        yield
+        return
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
 
 
 def get_multiprocess_slice_ranges(num_tasks, data_count):
@@ -236,21 +1244,33 @@ def get_multiprocess_slice_ranges(num_tasks, data_count):
     )
 
 
-def get_num_tasks(cores_to_reserve, data):
+def get_num_tasks(cores_to_reserve, data, memory_per_task=None):
     """
     Get the number of tasks based on the desired parameters.
     @param cores_to_reserve: Number of cores to not set on the process.
     @param data: The data to be processed.
+    @param memory_per_task: None if memory should not limit the number of
+        tasks; otherwise, the number of bytes each task is expected to need.
     @return: The number of tasks over which the process will be distributed.
     """
-    return min(max(CPU_COUNT - cores_to_reserve, 1), len(data))
+    task_count = max(CPU_COUNT - cores_to_reserve, 1)
+    if memory_per_task is not None:
+        available_memory = dredge.resources.get_available_memory()
+        if available_memory is not None:
+            task_count = min(
+                task_count, max(int(available_memory // memory_per_task), 1)
+            )
+    return min(task_count, len(data))
 
 
 def merge_csv_files(
-        input_paths, output_path, delimiter, headers=None, id_column=None
+        input_paths, output_path, delimiter, headers=None, id_column=None,
+        remove_inputs=False
 ):
     """
-    Stitch together multiple csv files.
+    Stitch together multiple csv files. Files whose paths end with .gz, .zst or
+        .lz4 are decompressed and compressed as they are streamed. See
+        dredge.compression.
     @param input_paths: Collection of paths to files to stitch.
     @param output_path: Path where the final output should be saved.
     @param delimiter: Delimiter used in the input files.
@@ -262,50 +1282,85 @@ def merge_csv_files(
         otherwise, if a numeric value is supplied, the column with this index is
         presumed to be a primary key, and only the first item with the id will
         be included in the merged result.
+    @param remove_inputs: True if the input files should be deleted once they
+        have been merged; otherwise, False.
     """
-    final_output = open(output_path, 'w+')
-    writer = csv.writer(final_output, delimiter=delimiter)
-    are_headers_written = False
-    if id_column is None:
-        for input_file in input_paths:
-            with open(input_file) as csv_file:
-                reader = csv.reader(csv_file, delimiter=delimiter)
-                if headers is not None:
-                    if not are_headers_written:
-                        writer.writerow(reader.next())
-                        are_headers_written = True
-                    else:
-                        reader.next()
-                for row in reader:
-                    writer.writerow(row)
+    output_codec = dredge.compression.get_codec(output_path)
+    if id_column is None and headers is None and output_codec is not None and (
+        all(
+            dredge.compression.get_codec(input_file) == output_codec
+            for input_file in input_paths
+        )
+    ):
+        # compressed members and frames can be concatenated as they are
+        with open(output_path, 'wb') as final_output:
+            for input_file in input_paths:
+                with open(input_file, 'rb') as compressed_file:
+                    dredge.compression.copy_contents(
+                        compressed_file, final_output
+                    )
+    elif id_column is None:
+        # without ids to check, rows can be copied without being parsed
+        with dredge.compression.open_file(output_path, 'wb') as final_output:
+            last_character = None
+            for input_file in input_paths:
+                with dredge.compression.open_file(input_file) as csv_file:
+                    if headers is not None:
+                        header_row = csv_file.readline()
+                        if last_character is None:
+                            final_output.write(header_row)
+                            last_character = header_row[-1:] or None
+                    if last_character not in (None, '\n'):
+                        final_output.write('\r\n')
+                    last_character = dredge.compression.copy_contents(
+                        csv_file, final_output, last_character
+                    )
     else:
+        are_headers_written = False
         ids = set()
+        with dredge.compression.open_file(output_path, 'wb') as final_output:
+            writer = csv.writer(final_output, delimiter=delimiter)
+            for input_file in input_paths:
+                with dredge.compression.open_file(input_file) as csv_file:
+                    reader = csv.reader(csv_file, delimiter=delimiter)
+                    if headers is not None:
+                        if not are_headers_written:
+                            writer.writerow(reader.next())
+                            are_headers_written = True
+                        else:
+                            reader.next()
+                    for row in reader:
+                        if not row[id_column] in ids:
+                            writer.writerow(row)
+                            ids.add(row[id_column])
+    if remove_inputs:
         for input_file in input_paths:
-            with open(input_file) as csv_file:
-                reader = csv.reader(csv_file, delimiter=delimiter)
-                if headers is not None:
-                    if not are_headers_written:
-                        writer.writerow(reader.next())
-                        are_headers_written = True
-                    else:
-                        reader.next()
-                for row in reader:
-                    if not row[id_column] in ids:
-                        writer.writerow(row)
-                        ids.add(row[id_column])
-    final_output.close()
+            os.remove(input_file)
 
 
-def sort_file_paths_for_load_balancing(file_paths, task_count):
+def sort_file_paths_for_load_balancing(
+        file_paths, task_count, file_sizes=None
+):
     """
     Sort a collection of file paths for proper load balancing.
     @param file_paths: A collection of file paths for e.g., XML documents.
+    @param task_count: The number of tasks the files will be divided over.
+    @param file_sizes: None if the size of each file should be read from disk;
+        otherwise, a dict mapping file paths to their sizes, such as from
+        dredge.corpus.CorpusIndex.get_file_sizes(). The sizes of any paths
+        missing from the dict are read from disk.
     @return: A tuple of file paths sorted for load balancing based on file size.
     """
-    # sort files by size
+    # sort files by size, looking each size up only once
+    file_sizes = dict(
+        (
+            file_path,
+            file_sizes[file_path] if file_sizes and file_path in file_sizes
+            else os.stat(file_path).st_size
+        ) for file_path in file_paths
+    )
     file_paths = sorted(
-        file_paths,
-        cmp=lambda x, y: -cmp(os.stat(x).st_size, os.stat(y).st_size)
+        file_paths, key=lambda file_path: -file_sizes[file_path]
     )
     # balance the load across all tasks
     sorted_file_paths = [list() for _ in xrange(task_count)]
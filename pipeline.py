@@ -0,0 +1,323 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains a pipeline that fuses downloading and parsing. Documents
+are handed to parser processes in memory as soon as they are fetched, so that
+network waits in the downloading process overlap with parsing in the workers,
+rather than running mass_download() to completion and then parsing its output
+with do_multi_parse_to_csv().
+"""
+
+import csv
+import multiprocessing
+import os
+import Queue
+import re
+import time
+import dredge.downloader
+import dredge.errorlog
+import dredge.multi
+
+## the default maximum number of fetched documents waiting to be parsed
+DEFAULT_QUEUE_DEPTH = 100
+
+
+def stream_download_and_parse(
+        item_ids, url_template, url_format_expression,
+        output_folder, task_name, parser_func,
+        cores_to_reserve=1,
+        delimiter=',',
+        id_column=None,
+        include_headers=True,
+        download_burst_count=50, sleep_time=30,
+        archive_directory=None,
+        file_extension='xml',
+        opener=None,
+        queue_depth=DEFAULT_QUEUE_DEPTH,
+        metrics=None
+):
+    """
+    Download data for the supplied item_ids and parse each document in a pool
+        of worker processes as soon as it arrives, streaming the rows into a
+        csv. Items whose documents already exist in archive_directory are read
+        from disk instead of being downloaded again.
+    @param item_ids: Collection of ids specifying what is to be downloaded.
+    @param url_template: URL template with formatting entries. E.g.,
+        http://boardgamegeek.com/xmlapi2/collection?user={name}
+    @param url_format_expression: Lambda expression to generate url template
+        kwargs from an id. E.g., lambda item_id: {'name': lookup_table[item_id]}
+    @param output_folder: Location where the results should be written.
+    @param task_name: The name to give to the csv output.
+    @param parser_func: A function with the signature func(document) that takes
+        the downloaded data as a string and returns a namedtuple object or a
+        collection of such objects.
+    @param cores_to_reserve: The number of cores to leave idle.
+    @param delimiter: Delimiter to use in csv output.
+    @param id_column: None if the data contain no primary key; otherwise, the
+        index of the primary key in the namedtuple type produced by parser_func.
+    @param include_headers: True if the final output should include headers;
+        otherwise, False.
+    @param download_burst_count: Number of downloads to execute in succession.
+    @param sleep_time: Number of seconds to sleep between download bursts.
+    @param archive_directory: None if raw documents should not be kept;
+        otherwise, a directory in which to store them as mass_download() does.
+    @param file_extension: Extension to use for archived documents.
+    @param opener: A custom OpenerDirector if required, such as when login
+        credentials must be supplied. See get_credentialed_opener().
+    @param queue_depth: The maximum number of fetched documents waiting to be
+        parsed. Downloading pauses while the queue is full.
+    @param metrics: An optional dredge.metrics.Metrics object on which to record
+        download and parse measurements and the depth of the document queue.
+    @raise dredge.multi.TaskError: If a parser worker exits before sending its
+        result, in which case the other workers are terminated.
+    """
+    # ensure the output directories exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if archive_directory is not None:
+        if not os.path.exists(archive_directory):
+            os.makedirs(archive_directory)
+        file_extension = re.search('[A-Za-z]+', file_extension).group(0)
+    # start the parser workers
+    task_count = max(dredge.multi.CPU_COUNT - cores_to_reserve, 1)
+    document_queue = multiprocessing.Queue(queue_depth)
+    results_queue = multiprocessing.Queue()
+    consumers = [
+        multiprocessing.Process(
+            target=_parse_documents_task,
+            args=(document_queue, results_queue),
+            kwargs={
+                'output_folder': output_folder,
+                'task_name': task_name,
+                'parser_func': parser_func,
+                'delimiter': delimiter,
+                'include_headers': include_headers,
+                'metrics': metrics,
+                '_task_index': x
+            }
+        ) for x in xrange(task_count)
+    ]
+    for worker in consumers:
+        worker.start()
+    results = list()
+    try:
+        # download items and hand them to the workers
+        fetch_error_path = os.path.join(
+            output_folder, '%s-fetch-errors.csv' % task_name
+        )
+        with open(fetch_error_path, 'w+') as error_file:
+            csv.writer(error_file).writerow(dredge.multi.ERROR_LOG_HEADERS)
+        opener_method = dredge.downloader.get_opener_method(opener, metrics)
+        # errors are written in the background, since many may fail in a row
+        with dredge.errorlog.ErrorLog(fetch_error_path) as error_log:
+            download_count = 0
+            for item_id in item_ids:
+                # read archived documents from disk
+                if archive_directory is not None:
+                    path_to_file_on_disk = os.path.join(
+                        archive_directory,
+                        dredge.downloader.get_item_file_name(
+                            item_id, file_extension
+                        )
+                    )
+                    if os.path.exists(path_to_file_on_disk):
+                        with open(path_to_file_on_disk) as file_on_disk:
+                            _put_document(
+                                document_queue,
+                                (item_id, file_on_disk.read()), consumers
+                            )
+                        continue
+                # download the data
+                url = url_template.format(**url_format_expression(item_id))
+                try:
+                    document = opener_method(url).read()
+                except Exception:
+                    print 'error with %s' % item_id
+                    error_log.log(item_id)
+                    if metrics is not None:
+                        metrics.increment('download.errors')
+                else:
+                    if archive_directory is not None:
+                        with open(path_to_file_on_disk, 'w+') as file_on_disk:
+                            file_on_disk.write(document)
+                    _put_document(
+                        document_queue, (item_id, document), consumers
+                    )
+                    if metrics is not None:
+                        metrics.increment('download.items')
+                        _record_queue_depth(document_queue, metrics)
+                # wait between bursts
+                download_count += 1
+                if download_count % download_burst_count == 0:
+                    time.sleep(sleep_time)
+        # tell the workers to finish once the queue is empty
+        for _ in xrange(task_count):
+            _put_document(document_queue, None, consumers)
+        while len(results) < task_count:
+            try:
+                results.append(
+                    results_queue.get(
+                        timeout=dredge.multi.WATCHDOG_POLL_INTERVAL
+                    )
+                )
+            except Queue.Empty:
+                # a worker that exits without its result would never send it
+                dredge.multi._check_workers(consumers)
+    finally:
+        for worker in consumers:
+            if worker.is_alive() and len(results) < task_count:
+                worker.terminate()
+            worker.join()
+    # stitch output files together
+    csv_headers = None
+    for path_to_csv, headers, snapshot in results:
+        csv_headers = csv_headers or headers
+        if metrics is not None:
+            metrics.merge(snapshot)
+    if metrics is not None:
+        metrics.flush()
+    # workers that produced no rows also wrote no headers
+    dredge.multi.merge_csv_files(
+        input_paths=[
+            path_to_csv for path_to_csv, headers, snapshot in results
+            if headers is not None or not include_headers
+        ],
+        output_path=os.path.join(output_folder, '%s.csv' % task_name),
+        delimiter=delimiter,
+        headers=csv_headers if include_headers else None,
+        id_column=id_column
+    )
+    for path_to_csv, headers, snapshot in results:
+        os.remove(path_to_csv)
+    # stitch error logs together
+    dredge.multi.merge_csv_files(
+        input_paths=[fetch_error_path] + [
+            os.path.join(output_folder, '%s-%i-errors.csv' % (task_name, i))
+            for i in xrange(task_count)
+        ],
+        output_path=os.path.join(output_folder, '%s-errors.csv' % task_name),
+        delimiter=',',
+        headers=dredge.multi.ERROR_LOG_HEADERS,
+        remove_inputs=True
+    )
+
+
+def _parse_documents_task(
+        document_queue, result_queue,
+        output_folder, task_name, parser_func, delimiter, include_headers,
+        metrics, **kwargs
+):
+    """
+    A task to parse documents from a queue and dump the data into a csv until
+        it receives None.
+    @param document_queue: A queue of (item_id, document) tuples.
+    @param result_queue: The queue into which the result should be placed.
+    @param output_folder: Location where the results should be written.
+    @param task_name: Name to be given to output files.
+    @param parser_func: A function with the signature func(document) that
+        returns a namedtuple object or a collection of such objects.
+    @param delimiter: Delimiter to use in csv output.
+    @param include_headers: True if the csv should start with headers.
+    @param metrics: None if no metrics should be recorded; otherwise, a
+        dredge.metrics.Metrics object from which a collector for this task is
+        created.
+    @param kwargs: Method signature requirement.
+    @return: Puts a tuple of (path_to_csv, csv_headers, snapshot) in the result
+        queue, where csv_headers is None if no rows were produced and snapshot
+        is None if no metrics were recorded.
+    """
+    if metrics is not None:
+        metrics = metrics.child(task=kwargs['_task_index'])
+    path_to_csv = os.path.join(
+        output_folder, '%s-%i.csv' % (task_name, kwargs['_task_index'])
+    )
+    error_path = os.path.join(
+        output_folder, '%s-%i-errors.csv' % (task_name, kwargs['_task_index'])
+    )
+    with open(error_path, 'w+') as error_file:
+        csv.writer(error_file).writerow(dredge.multi.ERROR_LOG_HEADERS)
+    # errors are written in the background, since many may fail in a row
+    error_log = dredge.errorlog.ErrorLog(error_path)
+    csv_headers = None
+    with open(path_to_csv, 'w+') as csv_file:
+        writer = csv.writer(csv_file, delimiter=delimiter)
+        for item_id, document in iter(document_queue.get, None):
+            start_time = time.time()
+            try:
+                entry = parser_func(document)
+            except Exception:
+                error_log.log(item_id)
+                if metrics is not None:
+                    metrics.increment('parse.errors')
+                continue
+            entries = (entry,) if hasattr(entry, '_fields') else entry
+            if entries and csv_headers is None:
+                csv_headers = entries[0]._fields
+                if include_headers:
+                    writer.writerow(csv_headers)
+            writer.writerows(entries)
+            if metrics is not None:
+                metrics.observe('parse.document_time', time.time() - start_time)
+                metrics.increment('parse.documents')
+                metrics.increment('parse.rows', len(entries))
+    error_log.close()
+    if metrics is not None:
+        metrics.flush()
+    result_queue.put(
+        (
+            path_to_csv, csv_headers,
+            None if metrics is None else metrics.snapshot()
+        )
+    )
+
+
+def _put_document(document_queue, item, consumers):
+    """
+    Put an item in the document queue, waiting while it is full unless a
+        worker has died, in which case it may never be emptied.
+    @param document_queue: The queue of documents.
+    @param item: An (item_id, document) tuple, or None to stop a worker.
+    @param consumers: The worker processes.
+    @raise dredge.multi.TaskError: If a worker has exited with a non-zero code.
+    """
+    while True:
+        try:
+            document_queue.put(
+                item, timeout=dredge.multi.WATCHDOG_POLL_INTERVAL
+            )
+            return
+        except Queue.Full:
+            dredge.multi._check_workers(consumers)
+
+
+def _record_queue_depth(document_queue, metrics):
+    """
+    Record the number of documents waiting to be parsed, if the platform can
+        report it.
+    @param document_queue: The queue of documents.
+    @param metrics: A dredge.metrics.Metrics object.
+    """
+    try:
+        metrics.set_gauge('pipeline.queue_depth', document_queue.qsize())
+    except NotImplementedError:
+        pass
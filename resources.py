@@ -0,0 +1,207 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+
+This module contains functions for finding the processors and memory actually
+available to this process. In containers these are often far less than the
+machine has: the scheduler affinity mask may exclude some processors, and
+control group quotas may limit processor time and memory.
+"""
+
+import math
+import multiprocessing
+import os
+import resource
+
+## root of the control group file system
+CGROUP_ROOT = '/sys/fs/cgroup'
+## cgroup limits at or above this many bytes mean memory is unlimited
+_UNLIMITED_MEMORY = 2 ** 60
+
+
+def get_available_cpu_count(
+        proc_path='/proc/self', cgroup_root=CGROUP_ROOT
+):
+    """
+    Get the number of processors this process may use, respecting its affinity
+        mask and any control group quota on processor time.
+    @param proc_path: Path to the proc directory for this process.
+    @param cgroup_root: Root of the control group file system.
+    @return: The number of processors, at least 1.
+    """
+    counts = [multiprocessing.cpu_count()]
+    affinity_count = _read_affinity_cpu_count(
+        os.path.join(proc_path, 'status')
+    )
+    if affinity_count is not None:
+        counts.append(affinity_count)
+    quota_count = _read_cgroup_cpu_quota(
+        os.path.join(proc_path, 'cgroup'), cgroup_root
+    )
+    if quota_count is not None:
+        counts.append(quota_count)
+    return max(min(counts), 1)
+
+
+def get_available_memory(
+        proc_path='/proc/self', meminfo_path='/proc/meminfo',
+        cgroup_root=CGROUP_ROOT
+):
+    """
+    Get the number of bytes of memory this process may still allocate,
+        respecting any control group memory limit.
+    @param proc_path: Path to the proc directory for this process.
+    @param meminfo_path: Path to the system memory information.
+    @param cgroup_root: Root of the control group file system.
+    @return: The number of bytes, or None if it cannot be determined.
+    """
+    amounts = list()
+    try:
+        with open(meminfo_path) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    amounts.append(int(line.split()[1]) * 1024)
+    except IOError:
+        pass
+    cgroup_path = os.path.join(proc_path, 'cgroup')
+    for limit_name, usage_name, controller in (
+            ('memory.max', 'memory.current', None),
+            ('memory.limit_in_bytes', 'memory.usage_in_bytes', 'memory')
+    ):
+        limit = _read_cgroup_value(
+            cgroup_path, cgroup_root, controller, limit_name
+        )
+        usage = _read_cgroup_value(
+            cgroup_path, cgroup_root, controller, usage_name
+        )
+        if limit not in (None, 'max') and int(limit) < _UNLIMITED_MEMORY:
+            amounts.append(max(int(limit) - int(usage or 0), 0))
+    return min(amounts) if amounts else None
+
+
+def get_rss(proc_path='/proc/self'):
+    """
+    Get the resident set size of this process.
+    @param proc_path: Path to the proc directory for this process.
+    @return: The number of bytes of memory currently resident. Where the proc
+        file system is unavailable, the peak resident set size is returned.
+    """
+    try:
+        with open(os.path.join(proc_path, 'statm')) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux and bytes on OS X
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if os.uname()[0] == 'Darwin' else max_rss * 1024
+
+
+def _read_affinity_cpu_count(status_path):
+    """
+    Count the processors in the affinity mask of a process.
+    @param status_path: Path to the process's status file in proc.
+    @return: The number of processors, or None if it cannot be determined.
+    """
+    try:
+        with open(status_path) as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return _count_cpu_list(line.split(':', 1)[1].strip())
+    except IOError:
+        pass
+    return None
+
+
+def _count_cpu_list(cpu_list):
+    """
+    Count the processors in a list such as 0-3,8,10-11.
+    @param cpu_list: The list of processors.
+    @return: The number of processors in the list.
+    """
+    count = 0
+    for cpu_range in cpu_list.split(','):
+        if not cpu_range:
+            continue
+        bounds = cpu_range.split('-')
+        count += int(bounds[-1]) - int(bounds[0]) + 1
+    return count
+
+
+def _read_cgroup_cpu_quota(cgroup_path, cgroup_root):
+    """
+    Get the number of processors' worth of time a control group quota allows.
+    @param cgroup_path: Path to the process's cgroup file in proc.
+    @param cgroup_root: Root of the control group file system.
+    @return: The quota rounded up to a whole number of processors, or None if
+        there is no quota.
+    """
+    cpu_max = _read_cgroup_value(cgroup_path, cgroup_root, None, 'cpu.max')
+    if cpu_max is not None:
+        quota, period = (cpu_max.split() + ['100000'])[:2]
+        if quota == 'max':
+            return None
+    else:
+        quota = _read_cgroup_value(
+            cgroup_path, cgroup_root, 'cpu', 'cpu.cfs_quota_us'
+        )
+        period = _read_cgroup_value(
+            cgroup_path, cgroup_root, 'cpu', 'cpu.cfs_period_us'
+        )
+        if quota is None or period is None or int(quota) <= 0:
+            return None
+    return int(math.ceil(float(quota) / float(period)))
+
+
+def _read_cgroup_value(cgroup_path, cgroup_root, controller, file_name):
+    """
+    Read a value from the control group of a process. The process's own group
+        is tried first, then the root, which is what containers usually show.
+    @param cgroup_path: Path to the process's cgroup file in proc.
+    @param cgroup_root: Root of the control group file system.
+    @param controller: The name of a version 1 controller, such as memory, or
+        None for the unified version 2 hierarchy.
+    @param file_name: The name of the file containing the value.
+    @return: The contents of the file without surrounding whitespace, or None
+        if it does not exist.
+    """
+    group_path = ''
+    try:
+        with open(cgroup_path) as f:
+            for line in f:
+                hierarchy_id, controllers, path = line.strip().split(':', 2)
+                if (
+                    controller is None and hierarchy_id == '0' or
+                    controller in controllers.split(',')
+                ):
+                    group_path = path.lstrip('/')
+    except (IOError, ValueError):
+        pass
+    base = cgroup_root if controller is None else os.path.join(
+        cgroup_root, controller
+    )
+    for directory in (os.path.join(base, group_path), base):
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                return f.read().strip()
+        except IOError:
+            continue
+    return None
@@ -0,0 +1,307 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+This module contains utilities for sharing large read-only objects, such as
+lookup tables attached to parser functions, with worker processes. The objects
+are written once to a memory-mapped file. When pickled, they carry only the
+path to that file, so each worker attaches to the same pages in the operating
+system's cache instead of receiving its own copy. Because the data do not live
+in Python objects, reference counting in the workers never dirties the shared
+pages the way it does for ordinary objects inherited through fork().
+"""
+
+import array
+import cPickle
+import mmap
+import os
+import struct
+import sys
+
+## header for shared mapping files: magic string and entry count
+_MAPPING_HEADER = struct.Struct('<4sQ')
+## index entry for shared mapping files: key offset/length, value offset/length
+_MAPPING_ENTRY = struct.Struct('<QIQI')
+## magic string identifying shared mapping files
+_MAPPING_MAGIC = 'DRGM'
+## header for shared array files: magic string, typecode and item count
+_ARRAY_HEADER = struct.Struct('<4scQ')
+## magic string identifying shared array files
+_ARRAY_MAGIC = 'DRGA'
+
+
+class _MappedFile(object):
+    """
+    Base class for read-only objects backed by a memory-mapped file. The file
+        is attached lazily, so instances may be created in the parent process
+        and cheaply sent to workers.
+    """
+    def __init__(self, path):
+        """
+        Initialize a new instance.
+        @param path: Path to the file on disk.
+        """
+        self.path = os.path.abspath(path)
+        self._map = None
+
+    def __getstate__(self):
+        """
+        Only the path is pickled; the data are attached again on first use.
+        """
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        """
+        Restore an instance from its pickled path.
+        @param state: The pickled state.
+        """
+        self.__init__(state['path'])
+
+    def _attach(self):
+        """
+        Map the file into memory if it is not already.
+        @return: The mmap object.
+        """
+        if self._map is None:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._on_attach()
+        return self._map
+
+    def _on_attach(self):
+        """
+        Hook to read header information once the file has been mapped.
+        """
+        pass
+
+    def close(self):
+        """
+        Release the memory map. The object reattaches if it is used again.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SharedMapping(_MappedFile):
+    """
+    A read-only dict-like object backed by a memory-mapped file. Keys should be
+        strings or integers. Values may be any picklable object; each lookup
+        unpickles only the requested value.
+    """
+    def _on_attach(self):
+        """
+        Read the header from the mapped file.
+        """
+        magic, self._count = _MAPPING_HEADER.unpack_from(self._map, 0)
+        if magic != _MAPPING_MAGIC:
+            raise IOError('%s is not a shared mapping file' % self.path)
+
+    def _entry(self, index):
+        """
+        Get the index entry at the specified position.
+        @param index: Position of the entry in the sorted key table.
+        @return: A tuple of (key_offset, key_length, value_offset, value_length)
+        """
+        return _MAPPING_ENTRY.unpack_from(
+            self._map, _MAPPING_HEADER.size + index * _MAPPING_ENTRY.size
+        )
+
+    def _find(self, key):
+        """
+        Binary search the key table for the supplied key.
+        @param key: The key to look up.
+        @return: The index entry for the key, or None if it does not exist.
+        """
+        mapped_file = self._attach()
+        packed_key = _pack_key(key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            candidate = mapped_file[entry[0]:entry[0] + entry[1]]
+            if candidate < packed_key:
+                low = middle + 1
+            elif candidate > packed_key:
+                high = middle
+            else:
+                return entry
+        return None
+
+    def __getitem__(self, key):
+        entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        return cPickle.loads(self._map[entry[2]:entry[2] + entry[3]])
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        self._attach()
+        return self._count
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        """
+        Get the value for a key if it exists.
+        @param key: The key to look up.
+        @param default: Value to return if the key does not exist.
+        @return: The value for the key or the default.
+        """
+        entry = self._find(key)
+        if entry is None:
+            return default
+        return cPickle.loads(self._map[entry[2]:entry[2] + entry[3]])
+
+    def iterkeys(self):
+        """
+        Iterate over all keys in the mapping.
+        """
+        mapped_file = self._attach()
+        for i in xrange(self._count):
+            entry = self._entry(i)
+            yield cPickle.loads(mapped_file[entry[0]:entry[0] + entry[1]])
+
+    def keys(self):
+        """
+        @return: A list of all keys in the mapping.
+        """
+        return list(self.iterkeys())
+
+
+class SharedArray(_MappedFile):
+    """
+    A read-only sequence of numbers backed by a memory-mapped file. Items are
+        stored using the typecodes of the array module.
+    """
+    def _on_attach(self):
+        """
+        Read the header from the mapped file.
+        """
+        magic, self.typecode, self._count = _ARRAY_HEADER.unpack_from(
+            self._map, 0
+        )
+        if magic != _ARRAY_MAGIC:
+            raise IOError('%s is not a shared array file' % self.path)
+        self._item = struct.Struct('<' + self.typecode)
+
+    def __getitem__(self, index):
+        self._attach()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return array.array(
+                    self.typecode,
+                    (self[i] for i in xrange(start, stop, step))
+                )
+            values = array.array(self.typecode)
+            values.fromstring(
+                self._map[
+                    _ARRAY_HEADER.size + start * self._item.size:
+                    _ARRAY_HEADER.size + max(stop, start) * self._item.size
+                ]
+            )
+            if sys.byteorder == 'big':
+                values.byteswap()
+            return values
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('shared array index out of range')
+        return self._item.unpack_from(
+            self._map, _ARRAY_HEADER.size + index * self._item.size
+        )[0]
+
+    def __len__(self):
+        self._attach()
+        return self._count
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+def _pack_key(key):
+    """
+    Get the byte representation of a key used for sorting and searching.
+    @param key: A string or integer key.
+    @return: A byte string.
+    """
+    return cPickle.dumps(key, 2)
+
+
+def create_shared_array(values, typecode, path):
+    """
+    Write a collection of numbers to disk so it can be shared with workers.
+    @param values: A collection of numbers.
+    @param typecode: A typecode from the array module, e.g., 'i' or 'd'.
+    @param path: Location where the file should be written.
+    @return: A SharedArray for the supplied path.
+    """
+    values = array.array(typecode, values)
+    if values.itemsize != struct.calcsize('<' + typecode):
+        raise ValueError(
+            'typecode %s has no portable fixed-width representation' % typecode
+        )
+    with open(path, 'wb') as f:
+        f.write(_ARRAY_HEADER.pack(_ARRAY_MAGIC, typecode, len(values)))
+        # items are always stored little-endian
+        if sys.byteorder == 'big':
+            values.byteswap()
+        values.tofile(f)
+    return SharedArray(path)
+
+
+def create_shared_mapping(mapping, path):
+    """
+    Write a dict to disk so it can be shared with workers.
+    @param mapping: A dict whose keys are strings or integers.
+    @param path: Location where the file should be written.
+    @return: A SharedMapping for the supplied path.
+    """
+    packed_keys = sorted(
+        (_pack_key(key), key) for key in mapping.iterkeys()
+    )
+    data_offset = _MAPPING_HEADER.size + len(packed_keys) * _MAPPING_ENTRY.size
+    entries = list()
+    with open(path, 'wb') as f:
+        # write the keys and values first, then the index table pointing to them
+        f.seek(data_offset)
+        offset = data_offset
+        for packed_key, key in packed_keys:
+            packed_value = cPickle.dumps(mapping[key], 2)
+            f.write(packed_key)
+            f.write(packed_value)
+            entries.append(
+                _MAPPING_ENTRY.pack(
+                    offset, len(packed_key),
+                    offset + len(packed_key), len(packed_value)
+                )
+            )
+            offset += len(packed_key) + len(packed_value)
+        f.seek(0)
+        f.write(_MAPPING_HEADER.pack(_MAPPING_MAGIC, len(packed_keys)))
+        f.write(''.join(entries))
+    return SharedMapping(path)
@@ -0,0 +1,162 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.archive.
+"""
+
+import cPickle
+import os
+import shutil
+import unittest
+import dredge.archive
+import dredge.tests
+
+
+class TestSegmentArchive(unittest.TestCase):
+    """
+    Test the SegmentArchive class.
+    """
+    def setUp(self):
+        """
+        Create an archive with small segments in a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.archive = dredge.archive.SegmentArchive(
+            self.temp_directory, segment_size=100
+        )
+        self.documents = dict(
+            (str(i), 'document %i ' % i * (i + 1)) for i in xrange(10)
+        )
+        for item_id, document in sorted(self.documents.iteritems()):
+            self.archive.put(item_id, document)
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        self.archive.close()
+        shutil.rmtree(self.temp_directory)
+
+    def test_get(self):
+        """
+        Documents should be returned as buffers with their original contents.
+        """
+        for item_id, document in self.documents.iteritems():
+            data = self.archive.get(item_id)
+            self.assertIsInstance(data, buffer)
+            self.assertEqual(str(data), document)
+            self.assertEqual(self.archive.get_size(item_id), len(document))
+
+    def test_get_empty(self):
+        """
+        An empty document alone in its segment should be returned as an empty
+            buffer.
+        """
+        archive = dredge.archive.SegmentArchive(
+            os.path.join(self.temp_directory, 'empty')
+        )
+        archive.put('empty', '')
+        data = archive.get('empty')
+        self.assertIsInstance(data, buffer)
+        self.assertEqual(str(data), '')
+        archive.close()
+
+    def test_segments(self):
+        """
+        New segments should be started once a segment is full.
+        """
+        segment_files = [
+            f for f in os.listdir(self.temp_directory) if f.endswith('.dat')
+        ]
+        self.assertTrue(len(segment_files) > 1)
+
+    def test_reopen(self):
+        """
+        A reopened archive should contain the same documents.
+        """
+        archive = dredge.archive.SegmentArchive(self.temp_directory)
+        self.assertEqual(sorted(archive.ids()), sorted(self.documents.keys()))
+        self.assertIn(3, archive)
+        self.assertEqual(str(archive.get(3)), self.documents['3'])
+        archive.close()
+
+    def test_replace(self):
+        """
+        Storing a document with an existing id should replace it.
+        """
+        self.archive.put(3, 'replacement')
+        self.assertEqual(len(self.archive), len(self.documents))
+        self.assertEqual(str(self.archive.get(3)), 'replacement')
+        archive = dredge.archive.SegmentArchive(self.temp_directory)
+        self.assertEqual(str(archive.get(3)), 'replacement')
+        archive.close()
+
+    def test_deduplicate(self):
+        """
+        Identical documents should only be stored once.
+        """
+        size = sum(
+            os.path.getsize(os.path.join(self.temp_directory, f))
+            for f in os.listdir(self.temp_directory) if f.endswith('.dat')
+        )
+        self.assertFalse(self.archive.put('copy-a', self.documents['4']))
+        self.assertFalse(self.archive.put('copy-b', self.documents['4']))
+        self.assertEqual(
+            sum(
+                os.path.getsize(os.path.join(self.temp_directory, f))
+                for f in os.listdir(self.temp_directory) if f.endswith('.dat')
+            ),
+            size
+        )
+        self.assertEqual(str(self.archive.get('copy-a')), self.documents['4'])
+        self.assertEqual(
+            self.archive.get_digest('copy-b'), self.archive.get_digest(4)
+        )
+
+    def test_group_ids_by_content(self):
+        """
+        Ids should be grouped under the first id with the same contents.
+        """
+        self.archive.put('copy', self.documents['4'])
+        groups = self.archive.group_ids_by_content(['4', 'copy', '5'])
+        self.assertEqual(groups, {'4': ['4', 'copy'], '5': ['5']})
+        reopened = dredge.archive.SegmentArchive(self.temp_directory)
+        self.assertEqual(
+            reopened.group_ids_by_content(['copy', '4']),
+            {'copy': ['copy', '4']}
+        )
+        reopened.close()
+
+    def test_pickle(self):
+        """
+        Pickling should carry the location of the archive, not its contents.
+        """
+        pickled = cPickle.dumps(self.archive, 2)
+        self.assertNotIn('document 9', pickled)
+        archive = cPickle.loads(pickled)
+        self.assertEqual(str(archive.get(9)), self.documents['9'])
+        archive.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
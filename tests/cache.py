@@ -0,0 +1,159 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.cache.
+"""
+
+import os
+import shutil
+import time
+import unittest
+import zlib
+import dredge.cache
+import dredge.tests
+from dredge.tests.multi import Note, _test_xml_files
+
+
+class TestParseCache(unittest.TestCase):
+    """
+    Test the ParseCache class.
+    """
+    def setUp(self):
+        """
+        Create a cache in a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.cache = dredge.cache.ParseCache(
+            os.path.join(self.temp_directory, 'cache'), version='notes-1'
+        )
+        self.rows = [
+            Note(1, u'Adam', u'Wadam', u'A message.'),
+            Note(2, u'Adam', u'Wadam', u'A longer message.')
+        ]
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_round_trip(self):
+        """
+        Cached rows should be replayed as namedtuples with the same fields.
+        """
+        key = self.cache.get_file_key(_test_xml_files[0])
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, self.rows)
+        cached = self.cache.get(key)
+        self.assertEqual(cached, self.rows)
+        self.assertEqual(cached[0]._fields, Note._fields)
+        self.cache.put(key, self.rows[0])
+        self.assertEqual(self.cache.get(key), self.rows[:1])
+        self.cache.put(key, list())
+        self.assertEqual(self.cache.get(key), list())
+
+    def test_corrupt_entry(self):
+        """
+        A truncated or corrupt entry should be deleted and treated as a miss.
+        """
+        key = self.cache.get_file_key(_test_xml_files[0])
+        entry_path = self.cache._get_entry_path(key)
+        for corrupt in (
+            lambda data: data[:len(data) // 2],
+            lambda data: 'x' * len(data),
+            lambda data: zlib.compress('not a pickle')
+        ):
+            self.cache.put(key, self.rows)
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+            with open(entry_path, 'wb') as f:
+                f.write(corrupt(data))
+            self.assertIsNone(self.cache.get(key))
+            self.assertFalse(os.path.exists(entry_path))
+        self.cache.put(key, self.rows)
+        self.assertEqual(self.cache.get(key), self.rows)
+
+    def test_keys(self):
+        """
+        Keys should depend on the contents and the parser version.
+        """
+        key = self.cache.get_file_key(_test_xml_files[0])
+        self.assertNotEqual(key, self.cache.get_file_key(_test_xml_files[1]))
+        with open(_test_xml_files[0]) as f:
+            self.assertEqual(
+                key, self.cache.get_document_key(buffer(f.read()))
+            )
+        other_version = dredge.cache.ParseCache(
+            self.cache.directory, version='notes-2'
+        )
+        self.assertNotEqual(
+            key, other_version.get_file_key(_test_xml_files[0])
+        )
+        by_stat = dredge.cache.ParseCache(
+            self.cache.directory, version='notes-1', use_content_hash=False
+        )
+        self.assertNotEqual(key, by_stat.get_file_key(_test_xml_files[0]))
+
+    def test_evict(self):
+        """
+        The least recently used entries should be evicted first.
+        """
+        keys = [self.cache.get_file_key(f) for f in _test_xml_files[:3]]
+        for i, key in enumerate(keys):
+            self.cache.put(key, self.rows)
+            os.utime(
+                self.cache._get_entry_path(key), (time.time() - 100 + i,) * 2
+            )
+        # reading the oldest entry makes it the most recently used
+        self.cache.get(keys[0])
+        self.cache.max_size = os.path.getsize(
+            self.cache._get_entry_path(keys[0])
+        ) * 2
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+
+
+    def test_evict_on_put(self):
+        """
+        The cache should stay near max_size while entries are being stored.
+        """
+        key = self.cache.get_file_key(_test_xml_files[0])
+        self.cache.put(key, self.rows)
+        entry_size = os.path.getsize(self.cache._get_entry_path(key))
+        self.cache.max_size = entry_size * 20
+        for i in xrange(100):
+            self.cache.put(self.cache.get_document_key(str(i)), self.rows)
+        total_size = sum(
+            os.path.getsize(os.path.join(directory, file_name))
+            for directory, _, file_names in os.walk(self.cache.directory)
+            for file_name in file_names
+        )
+        self.assertLessEqual(
+            total_size,
+            self.cache.max_size * (1 + dredge.cache.EVICTION_INTERVAL)
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.compression.
+"""
+
+import os
+import shutil
+import unittest
+import dredge.compression
+import dredge.tests
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Test reading and writing compressed files.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.lines = ['Id,Value\r\n', '0,0\r\n', '1,10\r\n']
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def get_path(self, codec):
+        """
+        @param codec: The name of a codec, or None.
+        @return: A path in the temp directory with the codec's extension.
+        """
+        return os.path.join(
+            self.temp_directory,
+            'test.csv%s' % dredge.compression.get_extension(codec)
+        )
+
+    def check_codec(self, codec):
+        """
+        Write a file in two parts with a codec and read it back.
+        @param codec: The name of a codec, or None.
+        """
+        path = self.get_path(codec)
+        self.assertEqual(dredge.compression.get_codec(path), codec)
+        with dredge.compression.open_file(path, 'wb') as f:
+            f.write(''.join(self.lines[:2]))
+        with dredge.compression.open_file(path, 'ab') as f:
+            f.write(self.lines[2])
+        with dredge.compression.open_file(path) as f:
+            self.assertEqual(list(f), self.lines)
+        with dredge.compression.open_file(path) as f:
+            self.assertEqual(f.readline(), self.lines[0])
+            self.assertEqual(f.read(), ''.join(self.lines[1:]))
+
+    def test_plain(self):
+        """
+        Files without a compressed extension should be plain text.
+        """
+        self.check_codec(None)
+        with open(self.get_path(None)) as f:
+            self.assertEqual(f.read(), ''.join(self.lines))
+
+    def test_gzip(self):
+        """
+        Test gzip files.
+        """
+        self.check_codec('gzip')
+
+    @unittest.skipIf(
+        not dredge.compression.is_codec_available('zstd'),
+        'zstandard is not installed'
+    )
+    def test_zstd(self):
+        """
+        Test zstd files.
+        """
+        self.check_codec('zstd')
+
+    @unittest.skipIf(
+        not dredge.compression.is_codec_available('lz4'), 'lz4 is not installed'
+    )
+    def test_lz4(self):
+        """
+        Test lz4 files.
+        """
+        self.check_codec('lz4')
+
+    def test_unknown_codec(self):
+        """
+        An unknown codec should be rejected.
+        """
+        self.assertRaises(ValueError, dredge.compression.get_extension, 'rar')
+
+    def test_copy_contents(self):
+        """
+        Copying should report the last character written.
+        """
+        path = self.get_path('gzip')
+        with dredge.compression.open_file(path, 'wb') as f:
+            f.write(''.join(self.lines))
+        output_path = self.get_path(None)
+        with dredge.compression.open_file(path) as input_file:
+            with open(output_path, 'wb') as output_file:
+                self.assertEqual(
+                    dredge.compression.copy_contents(input_file, output_file),
+                    '\n'
+                )
+        with open(output_path) as f:
+            self.assertEqual(f.read(), ''.join(self.lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.corpus.
+"""
+
+import os
+import shutil
+import unittest
+import dredge.corpus
+import dredge.tests
+
+
+class TestCorpusIndex(unittest.TestCase):
+    """
+    Test the CorpusIndex class.
+    """
+    def setUp(self):
+        """
+        Create a directory with a few files and a subdirectory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.directory = os.path.join(self.temp_directory, 'corpus')
+        os.makedirs(os.path.join(self.directory, 'subdirectory'))
+        for i in xrange(5):
+            with open(os.path.join(self.directory, '%i.xml' % i), 'w') as f:
+                f.write('x' * i)
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def check_index(self, index):
+        """
+        Verify that an index describes the test files.
+        @param index: A CorpusIndex of the test directory.
+        """
+        self.assertEqual(
+            sorted(index.names()), ['%i.xml' % i for i in xrange(5)]
+        )
+        self.assertEqual(
+            index.get_file_sizes(),
+            dict(
+                (os.path.join(self.directory, '%i.xml' % i), i)
+                for i in xrange(5)
+            )
+        )
+        for name, (size, mtime) in index.entries.iteritems():
+            self.assertEqual(
+                mtime, os.stat(os.path.join(self.directory, name)).st_mtime
+            )
+
+    def test_scan(self):
+        """
+        Scanning should find every file but not subdirectories.
+        """
+        self.check_index(dredge.corpus.CorpusIndex.scan(self.directory))
+
+    def test_scan_without_scandir(self):
+        """
+        Scanning should work without the scandir package.
+        """
+        scandir = dredge.corpus.scandir
+        dredge.corpus.scandir = None
+        try:
+            self.check_index(dredge.corpus.CorpusIndex.scan(self.directory))
+        finally:
+            dredge.corpus.scandir = scandir
+
+    def test_save_and_load(self):
+        """
+        A saved index should load with the same entries.
+        """
+        index = dredge.corpus.CorpusIndex.scan(self.directory)
+        for file_name in ('index.csv', 'index.csv.gz'):
+            path = os.path.join(self.temp_directory, file_name)
+            index.save(path)
+            loaded = dredge.corpus.CorpusIndex.load(path)
+            self.assertEqual(loaded.directory, self.directory)
+            self.assertEqual(loaded.entries, index.entries)
+        self.assertEqual(
+            sorted(os.listdir(self.temp_directory)),
+            ['corpus', 'index.csv', 'index.csv.gz']
+        )
+
+    def test_rescan(self):
+        """
+        A rescan should reuse previous entries, add new files and drop
+            deleted ones.
+        """
+        previous = dredge.corpus.CorpusIndex.scan(self.directory)
+        previous.entries['1.xml'] = (100, 0.0)
+        os.remove(os.path.join(self.directory, '0.xml'))
+        with open(os.path.join(self.directory, '5.xml'), 'w') as f:
+            f.write('x' * 5)
+        index = dredge.corpus.CorpusIndex.scan(self.directory, previous)
+        self.assertEqual(
+            sorted(index.names()), ['%i.xml' % i for i in xrange(1, 6)]
+        )
+        self.assertEqual(index.entries['1.xml'], (100, 0.0))
+        self.assertEqual(index.entries['5.xml'][0], 5)
+
+    def test_add(self):
+        """
+        Added files should be included.
+        """
+        index = dredge.corpus.CorpusIndex.scan(self.directory)
+        index.add('new.xml', 3, 0.0)
+        self.assertTrue('new.xml' in index)
+        self.assertEqual(len(index), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,344 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.distributed. The workers run as separate local processes
+sharing one temp directory, as they would on separate hosts sharing a network
+file system.
+"""
+
+import csv
+import multiprocessing
+import os
+import shutil
+import time
+import unittest
+import dredge.benchmarks
+import dredge.distributed
+import dredge.downloader
+import dredge.tests
+from dredge.tests.multi import Note, _expected_xml_results, _test_xml_files
+from dredge.tests.multi import parser_func
+
+
+class TestDistributedParse(unittest.TestCase):
+    """
+    Test running a distributed parse job.
+    """
+    def setUp(self):
+        """
+        Prepare a job with two files in each chunk.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.work_directory = os.path.join(self.temp_directory, 'work')
+        self.output_folder = os.path.join(self.temp_directory, 'output')
+        self.chunk_count = dredge.distributed.prepare_distributed_parse(
+            file_paths=_test_xml_files,
+            work_directory=self.work_directory,
+            output_folder=self.output_folder,
+            task_name='notes',
+            chunk_size=2,
+            id_column=0
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def read_output(self):
+        """
+        @return: A tuple of Note objects from the final output, sorted by id.
+        """
+        with open(os.path.join(self.output_folder, 'notes.csv')) as f:
+            return tuple(
+                sorted(
+                    (
+                        Note(
+                            int(row['id']), row['sender'], row['recipient'],
+                            row['message']
+                        )
+                        for row in csv.DictReader(f)
+                    ),
+                    key=lambda note: note.id
+                )
+            )
+
+    def test_chunks(self):
+        """
+        The files should be divided into chunks of the requested size.
+        """
+        self.assertEqual(self.chunk_count, 4)
+
+    def test_multiple_workers(self):
+        """
+        Several workers should divide the chunks and merge the output once.
+        """
+        workers = [
+            multiprocessing.Process(
+                target=dredge.distributed.run_distributed_parse_worker,
+                args=(self.work_directory, parser_func),
+                kwargs={'poll_interval': 0.1}
+            ) for _ in xrange(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.read_output(), _expected_xml_results)
+        with open(os.path.join(self.output_folder, 'notes-errors.csv')) as f:
+            self.assertEqual(tuple(csv.DictReader(f)), ())
+        self.assertEqual(
+            os.listdir(os.path.join(self.work_directory, 'leases')), []
+        )
+
+    def test_abandoned_lease(self):
+        """
+        A lease that has not been renewed should be taken over.
+        """
+        lease_path = dredge.distributed._get_lease_path(self.work_directory, 0)
+        with open(lease_path, 'w') as f:
+            f.write('dead-host 0\n')
+        stale_time = time.time() - 60
+        os.utime(lease_path, (stale_time, stale_time))
+        is_merged = dredge.distributed.run_distributed_parse_worker(
+            self.work_directory, parser_func, lease_duration=30,
+            poll_interval=0.1
+        )
+        self.assertTrue(is_merged)
+        self.assertEqual(self.read_output(), _expected_xml_results)
+
+    def test_live_lease(self):
+        """
+        A chunk whose lease is being renewed should be left alone.
+        """
+        lease_path = dredge.distributed._get_lease_path(self.work_directory, 0)
+        with open(lease_path, 'w') as f:
+            f.write('live-host 0\n')
+        self.assertFalse(
+            dredge.distributed._claim_lease(self.work_directory, 0, 30)
+        )
+        self.assertTrue(
+            dredge.distributed._claim_lease(self.work_directory, 1, 30)
+        )
+
+    def test_taken_over_lease(self):
+        """
+        A worker whose lease was taken over should neither renew nor release
+            the new owner's lease.
+        """
+        lease_path = dredge.distributed._get_lease_path(self.work_directory, 0)
+        old_token = dredge.distributed._claim_lease(self.work_directory, 0, 30)
+        # another worker takes over the lease as if it had expired
+        os.remove(lease_path)
+        new_token = dredge.distributed._claim_lease(self.work_directory, 0, 30)
+        self.assertNotEqual(new_token, old_token)
+        stale_time = time.time() - 60
+        os.utime(lease_path, (stale_time, stale_time))
+        renewer = dredge.distributed._LeaseRenewer(lease_path, 0.01, old_token)
+        renewer.start()
+        renewer.join(5)
+        self.assertFalse(renewer.is_alive())
+        self.assertLess(os.path.getmtime(lease_path), time.time() - 30)
+        dredge.distributed._release_lease(self.work_directory, 0, old_token)
+        self.assertTrue(os.path.exists(lease_path))
+        dredge.distributed._release_lease(self.work_directory, 0, new_token)
+        self.assertFalse(os.path.exists(lease_path))
+
+    def test_racing_takeovers(self):
+        """
+        Only one of two workers that find the same abandoned lease should take
+            it over.
+        """
+        lease_path = dredge.distributed._get_lease_path(self.work_directory, 0)
+        with open(lease_path, 'w') as f:
+            f.write('dead-host 0\n')
+        stale_time = time.time() - 60
+        os.utime(lease_path, (stale_time, stale_time))
+        rename = os.rename
+        first_tokens = list()
+
+        def racing_rename(source, destination):
+            # the first worker takes the lease over just before the second
+            # moves the abandoned lease aside
+            if not first_tokens:
+                os.rename = rename
+                first_tokens.append(
+                    dredge.distributed._claim_lease(self.work_directory, 0, 30)
+                )
+            rename(source, destination)
+
+        os.rename = racing_rename
+        try:
+            second_token = dredge.distributed._claim_lease(
+                self.work_directory, 0, 30
+            )
+        finally:
+            os.rename = rename
+        self.assertTrue(first_tokens[0])
+        self.assertIsNone(second_token)
+        self.assertEqual(
+            dredge.distributed._read_lease_token(lease_path), first_tokens[0]
+        )
+        self.assertEqual(
+            os.listdir(os.path.dirname(lease_path)),
+            [os.path.basename(lease_path)]
+        )
+
+
+class TestDistributedDownload(unittest.TestCase):
+    """
+    Test running a coordinated crawl against a local stub server.
+    """
+    def setUp(self):
+        """
+        Start a stub server and prepare a crawl with three ids in each chunk.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.work_directory = os.path.join(self.temp_directory, 'work')
+        self.output_directory = os.path.join(self.temp_directory, 'output')
+        self.server = dredge.benchmarks.StubServer()
+        self.server.start()
+        self.item_ids = range(10)
+        self.chunk_count = dredge.distributed.prepare_distributed_download(
+            item_ids=self.item_ids,
+            work_directory=self.work_directory,
+            chunk_size=3,
+            requests_per_second=20,
+            burst=5
+        )
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def run_workers(self, process_count, url_template=None):
+        """
+        Run workers on this host until the crawl is done.
+        @param process_count: The number of workers to run.
+        @param url_template: The url template, or None to use the server's xml
+            documents.
+        """
+        dredge.distributed.run_distributed_download_workers(
+            self.work_directory, process_count,
+            url_template or self.server.url + '/thing?id={id}',
+            lambda item_id: {'id': item_id},
+            self.output_directory,
+            poll_interval=0.1
+        )
+
+    def read_log(self, name):
+        """
+        @param name: The name of a log in the work directory.
+        @return: A sorted list of the ids in the log.
+        """
+        with open(os.path.join(self.work_directory, name)) as f:
+            return sorted(int(row['id']) for row in csv.DictReader(f))
+
+    def test_chunks(self):
+        """
+        Test that ids are divided into chunks.
+        """
+        self.assertEqual(self.chunk_count, 4)
+
+    def test_download(self):
+        """
+        Test that several workers download every item exactly once.
+        """
+        self.run_workers(3)
+        self.assertEqual(
+            sorted(os.listdir(self.output_directory)),
+            sorted('%i.xml' % i for i in self.item_ids)
+        )
+        self.assertEqual(self.read_log('manifest.csv'), self.item_ids)
+        self.assertEqual(self.read_log('errors.csv'), [])
+
+    def test_shared_error_log(self):
+        """
+        Test that errors from all workers are written to one log.
+        """
+        self.run_workers(2, self.server.url + '/missing?id={id}')
+        self.assertEqual(self.read_log('errors.csv'), self.item_ids)
+        self.assertEqual(self.read_log('manifest.csv'), [])
+
+    def test_shared_rate_limit(self):
+        """
+        Test that workers together stay within the shared request rate.
+        """
+        start_time = time.time()
+        self.run_workers(3)
+        # 5 requests are permitted at once and the rest at 20 per second
+        self.assertGreaterEqual(time.time() - start_time, 0.25)
+
+
+class TestSharedRateLimiter(unittest.TestCase):
+    """
+    Test the shared rate limiter used by coordinated crawls.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.path = os.path.join(self.temp_directory, 'rate-limiter')
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_burst(self):
+        """
+        Test that a burst of requests is not delayed.
+        """
+        rate_limiter = dredge.downloader.SharedRateLimiter(self.path, 1, 5)
+        start_time = time.time()
+        for _ in xrange(5):
+            rate_limiter.acquire()
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_rate(self):
+        """
+        Test that processes sharing a limiter together observe its rate.
+        """
+        rate_limiter = dredge.downloader.SharedRateLimiter(self.path, 20, 1)
+        processes = [
+            multiprocessing.Process(
+                target=lambda: [rate_limiter.acquire() for _ in xrange(5)]
+            ) for _ in xrange(2)
+        ]
+        start_time = time.time()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # 10 requests with one permitted at once take at least 9 intervals
+        self.assertGreaterEqual(time.time() - start_time, 0.45)
+
+
+if __name__ == '__main__':
+    unittest.main()
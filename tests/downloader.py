@@ -26,14 +26,35 @@ so may be susceptible to unexpected changes at a later date.
 """
 
 import csv
+import functools
+import multiprocessing
 import os
 import re
 import shutil
+import StringIO
+import subprocess
+import sys
+import time
 import unittest
+import dredge.archive
+import dredge.benchmarks
+import dredge.corpus
+import dredge.metrics
 import dredge.tests
 import dredge.downloader
 
 
+def append_csv_rows(path, count):
+    """
+    Read a csv log and append rows to it, as a downloading process does.
+    @param path: Path to the log.
+    @param count: The number of rows to append.
+    """
+    dredge.downloader._read_csv_rows(path, ['id', 'size'])
+    for i in xrange(count):
+        dredge.downloader._append_csv_row(path, [os.getpid(), i])
+
+
 class TestMassDownloadXML(unittest.TestCase):
     """
     A class to test the mass_download() method with xml documents.
@@ -162,5 +183,741 @@ class TestMassDownloadMultiPageHTML(unittest.TestCase):
         self.assertEqual(ids, expected)
 
 
+class TestMassDownloadArchive(unittest.TestCase):
+    """
+    A class to test the mass_download() method with an archive. The documents
+        are served by a local dredge.benchmarks.StubServer.
+    """
+    def setUp(self):
+        """
+        Call the method to get some test data.
+        """
+        self.item_ids = range(10)
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.server = dredge.benchmarks.StubServer()
+        self.server.start()
+        self.archive = dredge.archive.SegmentArchive(
+            os.path.join(self.temp_directory, 'archive')
+        )
+        self.download(self.server.url + '/thing?id={id}')
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        self.archive.close()
+        shutil.rmtree(self.temp_directory)
+
+    def download(self, url_template):
+        """
+        Download the test items into the archive.
+        @param url_template: URL template for the items.
+        """
+        dredge.downloader.mass_download(
+            item_ids=self.item_ids,
+            url_template=url_template,
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_directory=self.temp_directory,
+            sleep_time=0,
+            archive=self.archive
+        )
+
+    def test_documents_archived(self):
+        """
+        Every document should be stored in the archive rather than a file.
+        """
+        self.assertEqual(
+            sorted(int(item_id) for item_id in self.archive.ids()),
+            self.item_ids
+        )
+        self.assertEqual(
+            str(self.archive.get(5)), self.server.get_xml_document(5)
+        )
+        self.assertFalse(
+            any(f.endswith('.xml') for f in os.listdir(self.temp_directory))
+        )
+
+    def test_resume(self):
+        """
+        Archived documents should not be downloaded again.
+        """
+        self.download(self.server.url + '/missing?id={id}')
+        with open(
+            os.path.join(self.temp_directory, dredge.downloader.ERROR_LOG_NAME)
+        ) as f:
+            self.assertEqual(tuple(csv.DictReader(f)), ())
+
+
+class TestMassDownloadCorpusIndex(unittest.TestCase):
+    """
+    A class to test the mass_download() method with a corpus index. The
+        documents are served by a local dredge.benchmarks.StubServer.
+    """
+    def setUp(self):
+        """
+        Start the server and create an empty index.
+        """
+        self.item_ids = range(10)
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.server = dredge.benchmarks.StubServer()
+        self.server.start()
+        self.corpus_index = dredge.corpus.CorpusIndex.scan(self.temp_directory)
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def download(self, url_template):
+        """
+        Download the test items using the index.
+        @param url_template: URL template for the items.
+        """
+        dredge.downloader.mass_download(
+            item_ids=self.item_ids,
+            url_template=url_template,
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_directory=self.temp_directory,
+            sleep_time=0,
+            corpus_index=self.corpus_index
+        )
+
+    def test_files_indexed(self):
+        """
+        Every downloaded file should be added to the index.
+        """
+        self.download(self.server.url + '/thing?id={id}')
+        self.assertEqual(
+            self.corpus_index.get_file_sizes(),
+            dict(
+                (
+                    os.path.join(self.temp_directory, '%i.xml' % i),
+                    len(self.server.get_xml_document(i))
+                ) for i in self.item_ids
+            )
+        )
+
+    def test_resume(self):
+        """
+        Items in the index should not be downloaded again.
+        """
+        for i in self.item_ids:
+            self.corpus_index.add('%i.xml' % i, 0, 0.0)
+        self.download(self.server.url + '/missing?id={id}')
+        with open(
+            os.path.join(self.temp_directory, dredge.downloader.ERROR_LOG_NAME)
+        ) as f:
+            self.assertEqual(tuple(csv.DictReader(f)), ())
+
+
+class TestMassDownloadSkipItemIds(unittest.TestCase):
+    """
+    A class to test the mass_download() method with a set of ids to skip. The
+        documents are served by a local dredge.benchmarks.StubServer.
+    """
+    def setUp(self):
+        """
+        Start the server.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.server = dredge.benchmarks.StubServer()
+        self.server.start()
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def download(self, item_ids, url_template, skip_item_ids):
+        """
+        Download test items into the temp directory.
+        @param item_ids: The ids to download.
+        @param url_template: URL template for the items.
+        @param skip_item_ids: The set of ids to skip.
+        """
+        dredge.downloader.mass_download(
+            item_ids=item_ids,
+            url_template=url_template,
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_directory=self.temp_directory,
+            sleep_time=0,
+            skip_item_ids=skip_item_ids
+        )
+
+    def test_skip_item_ids(self):
+        """
+        Items in the set should be skipped without reading the error log or
+            listing the directory, and finished items should be added to it.
+        """
+        skip_item_ids = dredge.downloader.find_downloaded_item_ids(
+            self.temp_directory
+        )
+        self.assertEqual(skip_item_ids, set())
+        skip_item_ids.add('3')
+        self.download(
+            range(5), self.server.url + '/thing?id={id}', skip_item_ids
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.temp_directory)),
+            sorted(
+                ['%i.xml' % i for i in (0, 1, 2, 4)] +
+                [dredge.downloader.ERROR_LOG_NAME]
+            )
+        )
+        self.download(
+            range(8), self.server.url + '/missing?id={id}', skip_item_ids
+        )
+        self.assertEqual(skip_item_ids, set(str(i) for i in xrange(8)))
+        # a fresh search finds the same items
+        self.assertEqual(
+            dredge.downloader.find_downloaded_item_ids(self.temp_directory),
+            set(str(i) for i in xrange(8)) - set(['3'])
+        )
+
+
+class SlowRateLimiter(object):
+    """
+    A rate limiter that makes every request wait.
+    """
+    def __init__(self, wait_time):
+        """
+        Initialize a new instance.
+        @param wait_time: Number of seconds to wait before each request.
+        """
+        self.wait_time = wait_time
+
+    def acquire(self):
+        """
+        Wait before a request.
+        """
+        time.sleep(self.wait_time)
+
+
+class TestGetOpenerMethod(unittest.TestCase):
+    """
+    A class to test the get_opener_method() method.
+    """
+    def test_fetch_latency(self):
+        """
+        Fetch latency should not include time spent waiting for the rate
+            limiter or a concurrency slot.
+        """
+        metrics = dredge.metrics.Metrics()
+        opener_method = dredge.downloader.get_opener_method(
+            metrics=metrics,
+            rate_limiter=SlowRateLimiter(0.5),
+            concurrency=dredge.downloader.AdaptiveConcurrency()
+        )
+        with dredge.benchmarks.StubServer() as server:
+            start_time = time.time()
+            data = opener_method(server.url + '/thing?id=1').read()
+            self.assertGreaterEqual(time.time() - start_time, 0.5)
+        self.assertEqual(data, server.get_xml_document(1))
+        latency = metrics.histograms['download.fetch_latency']
+        self.assertEqual(latency.count, 1)
+        self.assertLess(latency.maximum, 0.5)
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    """
+    A class to test downloading with an AdaptiveConcurrency controller.
+    """
+    def setUp(self):
+        """
+        Create a temp directory and a metrics collector.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.metrics = dredge.metrics.Metrics()
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def download(self, server, item_count):
+        """
+        Download items from a server with an adaptive controller.
+        @param server: A running dredge.benchmarks.StubServer.
+        @param item_count: The number of items to download.
+        @return: The AdaptiveConcurrency object used.
+        """
+        concurrency = dredge.downloader.AdaptiveConcurrency(
+            max_limit=8, metrics=self.metrics
+        )
+        dredge.downloader.mass_download(
+            item_ids=range(item_count),
+            url_template=server.url + '/thing?id={id}',
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_directory=self.temp_directory,
+            metrics=self.metrics,
+            concurrency=concurrency
+        )
+        return concurrency
+
+    def test_increase(self):
+        """
+        The limit should grow while the server stays healthy.
+        """
+        with dredge.benchmarks.StubServer(latency=0.01) as server:
+            concurrency = self.download(server, 40)
+        self.assertGreater(concurrency.limit, 1)
+        self.assertGreater(
+            self.metrics.counters['download.concurrency_increases'], 0
+        )
+        self.assertEqual(self.metrics.counters['download.items'], 40)
+        self.assertEqual(
+            len([f for f in os.listdir(self.temp_directory) if '.xml' in f]),
+            40
+        )
+
+    def test_decrease(self):
+        """
+        The limit should be cut when the server refuses requests.
+        """
+        with dredge.benchmarks.StubServer(requests_per_second=5) as server:
+            self.download(server, 40)
+        self.assertGreater(
+            self.metrics.counters['download.concurrency_decreases'], 0
+        )
+        self.assertEqual(
+            self.metrics.counters.get('download.items', 0) +
+            self.metrics.counters['download.errors'],
+            40
+        )
+
+    def test_limit(self):
+        """
+        No more requests than the limit should ever be in flight.
+        """
+        concurrency = dredge.downloader.AdaptiveConcurrency(
+            initial_limit=2, max_limit=2
+        )
+        peak = [0]
+        in_flight = [0]
+
+        def fetch(url, max_bytes=None):
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            in_flight[0] -= 1
+            return StringIO.StringIO(url)
+
+        opener_method = functools.partial(
+            dredge.downloader._controlled_fetch,
+            opener_method=fetch,
+            concurrency=concurrency
+        )
+        concurrency.run(range(20), opener_method)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(concurrency.in_flight, 0)
+
+    def test_run_errors(self):
+        """
+        A thread should move on to the next item when the function raises.
+        """
+        concurrency = dredge.downloader.AdaptiveConcurrency(max_limit=2)
+        done = list()
+
+        def func(item):
+            if item % 2:
+                raise ValueError('odd item')
+            done.append(item)
+
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            concurrency.run(range(20), func)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(sorted(done), range(0, 20, 2))
+
+    def test_url_format_error(self):
+        """
+        An item whose url cannot be formatted should be logged as an error
+            without stopping the other items.
+        """
+        def url_format_expression(item_id):
+            if item_id == 3:
+                raise KeyError(item_id)
+            return {'id': item_id}
+
+        with dredge.benchmarks.StubServer() as server:
+            dredge.downloader.mass_download(
+                item_ids=range(10),
+                url_template=server.url + '/thing?id={id}',
+                url_format_expression=url_format_expression,
+                output_directory=self.temp_directory,
+                concurrency=dredge.downloader.AdaptiveConcurrency(max_limit=1)
+            )
+        self.assertEqual(
+            sorted(f for f in os.listdir(self.temp_directory) if '.xml' in f),
+            sorted('%i.xml' % i for i in xrange(10) if i != 3)
+        )
+        with open(
+            os.path.join(self.temp_directory, dredge.downloader.ERROR_LOG_NAME)
+        ) as f:
+            self.assertEqual([row['id'] for row in csv.DictReader(f)], ['3'])
+
+
+class TestScheduleItemIds(unittest.TestCase):
+    """
+    A class to test ordering downloads with schedule_item_ids().
+    """
+    def test_no_schedule(self):
+        """
+        Without priorities or costs, the original order should be kept.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids([3, 1, 2]), [3, 1, 2]
+        )
+
+    def test_priorities(self):
+        """
+        Items with higher priorities should come first.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids(
+                [1, 2, 3, 4], priorities={3: 10, 2: 5}
+            ),
+            [3, 2, 1, 4]
+        )
+
+    def test_costs(self):
+        """
+        Cheap items should come first, and unknown items should be assumed to
+            have the median cost.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids(
+                [1, 2, 3, 4], costs={'1': 50, '2': 1, '3': 5}
+            ),
+            [2, 3, 4, 1]
+        )
+
+    def test_priorities_and_costs(self):
+        """
+        Items should be ordered by priority per unit of cost.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids(
+                [1, 2, 3],
+                priorities=lambda item_id: 10 if item_id == 1 else 1,
+                costs=lambda item_id: 20 if item_id == 1 else 1
+            ),
+            [2, 3, 1]
+        )
+
+    def test_lead_count(self):
+        """
+        The most expensive items should be moved to the front.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids(
+                [1, 2, 3, 4], costs={1: 50, 2: 1, 3: 5, 4: 100}, lead_count=2
+            ),
+            [4, 1, 2, 3]
+        )
+
+    def test_lead_count_priorities(self):
+        """
+        Expensive items should only be moved ahead of items with higher
+            priorities once those have been moved to the front.
+        """
+        self.assertEqual(
+            dredge.downloader.schedule_item_ids(
+                [1, 2, 3, 4], priorities={1: 10, 2: 10},
+                costs={1: 50, 2: 1, 3: 5, 4: 100}, lead_count=3
+            ),
+            [1, 2, 4, 3]
+        )
+
+    def test_mass_download(self):
+        """
+        Only items not yet downloaded should be scheduled, so that leaders are
+            picked among the pending items.
+        """
+        temp_directory = dredge.tests.get_temp_directory()
+        schedule_item_ids = dredge.downloader.schedule_item_ids
+        scheduled = list()
+
+        def record_schedule(item_ids, *args, **kwargs):
+            scheduled.append(list(item_ids))
+            return schedule_item_ids(item_ids, *args, **kwargs)
+
+        dredge.downloader.schedule_item_ids = record_schedule
+        try:
+            for item_id in (1, 4):
+                with open(
+                    os.path.join(temp_directory, '%i.xml' % item_id), 'w'
+                ) as f:
+                    f.write('data')
+            requested = list()
+
+            def url_format_expression(item_id):
+                requested.append(item_id)
+                return {'id': item_id}
+
+            metrics = dredge.metrics.Metrics()
+            with dredge.benchmarks.StubServer() as server:
+                dredge.downloader.mass_download(
+                    item_ids=[1, 2, 3, 4],
+                    url_template=server.url + '/thing?id={id}',
+                    url_format_expression=url_format_expression,
+                    output_directory=temp_directory,
+                    metrics=metrics,
+                    concurrency=dredge.downloader.AdaptiveConcurrency(
+                        max_limit=2
+                    ),
+                    costs={1: 50, 2: 1, 3: 5, 4: 100}
+                )
+            self.assertEqual(scheduled, [[2, 3]])
+            self.assertEqual(sorted(requested), [2, 3])
+            self.assertEqual(metrics.counters['download.skipped'], 2)
+        finally:
+            dredge.downloader.schedule_item_ids = schedule_item_ids
+            shutil.rmtree(temp_directory)
+
+
+class TestGetPageCounts(unittest.TestCase):
+    """
+    A class to test reading page counts from a previous download.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.page_ids = ['a-0001', 'a-0002', 'b c-0001', 'a-0003', '7']
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_files(self):
+        """
+        Page counts should be read from the names of saved pages.
+        """
+        for page_id in self.page_ids:
+            file_name = dredge.downloader.get_item_file_name(page_id, 'html')
+            with open(os.path.join(self.temp_directory, file_name), 'w'):
+                pass
+        self.assertEqual(
+            dredge.downloader.get_page_counts(self.temp_directory),
+            {'a': 3, 'b c': 1}
+        )
+
+    def test_archive(self):
+        """
+        Page counts should be read from the ids of archived pages.
+        """
+        archive = dredge.archive.SegmentArchive(self.temp_directory)
+        for page_id in self.page_ids:
+            archive.put(page_id, page_id)
+        self.assertEqual(
+            dredge.downloader.get_page_counts(self.temp_directory, archive),
+            {'a': 3, 'b c': 1}
+        )
+        archive.close()
+
+
+class TestLazyImports(unittest.TestCase):
+    """
+    A class to test that heavy dependencies are only imported when needed.
+    """
+    def test_no_heavy_imports(self):
+        """
+        Importing the download and parse modules should not load bs4, lxml or
+            the optional compression codecs.
+        """
+        output = subprocess.check_output(
+            [
+                sys.executable, '-c',
+                'import sys, dredge.distributed, dredge.pipeline; '
+                'print [m for m in %r if m in sys.modules]' % (
+                    ('bs4', 'lxml', 'lz4', 'zstandard'),
+                )
+            ],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        )
+        self.assertEqual(output.strip(), '[]')
+
+
+class TestMassDownloadPageCounts(unittest.TestCase):
+    """
+    A class to test finding page counts of multi-page items with a pattern and
+        caching them. The documents are served by a local
+        dredge.benchmarks.StubServer.
+    """
+    def setUp(self):
+        """
+        Start the server.
+        """
+        self.item_ids = range(6)
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.cache_path = os.path.join(self.temp_directory, 'page-counts.csv')
+        self.server = dredge.benchmarks.StubServer(max_pages=3)
+        self.server.start()
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def download(self, index_path='/collection', **kwargs):
+        """
+        Download the test items, finding page counts with a pattern.
+        @param index_path: Path on the server of the index pages.
+        @param kwargs: Any additional keyword arguments for mass_download().
+        """
+        dredge.downloader.mass_download(
+            item_ids=self.item_ids,
+            url_template=self.server.url + index_path + '?id={id}',
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_directory=self.temp_directory,
+            file_extension='html',
+            sleep_time=0,
+            segment_url_template=(
+                self.server.url + '/collection?id={id}&page={page}'
+            ),
+            segment_url_format_expression=lambda item_id, page: {
+                'id': item_id, 'page': page
+            },
+            page_count_pattern=r'page=(\d+)',
+            **kwargs
+        )
+
+    def read_errors(self):
+        """
+        @return: The ids in the error log.
+        """
+        with open(
+            os.path.join(self.temp_directory, dredge.downloader.ERROR_LOG_NAME)
+        ) as f:
+            return [row['id'] for row in csv.DictReader(f)]
+
+    def test_pattern(self):
+        """
+        Every page of every item should be downloaded.
+        """
+        self.download()
+        self.assertEqual(self.read_errors(), [])
+        self.assertEqual(
+            dredge.downloader.get_page_counts(self.temp_directory),
+            dict(
+                (str(i), self.server.get_page_count(i)) for i in self.item_ids
+            )
+        )
+
+    def test_prefix_size(self):
+        """
+        Page numbers beyond the searched prefix should not be found.
+        """
+        self.download(page_count_prefix_size=10)
+        self.assertEqual(
+            self.read_errors(), [str(i) for i in self.item_ids]
+        )
+
+    def test_prefix_size_metrics(self):
+        """
+        Only the searched prefix of each index page should be read when
+            requests are measured and limited.
+        """
+        metrics = dredge.metrics.Metrics()
+        self.download(
+            page_count_prefix_size=10,
+            metrics=metrics,
+            concurrency=dredge.downloader.AdaptiveConcurrency()
+        )
+        self.assertEqual(
+            sorted(self.read_errors()), [str(i) for i in self.item_ids]
+        )
+        self.assertEqual(
+            metrics.counters['download.bytes'], 10 * len(self.item_ids)
+        )
+
+    def test_cache(self):
+        """
+        Cached page counts should be used instead of fetching index pages.
+        """
+        self.download(page_count_cache_path=self.cache_path)
+        with open(self.cache_path) as f:
+            self.assertEqual(
+                sorted(
+                    (int(row['id']), int(row['pages']))
+                    for row in csv.DictReader(f)
+                ),
+                [(i, self.server.get_page_count(i)) for i in self.item_ids]
+            )
+        os.remove(os.path.join(self.temp_directory, '2-0003.html'))
+        # index pages are missing from this path, so fetching one would fail
+        self.download(
+            index_path='/missing', page_count_cache_path=self.cache_path
+        )
+        self.assertEqual(self.read_errors(), [])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_directory, '2-0003.html'))
+        )
+
+
+
+class TestCsvLog(unittest.TestCase):
+    """
+    A class to test the csv logs that may be shared between processes.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.path = os.path.join(self.temp_directory, 'log.csv')
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_shared_log(self):
+        """
+        Headers should come before every row appended by several processes
+            that start the log at once.
+        """
+        workers = [
+            multiprocessing.Process(
+                target=append_csv_rows, args=(self.path, 20)
+            ) for _ in xrange(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with open(self.path) as f:
+            self.assertEqual(f.readline().strip(), 'id,size')
+        self.assertEqual(
+            len(dredge.downloader._read_csv_rows(self.path, ['id', 'size'])),
+            80
+        )
+
+    def test_missing_headers(self):
+        """
+        No row should be dropped from a log without headers.
+        """
+        with open(self.path, 'w') as f:
+            f.write('1,10\r\n2,20\r\n')
+        self.assertEqual(
+            dredge.downloader._read_csv_rows(self.path, ['id', 'size']),
+            [['1', '10'], ['2', '20']]
+        )
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.errorlog.
+"""
+
+import csv
+import multiprocessing
+import os
+import shutil
+import unittest
+import dredge.errorlog
+import dredge.tests
+
+
+def fail(item_id):
+    """
+    Raise an exception whose message includes an item id.
+    @param item_id: The id of an item.
+    """
+    raise ValueError('bad item %s' % item_id)
+
+
+def log_failures(path, item_ids):
+    """
+    Log a failure for each item and exit without closing the log, as a worker
+        process does.
+    @param path: Path to the error log.
+    @param item_ids: The ids of the items.
+    """
+    error_log = dredge.errorlog.ErrorLog(path, flush_interval=60)
+    for item_id in item_ids:
+        try:
+            fail(item_id)
+        except ValueError:
+            error_log.log(item_id)
+
+
+class TestErrorLog(unittest.TestCase):
+    """
+    Test the ErrorLog class.
+    """
+    def setUp(self):
+        """
+        Create an error log with headers.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.path = os.path.join(self.temp_directory, 'errors.csv')
+        with open(self.path, 'w') as f:
+            csv.writer(f).writerow(['id', 'exception'])
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def read_rows(self):
+        """
+        @return: The rows in the error log after the headers.
+        """
+        with open(self.path) as f:
+            return list(csv.reader(f))[1:]
+
+    def test_group_tracebacks(self):
+        """
+        The full traceback should be written only for the first item with each
+            signature, and every id should be kept in the first column.
+        """
+        with dredge.errorlog.ErrorLog(self.path) as error_log:
+            for item_id in xrange(3):
+                try:
+                    fail(item_id)
+                except ValueError:
+                    error_log.log(item_id)
+            try:
+                {}['missing']
+            except KeyError:
+                error_log.log(3)
+            error_log.log(4, 'timeout: exceeded 1 seconds')
+        rows = self.read_rows()
+        self.assertEqual([row[0] for row in rows], ['0', '1', '2', '3', '4'])
+        self.assertTrue(rows[0][1].startswith('Traceback'))
+        self.assertEqual(
+            rows[1][1], 'ValueError: bad item 1 (traceback logged for 0)'
+        )
+        self.assertEqual(
+            rows[2][1], 'ValueError: bad item 2 (traceback logged for 0)'
+        )
+        self.assertTrue(rows[3][1].startswith('Traceback'))
+        self.assertIn('KeyError', rows[3][1])
+        self.assertEqual(rows[4][1], 'timeout: exceeded 1 seconds')
+
+    def test_background_flush(self):
+        """
+        Rows should be written by the background thread without a flush.
+        """
+        error_log = dredge.errorlog.ErrorLog(self.path, max_batch_size=2)
+        error_log.log(0, 'first')
+        error_log.log(1, 'second')
+        for _ in xrange(100):
+            if len(self.read_rows()) == 2:
+                break
+            error_log._thread.join(0.05)
+        self.assertEqual(self.read_rows(), [['0', 'first'], ['1', 'second']])
+        error_log.log(2, 'third')
+        error_log.close()
+        self.assertEqual(len(self.read_rows()), 3)
+        self.assertFalse(error_log._thread.is_alive())
+
+    def test_flush_at_worker_exit(self):
+        """
+        Pending rows should be written when a worker process exits.
+        """
+        worker = multiprocessing.Process(
+            target=log_failures, args=(self.path, range(5))
+        )
+        worker.start()
+        worker.join()
+        self.assertEqual(
+            [row[0] for row in self.read_rows()], ['0', '1', '2', '3', '4']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.metrics.
+"""
+
+import json
+import os
+import shutil
+import unittest
+import dredge.metrics
+import dredge.tests
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Test the Metrics class.
+    """
+    def setUp(self):
+        """
+        Create a collector that logs to a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.log_path = os.path.join(self.temp_directory, 'metrics.jsonl')
+        self.measurements = list()
+        self.metrics = dredge.metrics.Metrics(
+            hooks=[lambda name, value: self.measurements.append((name, value))],
+            log_path=self.log_path,
+            log_interval=3600
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_counters_and_gauges(self):
+        """
+        Counters should accumulate and gauges should hold the latest value.
+        """
+        self.metrics.increment('items')
+        self.metrics.increment('items', 4)
+        self.metrics.set_gauge('pending', 10)
+        self.metrics.set_gauge('pending', 9)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {'items': 5})
+        self.assertEqual(snapshot['gauges'], {'pending': 9})
+
+    def test_histogram(self):
+        """
+        Histograms should summarize observed values.
+        """
+        for value in (0.5, 1.5, 3.0):
+            self.metrics.observe('latency', value)
+        summary = self.metrics.snapshot()['histograms']['latency']
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['min'], 0.5)
+        self.assertEqual(summary['max'], 3.0)
+        self.assertEqual(summary['buckets'], {'0.5': 1, '2.0': 1, '4.0': 1})
+
+    def test_hooks(self):
+        """
+        Hooks should be called for each measurement.
+        """
+        self.metrics.increment('items')
+        self.metrics.observe('latency', 0.25)
+        self.assertEqual(
+            self.measurements, [('items', 1), ('latency', 0.25)]
+        )
+
+    def test_merge(self):
+        """
+        Snapshots from child collectors should merge into their parent.
+        """
+        child = self.metrics.child(task=1)
+        child.increment('items', 2)
+        child.observe('latency', 1.0)
+        self.metrics.increment('items')
+        self.metrics.merge(json.loads(json.dumps(child.snapshot())))
+        self.assertEqual(self.metrics.counters['items'], 3)
+        self.assertEqual(self.metrics.histograms['latency'].count, 1)
+        self.assertEqual(child.snapshot()['labels'], {'task': 1})
+
+    def test_flush(self):
+        """
+        Flushing should append a snapshot to the log file.
+        """
+        self.metrics.increment('items')
+        self.metrics.flush()
+        self.metrics.flush()
+        with open(self.log_path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[-1]['counters'], {'items': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
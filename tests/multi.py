@@ -24,16 +24,31 @@ THE SOFTWARE.
 Module to test dredge.multi.
 """
 
+import array
 import collections
+import cProfile
 import csv
 import itertools
+import json
 import lxml.etree
+import multiprocessing
+import operator
 import os
+import pstats
 import re
+import signal
+import threading
+import time
 import unittest
 import shutil
+import dredge.archive
+import dredge.cache
+import dredge.compression
+import dredge.corpus
+import dredge.metrics
 import dredge.multi
 import dredge.tests
+import dredge.validation
 
 ## paths to test files
 _test_xml_files = [
@@ -116,27 +131,796 @@ def parser_task(file_paths, slice_start, slice_end, result_queue, **kwargs):
     result_queue.put(results)
 
 
+def document_parser_func(document):
+    """
+    An example function with the required method signature for parsing
+        documents stored in an archive.
+    @param document: A buffer containing the document.
+    """
+    note = lxml.etree.fromstring(str(document))
+    return Note(
+        int(note.attrib['id']),
+        unicode(note.find('from').text.encode('utf-8')),
+        unicode(note.find('to').text.encode('utf-8')),
+        unicode(note.find('message').text.encode('utf-8'))
+    )
+
+
+def slow_parser_func(file_path):
+    """
+    A parser function that takes too long to parse the third test file.
+    @param file_path: Path to a file to parse.
+    """
+    if file_path.endswith('03.xml'):
+        time.sleep(30)
+    return parser_func(file_path)
+
+
+def hanging_task(items, slice_start, slice_end, result_queue, **kwargs):
+    """
+    A task that reports its progress and ignores alarms while it hangs on any
+        item equal to 3, so that only the watchdog can stop it.
+    @param items: A collection of integers.
+    @param slice_start: The start for the range to be processed.
+    @param slice_end: The end of the range to be processed.
+    @param result_queue: The queue into which the result should be placed.
+    @param kwargs: Method signature requirement.
+    """
+    signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    progress = kwargs['_task_progress']
+    results = list()
+    for i in xrange(slice_start, slice_end):
+        progress.start_item(kwargs['_task_index'], i)
+        if items[i] == 3:
+            time.sleep(60)
+        results.append(items[i])
+    progress.finish(kwargs['_task_index'])
+    result_queue.put(results)
+
+
 # TODO: Test cases illustrating error collection
 # TODO: Test cases illustrating non-unique ids
 class TestDoMultiParseToCSV(unittest.TestCase):
     """
-    Test the do_multi_parse_to_csv() method.
+    Test the do_multi_parse_to_csv() method.
+    """
+    def setUp(self):
+        """
+        Call the method to create the test output files. Note that the output of
+            parser_func is expected to be a namedtuple type with an attribute
+            called 'id'.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=1,
+            delimiter=',',
+            id_column=0
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_intermediate_output(self):
+        """
+        Verify the proper number of intermediate files.
+        """
+        partial_files = [
+            f for f in os.listdir(self.temp_directory)
+            if re.match('notes-\d+.csv', f)
+        ]
+        error_files = [
+            f for f in os.listdir(self.temp_directory)
+            if re.match('notes-\d+-errors.csv', f)
+        ]
+        self.assertEqual(len(partial_files), len(error_files))
+
+    def test_final_output(self):
+        """
+        Verify the final output file's contents.
+        """
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            reader = csv.DictReader(f)
+            rows = tuple(row for row in reader)
+        entries = tuple(
+            sorted(
+                tuple(
+                    Note(
+                        int(row['id']),
+                        row['sender'],
+                        row['recipient'],
+                        row['message']
+                    )
+                    for row in rows
+                ),
+                cmp=lambda x, y: cmp(x.id, y.id)
+            )
+        )
+        self.assertEqual(entries, _expected_xml_results)
+
+
+class TestDoMultiProcess(unittest.TestCase):
+    """
+    Test the do_multi_process() method.
+    """
+    def test_parse_xml_objects(self):
+        """
+        A test case demonstrating parsing xml objects.
+        """
+        notes = tuple(
+            itertools.chain.from_iterable(
+                dredge.multi.do_multi_process(
+                    data=_test_xml_files,
+                    task=parser_task,
+                    cores_to_reserve=1
+                )
+            )
+        )
+        actual = tuple(sorted(notes, cmp=lambda x, y: cmp(x.id, y.id)))
+        self.assertEqual(actual, _expected_xml_results)
+
+
+def streaming_task(data, slice_start, slice_end, result_queue, **kwargs):
+    """
+    A task that sends each item, a string and an array for each index.
+    """
+    channel = kwargs['_result_channel']
+    for i in xrange(slice_start, slice_end):
+        channel.send(data[i])
+        channel.send('x' * data[i])
+        channel.send(array.array('d', [data[i]] * 3))
+
+
+def failing_streaming_task(
+        data, slice_start, slice_end, result_queue, **kwargs
+):
+    """
+    A task that sends each item, raising on 3.
+    """
+    channel = kwargs['_result_channel']
+    for i in xrange(slice_start, slice_end):
+        if data[i] == 3:
+            raise ValueError('bad item %i' % data[i])
+        channel.send(data[i])
+
+
+def exiting_streaming_task(
+        data, slice_start, slice_end, result_queue, **kwargs
+):
+    """
+    A task that sends each item, exiting its process on 3.
+    """
+    channel = kwargs['_result_channel']
+    for i in xrange(slice_start, slice_end):
+        if data[i] == 3:
+            channel.flush()
+            os._exit(3)
+        channel.send(data[i])
+
+
+class TestDoMultiProcessIter(unittest.TestCase):
+    """
+    Test the do_multi_process_iter() method.
+    """
+    def check_results(self, results, data):
+        """
+        Verify that every item sent by streaming_task() arrived intact.
+        @param results: The items received.
+        @param data: The data that were processed.
+        """
+        self.assertEqual(
+            sorted(r for r in results if isinstance(r, int)), data
+        )
+        self.assertEqual(
+            sorted(r for r in results if isinstance(r, str)),
+            sorted('x' * i for i in data)
+        )
+        arrays = [r for r in results if isinstance(r, array.array)]
+        self.assertEqual(
+            sorted(a.tolist() for a in arrays),
+            [[float(i)] * 3 for i in data]
+        )
+        self.assertTrue(all(a.typecode == 'd' for a in arrays))
+
+    def test_stream(self):
+        """
+        Items should arrive intact through the shared buffers.
+        """
+        data = range(500)
+        self.check_results(
+            list(
+                dredge.multi.do_multi_process_iter(
+                    data, streaming_task, cores_to_reserve=-1, batch_size=64,
+                    queue_depth=2
+                )
+            ),
+            data
+        )
+
+    def test_large_batches(self):
+        """
+        Batches larger than a buffer should be sent through the queue.
+        """
+        data = range(200)
+        self.check_results(
+            list(
+                dredge.multi.do_multi_process_iter(
+                    data, streaming_task, batch_size=100, queue_depth=1,
+                    buffer_size=256
+                )
+            ),
+            data
+        )
+
+    def test_close(self):
+        """
+        Workers should be stopped if the consumer stops reading.
+        """
+        results = dredge.multi.do_multi_process_iter(
+            range(10000), streaming_task, batch_size=10, queue_depth=1
+        )
+        self.assertEqual(next(results), 0)
+        results.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_task_error(self):
+        """
+        An exception in a task should be raised with its traceback.
+        """
+        results = list()
+        with self.assertRaises(dredge.multi.TaskError) as context:
+            for item in dredge.multi.do_multi_process_iter(
+                    range(10), failing_streaming_task, batch_size=1
+            ):
+                results.append(item)
+        self.assertIn('ValueError: bad item 3', str(context.exception))
+        self.assertIn(0, results)
+        self.assertNotIn(3, results)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_worker_exit(self):
+        """
+        A worker that exits before its task is done should raise an error.
+        """
+        with self.assertRaises(dredge.multi.TaskError) as context:
+            list(
+                dredge.multi.do_multi_process_iter(
+                    range(10), exiting_streaming_task, batch_size=1
+                )
+            )
+        self.assertIn('worker exited with code 3', str(context.exception))
+
+
+def sender_counts(file_path):
+    """
+    Map a note to a count of one for its sender.
+    @param file_path: Path to an xml note.
+    @return: A list of (sender, count) pairs.
+    """
+    return [(parser_func(file_path).sender, 1)]
+
+
+def failing_map_func(item):
+    """
+    Map an integer to itself, failing on 3.
+    @param item: An integer.
+    @return: A list of one (key, value) pair.
+    """
+    if item == 3:
+        raise ValueError('three')
+    return [('items', [item])]
+
+
+def failing_reduce_func(value, other_value):
+    """
+    Add two lists, failing if the second contains 3.
+    @param value: A list.
+    @param other_value: A list.
+    @return: The combined list.
+    """
+    if 3 in other_value:
+        raise ValueError('bad value')
+    return value + other_value
+
+
+def unpicklable_map_func(item):
+    """
+    Map an integer to a key that cannot be pickled.
+    @param item: An integer.
+    @return: A list of one (key, value) pair.
+    """
+    return [(lambda: item, item)]
+
+
+def exiting_task(data, slice_start, slice_end, result_queue, **kwargs):
+    """
+    A task that exits its process without putting a result.
+    """
+    os._exit(3)
+
+
+class TestDoMultiReduce(unittest.TestCase):
+    """
+    Test the do_multi_reduce() method.
+    """
+    def test_count(self):
+        """
+        Test counting notes by sender.
+        """
+        expected = collections.Counter(
+            note.sender for note in _expected_xml_results
+        )
+        self.assertEqual(
+            dredge.multi.do_multi_reduce(
+                _test_xml_files, sender_counts, operator.add
+            ),
+            dict(expected)
+        )
+
+    def test_order(self):
+        """
+        Values should be combined in the order of the data, so reducers need
+            not be commutative.
+        """
+        # reserve negative cores to use several workers on any machine
+        self.assertEqual(
+            dredge.multi.do_multi_reduce(
+                range(20), lambda item: [(item % 2, [item])], operator.add,
+                cores_to_reserve=-3
+            ),
+            {0: range(0, 20, 2), 1: range(1, 20, 2)}
+        )
+
+    def test_error_handler(self):
+        """
+        Items on which the map function fails should be passed to the handler
+            and skipped.
+        """
+        errors = list()
+        self.assertEqual(
+            dredge.multi.do_multi_reduce(
+                range(6), failing_map_func, operator.add,
+                on_error=lambda item, tb: errors.append(item)
+            ),
+            {'items': [0, 1, 2, 4, 5]}
+        )
+        self.assertEqual(errors, [3])
+
+    def test_error(self):
+        """
+        Failures should raise a MapError without an error handler.
+        """
+        self.assertRaises(
+            dredge.multi.MapError, dredge.multi.do_multi_reduce,
+            range(6), failing_map_func, operator.add
+        )
+
+    def test_reduce_error(self):
+        """
+        Items on which the reduce function fails should be passed to the
+            handler.
+        """
+        errors = list()
+        dredge.multi.do_multi_reduce(
+            range(6), lambda item: [('items', [item])], failing_reduce_func,
+            cores_to_reserve=dredge.multi.CPU_COUNT,
+            on_error=lambda item, tb: errors.append(item)
+        )
+        self.assertEqual(errors, [3])
+
+    def test_unpicklable_result(self):
+        """
+        An aggregate that cannot be pickled should raise a TaskError rather
+            than leave the parent waiting.
+        """
+        self.assertRaises(
+            dredge.multi.TaskError, dredge.multi.do_multi_reduce,
+            range(6), unpicklable_map_func, operator.add
+        )
+
+    def test_worker_exit(self):
+        """
+        A worker that exits without a result should raise a TaskError.
+        """
+        self.assertRaises(
+            dredge.multi.TaskError, dredge.multi.do_multi_process,
+            range(6), exiting_task
+        )
+
+
+class TestParseArchive(unittest.TestCase):
+    """
+    Test the archive parameter of do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Store the test files in an archive and parse them from it, along with
+            an id that is not in the archive.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        archive = dredge.archive.SegmentArchive(
+            os.path.join(self.temp_directory, 'archive')
+        )
+        for i, file_path in enumerate(_test_xml_files):
+            with open(file_path) as f:
+                archive.put(i + 1, f.read())
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=range(1, 9) + [99],
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=document_parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            archive=archive
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_final_output(self):
+        """
+        Verify the final output file's contents.
+        """
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            entries = tuple(
+                sorted(
+                    (
+                        Note(
+                            int(row['id']), row['sender'], row['recipient'],
+                            row['message']
+                        )
+                        for row in csv.DictReader(f)
+                    ),
+                    key=lambda note: note.id
+                )
+            )
+        self.assertEqual(entries, _expected_xml_results)
+
+    def test_missing_id(self):
+        """
+        An id missing from the archive should be logged as an error.
+        """
+        with open(
+            os.path.join(self.temp_directory, 'notes-errors.csv')
+        ) as f:
+            self.assertEqual(
+                [(row['file'], row['error']) for row in csv.DictReader(f)],
+                [('99', 'missing from archive')]
+            )
+
+
+class TestParseArchiveDuplicates(unittest.TestCase):
+    """
+    Test parsing identical documents from an archive with
+        do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Store the test files in an archive, along with two copies of the first
+            file under different ids, and parse them from it.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        archive = dredge.archive.SegmentArchive(
+            os.path.join(self.temp_directory, 'archive')
+        )
+        file_paths = _test_xml_files + _test_xml_files[:1] * 2
+        for i, file_path in enumerate(file_paths):
+            with open(file_path) as f:
+                archive.put(i + 1, f.read())
+        self.metrics = dredge.metrics.Metrics()
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=range(1, 11),
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=document_parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            archive=archive,
+            document_id_column=0,
+            metrics=self.metrics
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_parsed_once(self):
+        """
+        Identical documents should only be parsed once.
+        """
+        self.assertEqual(self.metrics.counters['parse.files'], 8)
+        self.assertEqual(self.metrics.counters['parse.rows'], 10)
+
+    def test_rows_fanned_out(self):
+        """
+        Each id should have its own row, with the id set to the archive id.
+        """
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            rows = dict((int(row['id']), row) for row in csv.DictReader(f))
+        self.assertEqual(sorted(rows.keys()), range(1, 11))
+        self.assertEqual(rows[9]['message'], rows[1]['message'])
+        self.assertEqual(rows[10]['message'], rows[1]['message'])
+
+
+class TestParseCache(unittest.TestCase):
+    """
+    Test the parse_cache parameter of do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Create a parse cache in a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.parse_cache = dredge.cache.ParseCache(
+            os.path.join(self.temp_directory, 'cache'), version='notes-1'
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def parse(self):
+        """
+        Parse the test files using the cache.
+        @return: The metrics collected while parsing.
+        """
+        metrics = dredge.metrics.Metrics()
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            metrics=metrics,
+            parse_cache=self.parse_cache
+        )
+        return metrics
+
+    def test_replay(self):
+        """
+        A second run should replay every file from the cache.
+        """
+        self.assertEqual(self.parse().counters['parse.cache_misses'], 8)
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            first_output = f.read()
+        self.assertEqual(self.parse().counters['parse.cache_hits'], 8)
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            self.assertEqual(f.read(), first_output)
+
+
+class TestFileTimeout(unittest.TestCase):
+    """
+    Test the file_timeout parameter of do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Parse the test files with a parser that hangs on one of them.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=slow_parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            file_timeout=0.5
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_timeout_logged(self):
+        """
+        The slow file should be logged with a timeout reason.
+        """
+        with open(
+            os.path.join(self.temp_directory, 'notes-errors.csv')
+        ) as f:
+            rows = tuple(csv.DictReader(f))
+        self.assertEqual(len(rows), 1)
+        self.assertTrue(rows[0]['file'].endswith('03.xml'))
+        self.assertTrue(rows[0]['error'].startswith('timeout'))
+
+    def test_other_files_parsed(self):
+        """
+        All other files should still be parsed.
+        """
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            ids = sorted(int(row['id']) for row in csv.DictReader(f))
+        self.assertEqual(ids, [1, 2, 4, 5, 6, 7, 8])
+
+
+class TestFileTimeoutThread(TestFileTimeout):
+    """
+    Test the file_timeout parameter of do_multi_parse_to_csv() when it is
+        called from a thread other than the main thread.
+    """
+    def setUp(self):
+        """
+        Parse the test files from another thread.
+        """
+        thread = threading.Thread(
+            target=super(TestFileTimeoutThread, self).setUp
+        )
+        thread.start()
+        thread.join()
+
+
+class TestLogStalledFile(unittest.TestCase):
+    """
+    Test the _log_stalled_file() method.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_duplicate_ids(self):
+        """
+        Every id of a stalled document with duplicates should be logged.
+        """
+        dredge.multi._log_stalled_file(
+            'a', 0, 'timeout', self.temp_directory, 'notes',
+            duplicate_ids={'a': ['a', 'b', 'c']}
+        )
+        with open(os.path.join(self.temp_directory, 'notes-0-errors.csv')) as f:
+            self.assertEqual(
+                [row['file'] for row in csv.DictReader(f)], ['a', 'b', 'c']
+            )
+
+
+class TestWatchdog(unittest.TestCase):
+    """
+    Test the item_timeout parameter of do_multi_process().
+    """
+    def test_replace_hung_worker(self):
+        """
+        A hung worker should be replaced and the hung item reported.
+        """
+        stalled = list()
+        results = dredge.multi.do_multi_process(
+            data=range(8),
+            task=hanging_task,
+            cores_to_reserve=0,
+            item_timeout=0.5,
+            on_item_timeout=lambda item, task_index, reason: stalled.append(
+                (item, reason)
+            )
+        )
+        # items the hung worker finished before item 3 are lost with it
+        items = set(itertools.chain.from_iterable(results))
+        self.assertNotIn(3, items)
+        self.assertTrue(set([4, 5, 6, 7]).issubset(items))
+        self.assertEqual(len(stalled), 1)
+        self.assertEqual(stalled[0][0], 3)
+        self.assertTrue(stalled[0][1].startswith('timeout'))
+
+
+class TestWorkerRecycling(unittest.TestCase):
+    """
+    Test the max_files_per_task and max_task_memory parameters of
+        do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def parse(self, **kwargs):
+        """
+        Parse the test files with a single worker.
+        @param kwargs: Any additional keyword arguments for
+            do_multi_parse_to_csv().
+        @return: The sorted ids in the final output.
+        """
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=dredge.multi.CPU_COUNT,
+            id_column=0,
+            **kwargs
+        )
+        with dredge.compression.open_file(
+            os.path.join(
+                self.temp_directory, 'notes.csv%s' % (
+                    dredge.compression.get_extension(kwargs.get('compression'))
+                )
+            )
+        ) as f:
+            return sorted(int(row['id']) for row in csv.DictReader(f))
+
+    def test_max_files_per_task(self):
+        """
+        Replacing the worker after every file should not lose any rows.
+        """
+        self.assertEqual(
+            self.parse(max_files_per_task=1),
+            [note.id for note in _expected_xml_results]
+        )
+
+    def test_max_files_per_task_compressed(self):
+        """
+        Rows staged by replaced workers should be kept in compressed output.
+        """
+        self.assertEqual(
+            self.parse(max_files_per_task=1, compression='gzip'),
+            [note.id for note in _expected_xml_results]
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.temp_directory)),
+            ['notes-errors.csv', 'notes.csv.gz']
+        )
+
+    def test_max_task_memory(self):
+        """
+        Replacing the worker whenever it exceeds its memory budget should not
+            lose any rows.
+        """
+        self.assertEqual(
+            self.parse(max_task_memory=1),
+            [note.id for note in _expected_xml_results]
+        )
+        with open(
+            os.path.join(self.temp_directory, 'notes-errors.csv')
+        ) as f:
+            self.assertEqual(len(list(csv.reader(f))), 1)
+
+
+class TestParseSchema(unittest.TestCase):
+    """
+    Test the schema parameter of do_multi_parse_to_csv().
     """
     def setUp(self):
         """
-        Call the method to create the test output files. Note that the output of
-            parser_func is expected to be a namedtuple type with an attribute
-            called 'id'.
+        Parse the test files, allowing ids of at most 6.
         """
         self.temp_directory = dredge.tests.get_temp_directory()
+        self.metrics = dredge.metrics.Metrics()
         dredge.multi.do_multi_parse_to_csv(
             file_paths=_test_xml_files,
             output_folder=self.temp_directory,
             task_name='notes',
             parser_func=parser_func,
-            cores_to_reserve=1,
-            delimiter=',',
-            id_column=0
+            cores_to_reserve=0,
+            id_column=0,
+            metrics=self.metrics,
+            profile_files=True,
+            schema={'id': dredge.validation.Column('int', max_value=6)},
+            validation_batch_size=3
         )
 
     def tearDown(self):
@@ -145,63 +929,218 @@ class TestDoMultiParseToCSV(unittest.TestCase):
         """
         shutil.rmtree(self.temp_directory)
 
-    def test_intermediate_output(self):
+    def test_valid_rows(self):
         """
-        Verify the proper number of intermediate files.
+        Only valid rows should be written.
         """
-        partial_files = [
-            f for f in os.listdir(self.temp_directory)
-            if re.match('notes-\d+.csv', f)
-        ]
-        error_files = [
-            f for f in os.listdir(self.temp_directory)
-            if re.match('notes-\d+-errors.csv', f)
-        ]
-        self.assertEqual(len(partial_files), len(error_files))
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            ids = sorted(int(row['id']) for row in csv.DictReader(f))
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 6])
 
-    def test_final_output(self):
+    def test_invalid_rows(self):
         """
-        Verify the final output file's contents.
+        Invalid rows should be logged under the files that produced them.
         """
-        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
-            reader = csv.DictReader(f)
-            rows = tuple(row for row in reader)
-        entries = tuple(
-            sorted(
-                tuple(
-                    Note(
-                        int(row['id']),
-                        row['sender'],
-                        row['recipient'],
-                        row['message']
-                    )
-                    for row in rows
-                ),
-                cmp=lambda x, y: cmp(x.id, y.id)
+        with open(os.path.join(self.temp_directory, 'notes-errors.csv')) as f:
+            rows = sorted(csv.DictReader(f), key=lambda row: row['file'])
+        self.assertEqual(
+            [row['file'] for row in rows], _test_xml_files[6:]
+        )
+        self.assertEqual(
+            [row['error'] for row in rows], [
+                'invalid row: id 7 out of range [None, 6]',
+                'invalid row: id 8 out of range [None, 6]'
+            ]
+        )
+
+    def test_row_counts(self):
+        """
+        Rejected rows should not be counted as parsed.
+        """
+        self.assertEqual(self.metrics.counters['parse.rows'], 6)
+        self.assertEqual(self.metrics.counters['parse.invalid_rows'], 2)
+        with open(
+            os.path.join(self.temp_directory, 'notes-profile.csv')
+        ) as f:
+            rows = dict(
+                (row['file'], int(row['rows'])) for row in csv.DictReader(f)
+            )
+        self.assertEqual(
+            rows, dict(
+                (file_path, int(i < 6))
+                for i, file_path in enumerate(_test_xml_files)
             )
         )
-        self.assertEqual(entries, _expected_xml_results)
+
+    def test_unknown_field(self):
+        """
+        A schema field that the rows lack should raise a ValueError before
+            any worker is started.
+        """
+        self.assertRaises(
+            ValueError, dredge.multi.do_multi_parse_to_csv,
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            schema={'total': dredge.validation.Column('int')}
+        )
 
 
-class TestDoMultiProcess(unittest.TestCase):
+class TestParseSchemaDuplicates(unittest.TestCase):
     """
-    Test the do_multi_process() method.
+    Test the schema parameter of do_multi_parse_to_csv() with identical
+        documents in an archive.
     """
-    def test_parse_xml_objects(self):
+    def setUp(self):
         """
-        A test case demonstrating parsing xml objects.
+        Store the test files in an archive, along with two copies of the first
+            file under different ids, and parse them from it, allowing ids of
+            at most 6.
         """
-        notes = tuple(
-            itertools.chain.from_iterable(
-                dredge.multi.do_multi_process(
-                    data=_test_xml_files,
-                    task=parser_task,
-                    cores_to_reserve=1
-                )
-            )
+        self.temp_directory = dredge.tests.get_temp_directory()
+        archive = dredge.archive.SegmentArchive(
+            os.path.join(self.temp_directory, 'archive')
+        )
+        file_paths = _test_xml_files + _test_xml_files[:1] * 2
+        for i, file_path in enumerate(file_paths):
+            with open(file_path) as f:
+                archive.put(i + 1, f.read())
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=range(1, 11),
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=document_parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            archive=archive,
+            document_id_column=0,
+            schema={'id': dredge.validation.Column('int', max_value=6)}
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_invalid_rows(self):
+        """
+        Invalid rows should be logged under their own ids rather than the id
+            of the document that was parsed.
+        """
+        with open(os.path.join(self.temp_directory, 'notes-errors.csv')) as f:
+            ids = sorted(int(row['file']) for row in csv.DictReader(f))
+        self.assertEqual(ids, [7, 8, 9, 10])
+
+
+class TestParseMetrics(unittest.TestCase):
+    """
+    Test the metrics parameter of do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Parse the test files while collecting metrics.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.metrics = dredge.metrics.Metrics(
+            log_path=os.path.join(self.temp_directory, 'metrics.jsonl')
+        )
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            metrics=self.metrics
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_worker_metrics_merged(self):
+        """
+        Measurements from all workers should be merged into the collector.
+        """
+        self.assertEqual(self.metrics.counters['parse.files'], 8)
+        self.assertEqual(self.metrics.counters['parse.rows'], 8)
+        self.assertEqual(self.metrics.histograms['parse.file_time'].count, 8)
+
+    def test_log_written(self):
+        """
+        The final snapshot should be logged.
+        """
+        with open(os.path.join(self.temp_directory, 'metrics.jsonl')) as f:
+            lines = f.readlines()
+        self.assertEqual(json.loads(lines[-1])['counters']['parse.files'], 8)
+
+
+class TestParseProfiling(unittest.TestCase):
+    """
+    Test the profiling parameters of do_multi_parse_to_csv().
+    """
+    def setUp(self):
+        """
+        Parse the test files with profiling enabled.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        # stats left by an earlier run should not be merged
+        profile = cProfile.Profile()
+        profile.runcall(parser_func, _test_xml_files[0])
+        profile.dump_stats(
+            os.path.join(self.temp_directory, 'notes-0-1.prof')
+        )
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            profile_files=True,
+            profile_code=True
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def test_file_profile(self):
+        """
+        Every file should be listed in the profile with its row count.
+        """
+        with open(
+            os.path.join(self.temp_directory, 'notes-profile.csv')
+        ) as f:
+            rows = tuple(csv.DictReader(f))
+        self.assertEqual(
+            sorted(row['file'] for row in rows), sorted(_test_xml_files)
+        )
+        self.assertTrue(all(row['rows'] == '1' for row in rows))
+        self.assertTrue(all(float(row['wall_time']) >= 0 for row in rows))
+
+    def test_code_profile(self):
+        """
+        Worker stats should be merged into a single stats file.
+        """
+        stats = pstats.Stats(
+            os.path.join(self.temp_directory, 'notes.prof')
+        )
+        parser_calls = [
+            call_count for (path, line, name), (call_count, _, _, _, _)
+            in stats.stats.iteritems() if name == 'parser_func'
+        ]
+        self.assertEqual(parser_calls, [8])
+        self.assertEqual(
+            [f for f in os.listdir(self.temp_directory) if f.endswith('.prof')],
+            ['notes.prof']
         )
-        actual = tuple(sorted(notes, cmp=lambda x, y: cmp(x.id, y.id)))
-        self.assertEqual(actual, _expected_xml_results)
 
 
 class TestGetMultiprocessSliceRanges(unittest.TestCase):
@@ -365,6 +1304,196 @@ class TestMergeCSVFiles(unittest.TestCase):
         self.assertEqual(actual, expected)
 
 
+class TestMergeCompressedCSVFiles(TestMergeCSVFiles):
+    """
+    Test the merge_csv_files() method with compressed input and output.
+    """
+    def compress_inputs(self, name_format, extension='.gz'):
+        """
+        Compress the test input files into the temp directory.
+        @param name_format: Format string for the names of the test files.
+        @param extension: Extension indicating the codec to use.
+        @return: A list of paths to the compressed files.
+        """
+        input_paths = list()
+        for i in range(4):
+            file_name = name_format % i
+            with open(
+                os.path.join(dredge.tests.TEST_FILES_FOLDER, file_name)
+            ) as f:
+                contents = f.read()
+            input_path = os.path.join(
+                self.temp_directory, file_name + extension
+            )
+            with dredge.compression.open_file(input_path, 'wb') as f:
+                f.write(contents)
+            input_paths.append(input_path)
+        return input_paths
+
+    def read_output(self, output_path):
+        """
+        @param output_path: Path to a compressed csv file.
+        @return: A tuple of the rows in the file.
+        """
+        with dredge.compression.open_file(output_path) as csv_file:
+            return tuple(tuple(row) for row in csv.reader(csv_file))
+
+    def test_stitch_compressed(self):
+        """
+        Test stitching compressed files with headers.
+        """
+        output_path = os.path.join(self.temp_directory, 'merge.csv.gz')
+        dredge.multi.merge_csv_files(
+            input_paths=self.compress_inputs('merge-%02i.csv'),
+            output_path=output_path,
+            delimiter=',',
+            headers=self.expected_headers,
+            remove_inputs=True
+        )
+        self.assertEqual(
+            self.read_output(output_path),
+            tuple(self.expected_headers + self.expected_data)
+        )
+        self.assertEqual(os.listdir(self.temp_directory), ['merge.csv.gz'])
+
+    def test_concatenate_compressed(self):
+        """
+        Test concatenating compressed files without headers.
+        """
+        output_path = os.path.join(self.temp_directory, 'merge.csv.gz')
+        dredge.multi.merge_csv_files(
+            input_paths=self.compress_inputs('merge-%02i-no_headers.csv'),
+            output_path=output_path,
+            delimiter=',',
+            headers=None
+        )
+        self.assertEqual(
+            self.read_output(output_path), tuple(self.expected_data)
+        )
+
+    def test_change_codec(self):
+        """
+        Test merging files compressed with one codec into another.
+        """
+        output_path = os.path.join(self.temp_directory, 'merge.csv')
+        dredge.multi.merge_csv_files(
+            input_paths=self.compress_inputs('merge-%02i-no_headers.csv'),
+            output_path=output_path,
+            delimiter=',',
+            headers=None
+        )
+        self.assertEqual(
+            self.read_output(output_path), tuple(self.expected_data)
+        )
+
+    def test_unique_ids_compressed(self):
+        """
+        Test compressed files with a primary key.
+        """
+        output_path = os.path.join(self.temp_directory, 'merge.csv.gz')
+        dredge.multi.merge_csv_files(
+            input_paths=self.compress_inputs('merge-%02i.csv') * 2,
+            output_path=output_path,
+            delimiter=',',
+            headers=self.expected_headers,
+            id_column=0
+        )
+        self.assertEqual(
+            self.read_output(output_path),
+            tuple(self.expected_headers + self.expected_data)
+        )
+
+
+class TestParseCompressed(unittest.TestCase):
+    """
+    Test the do_multi_parse_to_csv() method with compressed output.
+    """
+    def setUp(self):
+        """
+        Create a temp directory.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def parse(self, compression, id_column):
+        """
+        Parse the test files with compressed output.
+        @param compression: The codec to use.
+        @param id_column: The primary key column, or None.
+        @return: A tuple of Note objects from the final output, sorted by id.
+        """
+        dredge.multi.do_multi_parse_to_csv(
+            file_paths=_test_xml_files,
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            id_column=id_column,
+            compression=compression
+        )
+        output_path = os.path.join(
+            self.temp_directory,
+            'notes.csv%s' % dredge.compression.get_extension(compression)
+        )
+        with dredge.compression.open_file(output_path) as f:
+            return tuple(
+                sorted(
+                    Note(
+                        int(row['id']), row['sender'], row['recipient'],
+                        row['message']
+                    ) for row in csv.DictReader(f)
+                )
+            )
+
+    def test_gzip(self):
+        """
+        Test gzip output with a primary key.
+        """
+        self.assertEqual(self.parse('gzip', 0), _expected_xml_results)
+
+    def test_compressed_size(self):
+        """
+        Compressed output of many small files should be smaller than plain
+            output, since each task writes one member rather than one per file.
+        """
+        sizes = dict()
+        for compression in (None, 'gzip'):
+            output_folder = os.path.join(self.temp_directory, str(compression))
+            os.mkdir(output_folder)
+            dredge.multi.do_multi_parse_to_csv(
+                file_paths=_test_xml_files * 200,
+                output_folder=output_folder,
+                task_name='notes',
+                parser_func=parser_func,
+                include_headers=False,
+                compression=compression
+            )
+            output_path = os.path.join(
+                output_folder,
+                'notes.csv%s' % dredge.compression.get_extension(compression)
+            )
+            sizes[compression] = os.path.getsize(output_path)
+            self.assertEqual(
+                sorted(os.listdir(output_folder)),
+                sorted([os.path.basename(output_path), 'notes-errors.csv'])
+            )
+        self.assertLess(sizes['gzip'], sizes[None] / 4)
+
+    @unittest.skipIf(
+        not dredge.compression.is_codec_available('zstd'),
+        'zstandard is not installed'
+    )
+    def test_zstd(self):
+        """
+        Test zstd output without a primary key.
+        """
+        self.assertEqual(self.parse('zstd', None), _expected_xml_results)
+
+
 class TestGetNumTasks(unittest.TestCase):
     """
     Test the get_num_tasks() method.
@@ -413,6 +1542,20 @@ class TestGetNumTasks(unittest.TestCase):
             len(self.small_data)
         )
 
+    def test_memory_per_task(self):
+        """
+        Should start no more tasks than fit in the available memory, but always
+            at least one.
+        """
+        self.assertEqual(
+            dredge.multi.get_num_tasks(0, self.data, memory_per_task=2 ** 62),
+            1
+        )
+        self.assertEqual(
+            dredge.multi.get_num_tasks(0, self.data, memory_per_task=1),
+            dredge.multi.CPU_COUNT
+        )
+
 
 class TestSortFilePathsForLoadBalancing(unittest.TestCase):
     """
@@ -436,6 +1579,33 @@ class TestSortFilePathsForLoadBalancing(unittest.TestCase):
         actual = dredge.multi.sort_file_paths_for_load_balancing(_test_xml_files, 4)
         self.assertEqual(expected, actual)
 
+    def test_supplied_sizes(self):
+        """
+        Sizes supplied by the caller should be used instead of those on disk.
+        """
+        file_sizes = dict((str(i), i) for i in xrange(8))
+        actual = dredge.multi.sort_file_paths_for_load_balancing(
+            [str(i) for i in xrange(8)], 4, file_sizes=file_sizes
+        )
+        self.assertEqual(actual, ('7', '3', '6', '2', '5', '1', '4', '0'))
+
+    def test_corpus_index(self):
+        """
+        Sizes from a corpus index should be used, and sizes missing from it
+            read from disk.
+        """
+        index = dredge.corpus.CorpusIndex.scan(dredge.tests.TEST_FILES_FOLDER)
+        file_sizes = index.get_file_sizes()
+        del file_sizes[_test_xml_files[0]]
+        self.assertEqual(
+            dredge.multi.sort_file_paths_for_load_balancing(
+                _test_xml_files, 2, file_sizes=file_sizes
+            ),
+            dredge.multi.sort_file_paths_for_load_balancing(
+                _test_xml_files, 2
+            )
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.pipeline. The tests download from a local
+dredge.benchmarks.StubServer, so they do not require a network connection.
+"""
+
+import csv
+import lxml.etree
+import multiprocessing
+import os
+import shutil
+import unittest
+import dredge.benchmarks
+import dredge.multi
+import dredge.pipeline
+import dredge.tests
+from dredge.tests.multi import Note
+
+
+def document_parser_func(document):
+    """
+    An example function with the required method signature for a document
+        parser function.
+    @param document: The downloaded data.
+    """
+    note = lxml.etree.fromstring(document)
+    if note.attrib['id'] == '13':
+        raise ValueError('unlucky note')
+    return Note(
+        int(note.attrib['id']),
+        note.find('from').text,
+        note.find('to').text,
+        note.find('message').text
+    )
+
+
+def exiting_document_parser_func(document):
+    """
+    A document parser function whose process exits on one document.
+    @param document: The downloaded data.
+    """
+    if lxml.etree.fromstring(document).attrib['id'] == '5':
+        os._exit(3)
+    return document_parser_func(document)
+
+
+class TestStreamDownloadAndParse(unittest.TestCase):
+    """
+    Test the stream_download_and_parse() method.
+    """
+    def setUp(self):
+        """
+        Start a stub server and stream its documents into a csv.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.archive_directory = os.path.join(self.temp_directory, 'archive')
+        self.item_ids = range(20)
+        self.server = dredge.benchmarks.StubServer()
+        self.server.start()
+
+    def tearDown(self):
+        """
+        Stop the server and clean up the temp directory.
+        """
+        self.server.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def stream(self, url_template, parser_func=document_parser_func):
+        """
+        Stream the test items into a csv.
+        @param url_template: URL template for the items.
+        @param parser_func: The document parser function.
+        """
+        dredge.pipeline.stream_download_and_parse(
+            item_ids=self.item_ids,
+            url_template=url_template,
+            url_format_expression=lambda item_id: {'id': item_id},
+            output_folder=self.temp_directory,
+            task_name='notes',
+            parser_func=parser_func,
+            cores_to_reserve=0,
+            id_column=0,
+            archive_directory=self.archive_directory,
+            sleep_time=0
+        )
+
+    def read_output(self):
+        """
+        @return: A tuple of the ids in the csv output and the rows of the error
+            log.
+        """
+        with open(os.path.join(self.temp_directory, 'notes.csv')) as f:
+            ids = sorted(int(row['id']) for row in csv.DictReader(f))
+        with open(os.path.join(self.temp_directory, 'notes-errors.csv')) as f:
+            errors = tuple(csv.DictReader(f))
+        return ids, errors
+
+    def test_output(self):
+        """
+        All documents but the unparseable one should be in the output.
+        """
+        self.stream(self.server.url + '/thing?id={id}')
+        ids, errors = self.read_output()
+        self.assertEqual(ids, [i for i in self.item_ids if i != 13])
+        self.assertEqual([row['file'] for row in errors], ['13'])
+        self.assertEqual(
+            sorted(
+                f for f in os.listdir(self.temp_directory)
+                if f.startswith('notes')
+            ),
+            ['notes-errors.csv', 'notes.csv']
+        )
+
+    def test_archive(self):
+        """
+        Archived documents should be reused instead of downloaded again.
+        """
+        self.stream(self.server.url + '/thing?id={id}')
+        self.assertEqual(
+            len(os.listdir(self.archive_directory)), len(self.item_ids)
+        )
+        self.stream(self.server.url + '/missing?id={id}')
+        ids, errors = self.read_output()
+        self.assertEqual(ids, [i for i in self.item_ids if i != 13])
+        self.assertEqual(len(errors), 1)
+
+    def test_fetch_errors(self):
+        """
+        Every failed download should be in the error log.
+        """
+        self.stream(self.server.url + '/missing?id={id}')
+        ids, errors = self.read_output()
+        self.assertEqual(ids, [])
+        self.assertEqual(
+            sorted(int(row['file']) for row in errors), self.item_ids
+        )
+
+    def test_worker_exit(self):
+        """
+        A parser worker that dies should raise an error rather than leave the
+            pipeline waiting for its result.
+        """
+        self.assertRaises(
+            dredge.multi.TaskError, self.stream,
+            self.server.url + '/thing?id={id}', exiting_document_parser_func
+        )
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.resources.
+"""
+
+import multiprocessing
+import os
+import shutil
+import unittest
+import dredge.resources
+import dredge.tests
+
+
+class ResourceTestCase(unittest.TestCase):
+    """
+    Base class for tests that read fake proc and cgroup files.
+    """
+    def setUp(self):
+        """
+        Create empty proc and cgroup directories.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.proc_path = os.path.join(self.temp_directory, 'proc')
+        self.cgroup_root = os.path.join(self.temp_directory, 'cgroup')
+        os.makedirs(self.proc_path)
+        os.makedirs(self.cgroup_root)
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        shutil.rmtree(self.temp_directory)
+
+    def write_file(self, path, contents):
+        """
+        Write a fake file, creating its directory if necessary.
+        @param path: Path to the file.
+        @param contents: The contents of the file.
+        """
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+
+class TestGetAvailableCPUCount(ResourceTestCase):
+    """
+    Test the get_available_cpu_count() method.
+    """
+    def get_count(self):
+        """
+        @return: The number of processors according to the fake files.
+        """
+        return dredge.resources.get_available_cpu_count(
+            proc_path=self.proc_path, cgroup_root=self.cgroup_root
+        )
+
+    def test_no_limits(self):
+        """
+        Without an affinity mask or quota, every processor is available.
+        """
+        self.assertEqual(self.get_count(), multiprocessing.cpu_count())
+
+    def test_affinity(self):
+        """
+        Only the processors in the affinity mask should be counted.
+        """
+        self.write_file(
+            os.path.join(self.proc_path, 'status'),
+            'Name:\tpython\nCpus_allowed_list:\t0\n'
+        )
+        self.assertEqual(self.get_count(), 1)
+
+    def test_count_cpu_list(self):
+        """
+        Ranges and single processors should both be counted.
+        """
+        self.assertEqual(dredge.resources._count_cpu_list('0-3,8,10-11'), 7)
+
+    def test_cgroup_v2_quota(self):
+        """
+        A version 2 quota should be rounded up to whole processors.
+        """
+        self.write_file(
+            os.path.join(self.proc_path, 'cgroup'), '0::/job\n'
+        )
+        self.write_file(
+            os.path.join(self.cgroup_root, 'job', 'cpu.max'), '50000 100000\n'
+        )
+        self.assertEqual(self.get_count(), 1)
+
+    def test_cgroup_v2_unlimited(self):
+        """
+        A version 2 quota of max should not limit the count.
+        """
+        self.write_file(os.path.join(self.cgroup_root, 'cpu.max'), 'max 100000')
+        self.assertEqual(self.get_count(), multiprocessing.cpu_count())
+
+    def test_cgroup_v1_quota(self):
+        """
+        A version 1 quota of -1 means unlimited; otherwise it should be used.
+        """
+        self.write_file(
+            os.path.join(self.proc_path, 'cgroup'),
+            '5:memory:/job\n4:cpu,cpuacct:/job\n'
+        )
+        quota_path = os.path.join(self.cgroup_root, 'cpu', 'job')
+        self.write_file(os.path.join(quota_path, 'cpu.cfs_period_us'), '100000')
+        self.write_file(os.path.join(quota_path, 'cpu.cfs_quota_us'), '-1')
+        self.assertEqual(self.get_count(), multiprocessing.cpu_count())
+        self.write_file(os.path.join(quota_path, 'cpu.cfs_quota_us'), '100000')
+        self.assertEqual(self.get_count(), 1)
+
+
+class TestGetAvailableMemory(ResourceTestCase):
+    """
+    Test the get_available_memory() method.
+    """
+    def get_memory(self):
+        """
+        @return: The available memory according to the fake files.
+        """
+        return dredge.resources.get_available_memory(
+            proc_path=self.proc_path,
+            meminfo_path=os.path.join(self.proc_path, 'meminfo'),
+            cgroup_root=self.cgroup_root
+        )
+
+    def test_unknown(self):
+        """
+        Should return None if no memory information can be found.
+        """
+        self.assertIsNone(self.get_memory())
+
+    def test_meminfo(self):
+        """
+        Should read the available memory of the system in kilobytes.
+        """
+        self.write_file(
+            os.path.join(self.proc_path, 'meminfo'),
+            'MemTotal:       8000 kB\nMemAvailable:   4000 kB\n'
+        )
+        self.assertEqual(self.get_memory(), 4000 * 1024)
+
+    def test_cgroup_v2_limit(self):
+        """
+        Should subtract current usage from a version 2 limit.
+        """
+        self.write_file(os.path.join(self.cgroup_root, 'memory.max'), '3000')
+        self.write_file(
+            os.path.join(self.cgroup_root, 'memory.current'), '1000'
+        )
+        self.assertEqual(self.get_memory(), 2000)
+
+    def test_cgroup_v1_limit(self):
+        """
+        Should use the smaller of the system and version 1 limits, ignoring
+            limits that mean unlimited.
+        """
+        self.write_file(
+            os.path.join(self.proc_path, 'meminfo'), 'MemAvailable:   4 kB\n'
+        )
+        memory_path = os.path.join(self.cgroup_root, 'memory')
+        self.write_file(
+            os.path.join(memory_path, 'memory.limit_in_bytes'),
+            '9223372036854771712'
+        )
+        self.write_file(
+            os.path.join(memory_path, 'memory.usage_in_bytes'), '1000'
+        )
+        self.assertEqual(self.get_memory(), 4096)
+        self.write_file(
+            os.path.join(memory_path, 'memory.limit_in_bytes'), '3000'
+        )
+        self.assertEqual(self.get_memory(), 2000)
+
+
+class TestGetRSS(unittest.TestCase):
+    """
+    Test the get_rss() method.
+    """
+    def test_rss(self):
+        """
+        Should report a resident set size that grows with allocations.
+        """
+        rss = dredge.resources.get_rss()
+        self.assertGreater(rss, 0)
+        data = 'x' * (64 * 1024 * 1024)
+        self.assertGreater(dredge.resources.get_rss(), rss)
+        del data
+
+
+if __name__ == '__main__':
+    unittest.main()
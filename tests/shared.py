@@ -0,0 +1,162 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.multi.
+Module to test dredge.shared.
+"""
+
+import cPickle
+import functools
+import os
+import shutil
+import unittest
+import dredge.multi
+import dredge.shared
+import dredge.tests
+
+
+def lookup_task(keys, slice_start, slice_end, result_queue, lookup, **kwargs):
+    """
+    A task that looks up each of its keys in a shared mapping.
+    @param keys: A collection of keys to look up.
+    @param slice_start: The start for the range to be looked up.
+    @param slice_end: The end of the range to be looked up.
+    @param result_queue: The queue into which the result should be placed.
+    @param lookup: A SharedMapping.
+    @param kwargs: Method signature requirement.
+    """
+    result_queue.put([lookup[keys[i]] for i in xrange(slice_start, slice_end)])
+
+
+class TestSharedMapping(unittest.TestCase):
+    """
+    Test the SharedMapping class.
+    """
+    def setUp(self):
+        """
+        Write a shared mapping to disk.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.data = dict(
+            [(i, 'value %i' % i) for i in xrange(100)] +
+            [('name', {'nested': [1, 2, 3]})]
+        )
+        self.mapping = dredge.shared.create_shared_mapping(
+            self.data, os.path.join(self.temp_directory, 'mapping.bin')
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        self.mapping.close()
+        shutil.rmtree(self.temp_directory)
+
+    def test_lookup(self):
+        """
+        Every key should map to its original value.
+        """
+        for key, value in self.data.iteritems():
+            self.assertEqual(self.mapping[key], value)
+        self.assertEqual(len(self.mapping), len(self.data))
+        self.assertEqual(sorted(self.mapping.keys()), sorted(self.data.keys()))
+
+    def test_missing_key(self):
+        """
+        Missing keys should behave as they do for a dict.
+        """
+        self.assertNotIn('missing', self.mapping)
+        self.assertIsNone(self.mapping.get('missing'))
+        self.assertRaises(KeyError, lambda: self.mapping['missing'])
+
+    def test_pickle_carries_only_path(self):
+        """
+        Pickling should not copy the data.
+        """
+        pickled = cPickle.dumps(self.mapping, 2)
+        self.assertNotIn('value 99', pickled)
+        self.assertEqual(cPickle.loads(pickled)[99], 'value 99')
+
+    def test_multi_process(self):
+        """
+        Workers should be able to look up values in the shared mapping.
+        """
+        keys = range(100)
+        results = dredge.multi.do_multi_process(
+            data=keys,
+            task=functools.partial(lookup_task, lookup=self.mapping),
+            cores_to_reserve=0
+        )
+        self.assertEqual(
+            sorted(value for result in results for value in result),
+            sorted(self.data[key] for key in keys)
+        )
+
+
+class TestSharedArray(unittest.TestCase):
+    """
+    Test the SharedArray class.
+    """
+    def setUp(self):
+        """
+        Write a shared array to disk.
+        """
+        self.temp_directory = dredge.tests.get_temp_directory()
+        self.data = [i * 0.5 for i in xrange(1000)]
+        self.array = dredge.shared.create_shared_array(
+            self.data, 'd', os.path.join(self.temp_directory, 'array.bin')
+        )
+
+    def tearDown(self):
+        """
+        Clean up the temp directory.
+        """
+        self.array.close()
+        shutil.rmtree(self.temp_directory)
+
+    def test_items(self):
+        """
+        Items should match the original data.
+        """
+        self.assertEqual(len(self.array), len(self.data))
+        self.assertEqual(list(self.array), self.data)
+        self.assertEqual(self.array[-1], self.data[-1])
+        self.assertRaises(IndexError, lambda: self.array[len(self.data)])
+
+    def test_slices(self):
+        """
+        Slices should return array copies of the requested items.
+        """
+        self.assertEqual(list(self.array[10:20]), self.data[10:20])
+        self.assertEqual(list(self.array[::-7]), self.data[::-7])
+
+    def test_pickle_round_trip(self):
+        """
+        Unpickled arrays should attach to the same file.
+        """
+        restored = cPickle.loads(cPickle.dumps(self.array, 2))
+        self.assertEqual(restored[500], self.data[500])
+
+
+if __name__ == '__main__':
+    unittest.main()
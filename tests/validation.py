@@ -0,0 +1,198 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+Module to test dredge.validation.
+"""
+
+import collections
+import datetime
+import unittest
+import dredge.validation
+
+## a row type with a column of each kind
+Row = collections.namedtuple('Row', ['name', 'count', 'score', 'day'])
+
+
+class TestColumn(unittest.TestCase):
+    """
+    Test the Column class.
+    """
+    def test_unknown_kind(self):
+        """
+        Should raise a ValueError for an unknown kind of column.
+        """
+        self.assertRaises(ValueError, dredge.validation.Column, 'complex')
+
+    def test_convert_int(self):
+        """
+        Should convert valid ints and report invalid and out of range values.
+        """
+        column = dredge.validation.Column('int', min_value=0, max_value=100)
+        converted, errors = column.convert(
+            ['1', 2, 'x', '150', '1.5', '-3', '', '42']
+        )
+        self.assertEqual(converted, [1, 2, 'x', '150', '1.5', '-3', '', 42])
+        self.assertEqual(sorted(errors), [2, 3, 4, 5, 6])
+        self.assertEqual(errors[2], "invalid int 'x'")
+        self.assertEqual(errors[3], "'150' out of range [0, 100]")
+        self.assertEqual(errors[6], 'missing value')
+
+    def test_convert_int_inexact(self):
+        """
+        Should report floats with a fractional part and bools rather than
+            truncating them, and compare the original values with the range.
+        """
+        column = dredge.validation.Column('int', max_value=10)
+        converted, errors = column.convert([3.7, True, 4.0, 10.9, 10, 11.0])
+        self.assertEqual(converted, [3.7, True, 4, 10.9, 10, 11.0])
+        self.assertEqual(sorted(errors), [0, 1, 3, 5])
+        self.assertEqual(errors[0], 'invalid int 3.7')
+        self.assertEqual(errors[1], 'invalid int True')
+        self.assertEqual(errors[5], '11.0 out of range [None, 10]')
+
+    def test_convert_int_fractional_bounds(self):
+        """
+        Should not truncate fractional bounds of int columns.
+        """
+        column = dredge.validation.Column('int', min_value=0.5, max_value=9.5)
+        converted, errors = column.convert(['0', '1', '9', '10'])
+        self.assertEqual(converted, ['0', 1, 9, '10'])
+        self.assertEqual(sorted(errors), [0, 3])
+
+    def test_convert_float(self):
+        """
+        Should convert floats and treat nan as out of any range.
+        """
+        column = dredge.validation.Column('float', max_value=1.0)
+        converted, errors = column.convert(['0.5', '1e-3', 'nan', '2'])
+        self.assertEqual(converted[:2], [0.5, 0.001])
+        self.assertEqual(sorted(errors), [2, 3])
+
+    def test_convert_date(self):
+        """
+        Should parse ISO dates and date objects.
+        """
+        column = dredge.validation.Column('date', min_value='2000-01-01')
+        converted, errors = column.convert(
+            [
+                '2013-01-02', datetime.date(2014, 5, 6), '2013-13-02',
+                '1999-12-31'
+            ]
+        )
+        self.assertEqual(
+            converted[:2],
+            [datetime.date(2013, 1, 2), datetime.date(2014, 5, 6)]
+        )
+        self.assertEqual(sorted(errors), [2, 3])
+
+    def test_optional(self):
+        """
+        Empty values in optional columns should be kept without errors.
+        """
+        column = dredge.validation.Column('datetime', required=False)
+        converted, errors = column.convert([None, '2013-01-02 10:11:12', ''])
+        self.assertEqual(
+            converted, [None, datetime.datetime(2013, 1, 2, 10, 11, 12), '']
+        )
+        self.assertEqual(errors, {})
+
+
+class TestRowValidator(unittest.TestCase):
+    """
+    Test the RowValidator class.
+    """
+    def setUp(self):
+        """
+        Create a validator that records its output.
+        """
+        self.written = list()
+        self.invalid = list()
+        self.validator = dredge.validation.RowValidator(
+            schema={
+                'count': dredge.validation.Column('int', min_value=0),
+                'score': dredge.validation.Column('float'),
+                'day': dredge.validation.Column('date', required=False)
+            },
+            write_rows=self.written.extend,
+            on_invalid_row=lambda item_id, message: self.invalid.append(
+                (item_id, message)
+            ),
+            batch_size=4
+        )
+
+    def test_batches(self):
+        """
+        Rows should be validated once a batch is full and when closed, with
+            invalid rows reported instead of written.
+        """
+        self.validator.add(['a', 'a'], [
+            Row('x', '1', '0.5', '2013-01-02'), Row('y', '-1', '1', '')
+        ])
+        self.assertEqual(self.written, [])
+        self.validator.add(['b', 'b'], [
+            Row('z', '3', 'bad', None), Row('w', '4', '2', None)
+        ])
+        self.assertEqual(len(self.written), 2)
+        self.validator.add(['c'], [Row('v', '5', '3', '2013-02-30')])
+        self.validator.close()
+        self.assertEqual(self.written, [
+            ('x', 1, 0.5, datetime.date(2013, 1, 2)), ('w', 4, 2.0, None)
+        ])
+        self.assertEqual(self.invalid, [
+            ('a', "invalid row: count '-1' out of range [0, None]"),
+            ('b', "invalid row: score invalid float 'bad'"),
+            ('c', "invalid row: day invalid date '2013-02-30'")
+        ])
+
+    def test_row_ids(self):
+        """
+        Invalid rows should be reported under their own ids, and the number of
+            valid rows of each call should be passed to its callback.
+        """
+        counts = list()
+        self.validator.add(
+            ['a', 'b', 'c'], [
+                Row('x', '1', '0.5', None), Row('x', '-1', '0.5', None),
+                Row('x', '2', '0.5', None)
+            ],
+            counts.append
+        )
+        self.validator.add(['d'], [Row('y', 'x', '1', None)], counts.append)
+        self.assertEqual(counts, [2, 0])
+        self.assertEqual([item_id for item_id, _ in self.invalid], ['b', 'd'])
+
+    def test_unknown_field(self):
+        """
+        Should raise a ValueError for a schema field that the rows lack.
+        """
+        validator = dredge.validation.RowValidator(
+            {'total': dredge.validation.Column('int')}, self.written.extend,
+            lambda item_id, message: None
+        )
+        self.assertRaises(
+            ValueError, validator.add, ['a'], [Row('x', '1', '0.5', None)]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2013 Adam Mechtley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+
+
+This module contains a stage that converts and validates parsed rows in bulk
+with NumPy before they are written. Rows are collected into batches, and each
+column with a schema is converted in one call per batch rather than row by row
+in Python. When a conversion fails, the batch is split in halves to find the
+values that caused it, so a few bad values cost a few extra conversions rather
+than a pass over every row. Requires the numpy package.
+"""
+
+import bisect
+import multiprocessing.util
+import numpy
+
+## numpy types to which each kind of column is converted
+COLUMN_TYPES = {
+    'int': 'int64',
+    'float': 'float64',
+    'date': 'datetime64[D]',
+    'datetime': 'datetime64[s]'
+}
+## default number of rows validated together
+DEFAULT_BATCH_SIZE = 10000
+
+
+class Column(object):
+    """
+    The type and allowed range of a column. Values are converted to the type
+        and written in a canonical form: ints and floats as Python writes them,
+        dates as YYYY-MM-DD and datetimes as YYYY-MM-DD HH:MM:SS. Dates and
+        datetimes are parsed from ISO 8601 strings or date objects.
+    """
+    def __init__(self, kind, min_value=None, max_value=None, required=True):
+        """
+        Initialize a new instance.
+        @param kind: 'int', 'float', 'date' or 'datetime'.
+        @param min_value: None or the smallest value allowed.
+        @param max_value: None or the largest value allowed.
+        @param required: True if None and empty strings are invalid; otherwise,
+            False, in which case they are written unchanged.
+        """
+        if kind not in COLUMN_TYPES:
+            raise ValueError('unknown column kind %r' % kind)
+        self.kind = kind
+        self.dtype = numpy.dtype(COLUMN_TYPES[kind])
+        self.min_value = min_value
+        self.max_value = max_value
+        self.required = required
+
+    def convert(self, values):
+        """
+        Convert and validate a column of values.
+        @param values: A sequence of values.
+        @return: A tuple of (converted, errors): a list of the converted values,
+            with invalid values unchanged, and a dict mapping the index of each
+            invalid value to a description of the problem.
+        """
+        values = numpy.array(values, dtype=object)
+        converted = values.copy()
+        errors = dict()
+        is_empty = numpy.equal(values, None) | numpy.equal(values, '')
+        if self.required:
+            for i in numpy.flatnonzero(is_empty):
+                errors[i] = 'missing value'
+        present = numpy.flatnonzero(~is_empty)
+        typed_values, is_bad = _convert(values[present], self.dtype)
+        if self.kind == 'int':
+            # astype() truncates floats and accepts bools, so reject both
+            is_inexact = _is_inexact_int(values[present[~is_bad]], typed_values)
+            is_bad[numpy.flatnonzero(~is_bad)[is_inexact]] = True
+            typed_values = typed_values[~is_inexact]
+        for i in present[is_bad]:
+            errors[i] = 'invalid %s %r' % (self.kind, values[i])
+        present = present[~is_bad]
+        # nan fails every comparison, so it is out of any range
+        is_out_of_range = numpy.zeros(len(present), dtype=bool)
+        # bounds of int columns may be fractional, so they are not truncated
+        if self.kind == 'int':
+            bound_dtype = numpy.dtype('float64')
+        else:
+            bound_dtype = self.dtype
+        with numpy.errstate(invalid='ignore'):
+            if self.min_value is not None:
+                is_out_of_range |= ~(
+                    typed_values >=
+                    numpy.array(self.min_value, dtype=bound_dtype)
+                )
+            if self.max_value is not None:
+                is_out_of_range |= ~(
+                    typed_values <=
+                    numpy.array(self.max_value, dtype=bound_dtype)
+                )
+        for i in present[is_out_of_range]:
+            errors[i] = '%r out of range [%s, %s]' % (
+                values[i], self.min_value, self.max_value
+            )
+        # assign through an object array so dates are not coerced back
+        typed_objects = numpy.empty(len(present), dtype=object)
+        typed_objects[:] = typed_values.tolist()
+        converted[present[~is_out_of_range]] = typed_objects[~is_out_of_range]
+        return converted.tolist(), errors
+
+
+def check_schema(schema, fields):
+    """
+    Check that every field in a schema is a field of the rows.
+    @param schema: A dict mapping the names of fields to Column objects.
+    @param fields: The names of the fields of the rows.
+    @raise ValueError: If a field in the schema is not a field of the rows.
+    """
+    missing_fields = sorted(set(schema) - set(fields))
+    if missing_fields:
+        raise ValueError(
+            'schema fields %s are not fields of the rows (%s)' % (
+                ', '.join(missing_fields), ', '.join(fields)
+            )
+        )
+
+
+class RowValidator(object):
+    """
+    Collects rows into batches, converts and validates the columns in a schema,
+        writes the valid rows and reports the invalid ones. Pending rows are
+        processed when the validator is closed or the process exits normally,
+        but are lost if the process is killed.
+    """
+    def __init__(
+            self, schema, write_rows, on_invalid_row,
+            batch_size=DEFAULT_BATCH_SIZE
+    ):
+        """
+        Initialize a new instance.
+        @param schema: A dict mapping the names of fields of the namedtuple
+            rows to Column objects. Fields not in the schema are written
+            unchanged.
+        @param write_rows: A function with the signature func(rows) that writes
+            a list of valid rows.
+        @param on_invalid_row: A function with the signature
+            func(item_id, message) that is called for each invalid row.
+        @param batch_size: The number of rows to collect before validating.
+        """
+        self.schema = schema
+        self.write_rows = write_rows
+        self.on_invalid_row = on_invalid_row
+        self.batch_size = batch_size
+        self._rows = list()
+        self._item_ids = list()
+        self._callbacks = list()
+        self._is_schema_checked = False
+        # run before error logs are flushed at exit, since this writes to them
+        self._finalizer = multiprocessing.util.Finalize(
+            self, self.flush, exitpriority=20
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add(self, item_ids, rows, on_validated=None):
+        """
+        Add rows to the current batch, validating it if it is full.
+        @param item_ids: A sequence of the id of the item that produced each
+            row, which is passed to on_invalid_row.
+        @param rows: A sequence of namedtuple rows.
+        @param on_validated: None or a function with the signature
+            func(row_count) that is called with the number of these rows that
+            were valid once they have been written.
+        @raise ValueError: If a field in the schema is not a field of the rows.
+        """
+        if rows and not self._is_schema_checked:
+            check_schema(self.schema, rows[0]._fields)
+            self._is_schema_checked = True
+        if on_validated is not None:
+            self._callbacks.append(
+                (len(self._rows), len(self._rows) + len(rows), on_validated)
+            )
+        self._rows.extend(rows)
+        self._item_ids.extend(item_ids)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Validate the current batch, write the valid rows and report the rest.
+        """
+        rows, item_ids = self._rows, self._item_ids
+        callbacks = self._callbacks
+        self._rows, self._item_ids, self._callbacks = list(), list(), list()
+        if not rows:
+            return
+        columns = zip(*rows)
+        messages = dict()
+        for field, column in sorted(self.schema.iteritems()):
+            index = rows[0]._fields.index(field)
+            columns[index], errors = column.convert(columns[index])
+            for i, error in errors.iteritems():
+                messages.setdefault(i, 'invalid row: %s %s' % (field, error))
+        rows = zip(*columns)
+        if messages:
+            self.write_rows(
+                [row for i, row in enumerate(rows) if i not in messages]
+            )
+            for i in sorted(messages):
+                self.on_invalid_row(item_ids[i], messages[i])
+        else:
+            self.write_rows(rows)
+        invalid_indices = sorted(messages)
+        for start, end, on_validated in callbacks:
+            on_validated(
+                end - start -
+                bisect.bisect_left(invalid_indices, end) +
+                bisect.bisect_left(invalid_indices, start)
+            )
+
+    def close(self):
+        """
+        Validate and write the last batch.
+        """
+        self._finalizer()
+
+
+def _is_inexact_int(values, typed_values):
+    """
+    Find values that were changed by converting them to ints.
+    @param values: An object array of values that could be converted.
+    @param typed_values: The values converted to int64.
+    @return: A boolean array marking bools and floats with a fractional part.
+    """
+    is_bool = numpy.frompyfunc(
+        lambda value: isinstance(value, (bool, numpy.bool_)), 1, 1
+    )(values).astype(bool)
+    with numpy.errstate(invalid='ignore'):
+        return is_bool | (values.astype('float64') != typed_values)
+
+
+def _convert(values, dtype):
+    """
+    Convert an array of values to a numpy type, isolating the values that
+        cannot be converted by splitting the array in halves.
+    @param values: An object array of values.
+    @param dtype: The numpy type to which to convert the values.
+    @return: A tuple of (converted, is_bad): an array of the values that could
+        be converted and a boolean array marking those that could not.
+    """
+    try:
+        return values.astype(dtype), numpy.zeros(len(values), dtype=bool)
+    except (ValueError, TypeError, OverflowError):
+        if len(values) == 1:
+            return numpy.array([], dtype=dtype), numpy.ones(1, dtype=bool)
+    middle = len(values) // 2
+    first, is_first_bad = _convert(values[:middle], dtype)
+    rest, is_rest_bad = _convert(values[middle:], dtype)
+    return (
+        numpy.concatenate([first, rest]),
+        numpy.concatenate([is_first_bad, is_rest_bad])
+    )